@@ -4,26 +4,54 @@
 # Flask-Multipass is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
-from flask_multipass.auth import AuthProvider
-from flask_multipass.core import Multipass
-from flask_multipass.data import AuthInfo, IdentityInfo
-from flask_multipass.exceptions import (
-    AuthenticationFailed,
-    GroupRetrievalFailed,
-    IdentityRetrievalFailed,
-    InvalidCredentials,
-    MultipassException,
-    NoSuchUser,
-)
-from flask_multipass.group import Group
-from flask_multipass.identity import IdentityProvider
+from importlib import import_module
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from flask_multipass.auth import AuthProvider
+    from flask_multipass.core import Multipass
+    from flask_multipass.data import AuthInfo, IdentityInfo
+    from flask_multipass.exceptions import (
+        AuthenticationFailed,
+        GroupRetrievalFailed,
+        IdentityRetrievalFailed,
+        InvalidCredentials,
+        MultipassException,
+        NoSuchUser,
+        ProviderUnavailable,
+    )
+    from flask_multipass.group import Group
+    from flask_multipass.identity import IdentityProvider
+
+# The public names are imported lazily (PEP 562) so importing e.g. just the
+# exceptions does not require loading Flask and all the core machinery.
+_lazy_attrs = {  # noqa: RUF067
+    'Multipass': 'flask_multipass.core',
+    'AuthProvider': 'flask_multipass.auth',
+    'IdentityProvider': 'flask_multipass.identity',
+    'AuthInfo': 'flask_multipass.data',
+    'IdentityInfo': 'flask_multipass.data',
+    'Group': 'flask_multipass.group',
+    'MultipassException': 'flask_multipass.exceptions',
+    'AuthenticationFailed': 'flask_multipass.exceptions',
+    'IdentityRetrievalFailed': 'flask_multipass.exceptions',
+    'GroupRetrievalFailed': 'flask_multipass.exceptions',
+    'NoSuchUser': 'flask_multipass.exceptions',
+    'InvalidCredentials': 'flask_multipass.exceptions',
+    'ProviderUnavailable': 'flask_multipass.exceptions',
+}
 
 __all__ = ('Multipass', 'AuthProvider', 'IdentityProvider', 'AuthInfo', 'IdentityInfo', 'Group', 'MultipassException',
            'AuthenticationFailed', 'IdentityRetrievalFailed', 'GroupRetrievalFailed', 'NoSuchUser',
-           'InvalidCredentials')
+           'InvalidCredentials', 'ProviderUnavailable')
 
 
 def __getattr__(name):
+    if name in _lazy_attrs:
+        value = getattr(import_module(_lazy_attrs[name]), name)
+        globals()[name] = value
+        return value
+
     if name == '__version__':
         import importlib.metadata
         import warnings
@@ -37,3 +65,7 @@ def __getattr__(name):
         return importlib.metadata.version('flask-multipass')
 
     raise AttributeError(name)
+
+
+def __dir__():
+    return sorted({*globals(), *_lazy_attrs})
@@ -21,6 +21,7 @@ class AuthProvider(metaclass=SupportsMeta):
                               'login_form is set'): 'process_local_login',
         SupportsMeta.callable(lambda cls: cls.login_form is None,
                               'login_form is not set'): 'initiate_external_login',
+        'supports_bearer_token': 'verify_bearer_token',
     }
     #: The entry point to lookup providers (do not override this!)
     _entry_point = 'flask_multipass.auth_providers'
@@ -30,6 +31,9 @@ class AuthProvider(metaclass=SupportsMeta):
     #: form in your application, specify a :class:`~flask_wtf.Form`
     #: here (usually containing a username/email and a password field).
     login_form = None
+    #: If the provider can verify bearer tokens sent along with API
+    #: requests
+    supports_bearer_token = False
 
     def __init__(self, multipass, name, settings):
         self.multipass = multipass
@@ -37,6 +41,23 @@ class AuthProvider(metaclass=SupportsMeta):
         self.settings = settings.copy()
         self.title = self.settings.pop('title', self.name)
 
+    @classmethod
+    def get_url_rules(cls, name, settings):
+        """Returns the URL rules needed by an instance of the provider.
+
+        The rules are registered when the application is initialized,
+        even if ``MULTIPASS_LAZY_PROVIDERS`` is enabled and the provider
+        is only instantiated once it is used.
+
+        :param name: The name of the auth provider instance
+        :param settings: The settings dictionary for the auth provider
+                         instance
+        :return: An iterable of ``(rule, endpoint, view, methods)``
+                 tuples, where `view` is the name of the provider's
+                 method handling the requests.
+        """
+        return ()
+
     @property
     def is_external(self):
         """True if the provider is external.
@@ -113,5 +134,21 @@ class AuthProvider(metaclass=SupportsMeta):
         """
         return None
 
+    def verify_bearer_token(self, token):  # pragma: no cover
+        """Verifies a bearer token sent along with an API request.
+
+        This is used by :meth:`.Multipass.authenticate_bearer_token`.
+
+        :param token: The bearer token
+        :raise AuthenticationFailed: If the token is not valid
+        :return: An :class:`.AuthInfo` instance containing data that can
+                 be used by the identity provider to retrieve information
+                 for the user the token belongs to.
+        """
+        if self.supports_bearer_token:
+            raise NotImplementedError
+        else:
+            raise RuntimeError('This provider does not support bearer tokens')
+
     def __repr__(self):
         return f'<{type(self).__name__}({self.name})>'
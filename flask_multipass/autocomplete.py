@@ -0,0 +1,150 @@
+# This file is part of Flask-Multipass.
+# Copyright (C) 2015 - 2021 CERN
+#
+# Flask-Multipass is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import heapq
+import itertools
+import threading
+import time
+
+from flask_multipass.util import TTLCache
+
+
+def normalize_query(query):
+    """Normalizes an autocomplete query.
+
+    Surrounding whitespace is removed, inner whitespace is collapsed and
+    the query is casefolded.
+    """
+    return ' '.join(query.split()).casefold()
+
+
+def _iter_values(identity, field):
+    value = identity.data.get(field)
+    values = value if isinstance(value, (list, tuple, set)) else (value,)
+    return (normalize_query(v) for v in values if isinstance(v, str))
+
+
+class Autocompleter:
+    """Answers type-ahead searches for identities.
+
+    The identities whose `fields` start with the query are searched
+    using ``match='prefix'`` and cached for the normalized query.  When
+    the query is extended (e.g. because the user typed another letter),
+    the cached results of the shorter query are narrowed down locally
+    instead of searching again, as long as they were complete, i.e. no
+    provider had more results than `fetch_limit`.  Only up to
+    ``fetch_limit + 1`` results are read from each search, so a short
+    query matching many identities does not retrieve all of them.
+
+    :param cache_ttl: The time in seconds to cache search results.
+    :param fetch_limit: The maximum number of identities to retrieve
+                        from each provider for every field.
+    :param debounce: The time in seconds to wait before searching.  If a
+                     newer query from the same client arrives in the
+                     meantime, the search is not performed at all.
+    """
+
+    def __init__(self, cache_ttl=60, fetch_limit=50, debounce=0):
+        self.cache = TTLCache(ttl=cache_ttl)
+        self.fetch_limit = fetch_limit
+        self.debounce = debounce
+        self._generations = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def _start(self, client):
+        with self._lock:
+            generation = self._generations[client] = next(self._counter)
+            return generation
+
+    def _is_superseded(self, client, generation):
+        return client is not None and self._generations.get(client) != generation
+
+    def _finish(self, client, generation):
+        with self._lock:
+            if self._generations.get(client) == generation:
+                del self._generations[client]
+
+    @staticmethod
+    def _matches(identity, fields, query):
+        return any(value.startswith(query) for field in fields for value in _iter_values(identity, field))
+
+    def _get_cached(self, key, query, fields):
+        entry = self.cache.get((*key, query))
+        if entry is not None:
+            return entry[0]
+        for length in range(len(query) - 1, 0, -1):
+            entry = self.cache.get((*key, query[:length]))
+            if entry is None:
+                continue
+            identities, complete = entry
+            if not complete:
+                # results for even shorter queries cannot be complete either
+                return None
+            identities = [identity for identity in identities if self._matches(identity, fields, query)]
+            self.cache.set((*key, query), (identities, True))
+            return identities
+        return None
+
+    def _search(self, multipass, query, fields, providers, client, generation):
+        identities = []
+        complete = True
+        for provider in multipass.identity_providers.values():
+            if (providers is not None and provider.name not in providers) or not provider.supports_search:
+                continue
+            # search criteria are ANDed, so each field needs its own search
+            for field in dict.fromkeys(fields):
+                if self._is_superseded(client, generation):
+                    return None
+                results = multipass._iter_search_results(provider, {field: {query}}, 'prefix')
+                try:
+                    # one more than needed tells us whether there are more results
+                    found = list(itertools.islice(results, self.fetch_limit + 1))
+                finally:
+                    results.close()
+                identities += found[:self.fetch_limit]
+                complete = complete and len(found) <= self.fetch_limit
+        return identities, complete
+
+    @staticmethod
+    def _rank(identity, fields, query):
+        return min(((value != query, i, len(value), value)
+                    for i, field in enumerate(fields)
+                    for value in _iter_values(identity, field)
+                    if value.startswith(query)),
+                   default=(True, len(fields), 0, ''))
+
+    def complete(self, multipass, query, fields=('name',), providers=None, limit=10, client=None):
+        """Returns the best identities matching a type-ahead query.
+
+        See :meth:`.Multipass.autocomplete` for details.
+        """
+        normalized = normalize_query(query)
+        if not normalized:
+            return []
+        key = (tuple(sorted(providers)) if providers is not None else None, tuple(fields))
+        generation = self._start(client) if client is not None else None
+        try:
+            identities = self._get_cached(key, normalized, fields)
+            if identities is None:
+                if self.debounce and client is not None:
+                    time.sleep(self.debounce)
+                result = self._search(multipass, ' '.join(query.split()), fields, providers, client, generation)
+                if result is None:
+                    return None
+                found, complete = result
+                identities = [identity for identity in found if self._matches(identity, fields, normalized)]
+                self.cache.set((*key, normalized), (identities, complete))
+            if self._is_superseded(client, generation):
+                return None
+        finally:
+            if client is not None:
+                self._finish(client, generation)
+        unique = {}
+        for identity in identities:
+            unique.setdefault((identity.provider.name, identity.identifier), identity)
+        return heapq.nsmallest(limit, unique.values(),
+                               key=lambda x: (self._rank(x, fields, normalized), x.provider.name, x.identifier))
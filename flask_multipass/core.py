@@ -4,38 +4,78 @@
 # Flask-Multipass is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
+import heapq
 import itertools
+import operator
+import sys
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 from urllib.parse import urlsplit
 
-from flask import current_app, flash, redirect, render_template, request, session, url_for
+from flask import (
+    appcontext_tearing_down,
+    copy_current_request_context,
+    current_app,
+    flash,
+    g,
+    has_app_context,
+    has_request_context,
+    redirect,
+    render_template,
+    request,
+    session,
+    url_for,
+)
 from werkzeug.datastructures import Headers, ImmutableDict
 from werkzeug.exceptions import NotFound
 
 from flask_multipass.auth import AuthProvider
+from flask_multipass.autocomplete import Autocompleter
 from flask_multipass.exceptions import (
     GroupRetrievalFailed,
     IdentityRetrievalFailed,
     InvalidCredentials,
     MultipassException,
     NoSuchUser,
+    ProviderUnavailable,
 )
 from flask_multipass.identity import IdentityProvider
+from flask_multipass.session import multipass_session, save_multipass_session
 from flask_multipass.util import (
+    CircuitBreaker,
+    SingleFlight,
     get_canonical_provider_map,
     get_provider_base,
     get_state,
     resolve_provider_type,
+    resolve_search_match,
     validate_provider_map,
 )
 
-# If SQLAlchemy is available, handle its AssociationCollection as a
-# multi-value type for search criteria
-try:
-    from sqlalchemy.ext.associationproxy import _AssociationCollection
-except ImportError:
-    multi_value_types = (list, tuple)
-else:
-    multi_value_types = (list, tuple, _AssociationCollection)
+
+def _normalize_search_criteria(criteria):
+    """Converts the values of search criteria to sets."""
+    for k, v in criteria.items():
+        if _is_multi_value(v):
+            criteria[k] = v = set(v)
+        elif not isinstance(v, set):
+            criteria[k] = v = {v}
+        if any(not x for x in v):
+            raise ValueError('Empty search criterion: ' + k)
+
+
+def _is_multi_value(value):
+    """Checks if a search criterion contains multiple values."""
+    if isinstance(value, (list, tuple)):
+        return True
+    # SQLAlchemy's AssociationCollection is handled as well, but there is no
+    # need to import SQLAlchemy for this: if it has not been imported yet, the
+    # value cannot be an AssociationCollection anyway
+    associationproxy = sys.modules.get('sqlalchemy.ext.associationproxy')
+    return associationproxy is not None and isinstance(value, associationproxy._AssociationCollection)
 
 
 class Multipass:
@@ -79,10 +119,26 @@ class Multipass:
         app.config.setdefault('MULTIPASS_ALL_MATCHING_IDENTITIES', False)
         app.config.setdefault('MULTIPASS_REQUIRE_IDENTITY', True)
         app.config.setdefault('MULTIPASS_HIDE_NO_SUCH_USER', False)
+        app.config.setdefault('MULTIPASS_SESSION_STORE', None)
+        app.config.setdefault('MULTIPASS_SESSION_STORE_TTL', 86400)
+        app.config.setdefault('MULTIPASS_LAZY_PROVIDERS', False)
+        app.config.setdefault('MULTIPASS_PARALLEL_IDENTITY_LOOKUPS', False)
+        app.config.setdefault('MULTIPASS_CIRCUIT_BREAKER', None)
+        app.config.setdefault('MULTIPASS_SINGLE_FLIGHT', False)
+        app.config.setdefault('MULTIPASS_REQUEST_CACHE', False)
+        app.config.setdefault('MULTIPASS_AUTOCOMPLETE_CACHE_TTL', 60)
+        app.config.setdefault('MULTIPASS_AUTOCOMPLETE_FETCH_LIMIT', 50)
+        app.config.setdefault('MULTIPASS_AUTOCOMPLETE_DEBOUNCE', 0)
+        state.autocompleter = Autocompleter(cache_ttl=app.config['MULTIPASS_AUTOCOMPLETE_CACHE_TTL'],
+                                            fetch_limit=app.config['MULTIPASS_AUTOCOMPLETE_FETCH_LIMIT'],
+                                            debounce=app.config['MULTIPASS_AUTOCOMPLETE_DEBOUNCE'])
+        app.after_request(save_multipass_session)
         with app.app_context():
             self._create_login_rule()
-            state.auth_providers = ImmutableDict(self._create_providers('AUTH', AuthProvider))
-            state.identity_providers = ImmutableDict(self._create_providers('IDENTITY', IdentityProvider))
+            state.auth_providers = self._create_providers('AUTH', AuthProvider)
+            state.identity_providers = self._create_providers('IDENTITY', IdentityProvider)
+            state.circuit_breakers = {'auth': self._create_circuit_breakers('AUTH'),
+                                      'identity': self._create_circuit_breakers('IDENTITY')}
             state.provider_map = ImmutableDict(get_canonical_provider_map(current_app.config['MULTIPASS_PROVIDER_MAP']))
             validate_provider_map(state)
 
@@ -109,6 +165,20 @@ class Multipass:
         """Returns a read-only mapping between auth and identity providers."""
         return get_state().provider_map
 
+    @property
+    def provider_health(self):
+        """Returns the health of all providers.
+
+        The health is tracked by each provider's circuit breaker, see
+        :attr:`.CircuitBreaker.health` for the available information.
+
+        :return: A dict with the ``auth`` and ``identity`` keys, each
+                 containing a dict mapping provider names to their
+                 health.
+        """
+        return {kind: {name: breaker.health for name, breaker in breakers.items()}
+                for kind, breakers in get_state().circuit_breakers.items()}
+
     def register_provider(self, cls, type_):
         """Registers a new provider type.
 
@@ -134,7 +204,7 @@ class Multipass:
         """Saves the URL to redirect to after logging in."""
         next_url = request.args.get('next')
         if next_url and self.validate_next_url(next_url):
-            session['_multipass_next_url'] = next_url
+            multipass_session['_multipass_next_url'] = next_url
 
     def validate_next_url(self, url):
         """Make sure the next URL is an allowed redirect target.
@@ -205,9 +275,10 @@ class Multipass:
         :param clear_session: If true, the Flask session is cleared.
         :return: A Flask respnse
         """
-        auth_provider = self.auth_providers.get(session.get('_multipass_login_provider'))
+        auth_provider = self.auth_providers.get(multipass_session.get('_multipass_login_provider'))
         response = auth_provider.process_logout(return_url) if auth_provider else None
         if clear_session:
+            multipass_session.clear()
             session.clear()
         return response or redirect(return_url)
 
@@ -241,30 +312,63 @@ class Multipass:
                           unique identity.
         :return: A Flask response
         """
-        links = self.provider_map[auth_info.provider.name]
-        identities = []
-        for link in links:
-            provider = self.identity_providers[link['identity_provider']]
-            mapping = link.get('mapping', {})
-            identity_info = provider.get_identity_from_auth(auth_info.map(mapping))
-            if identity_info is None:
-                continue
-            if identity_info.secure_login is None:
-                # if no information about login security has been set by the identity
-                # provider, copy whatever the auth provider may have
-                identity_info.secure_login = auth_info.secure_login
-            identities.append(identity_info)
-            if not current_app.config['MULTIPASS_ALL_MATCHING_IDENTITIES']:
-                break
+        if (tracked_login := g.pop('_multipass_tracked_login', None)) is not None:
+            # the auth provider successfully processed the login form; anything
+            # failing from now on is not its fault
+            tracked_login.close()
+        identities = self._get_identities_from_auth(auth_info)
         if not identities and current_app.config['MULTIPASS_REQUIRE_IDENTITY']:
             raise IdentityRetrievalFailed('No identity found', provider=auth_info.provider)
-        session['_multipass_login_provider'] = auth_info.provider.name
+        multipass_session['_multipass_login_provider'] = auth_info.provider.name
         if current_app.config['MULTIPASS_ALL_MATCHING_IDENTITIES']:
             response = self.login_finished(identities)
         else:
             response = self.login_finished(identities[0] if identities else None)
         return response or self.redirect_success()
 
+    def authenticate_bearer_token(self, token=None, provider=None):
+        """Authenticates an API request using a bearer token.
+
+        The token is verified by the auth provider and the identities
+        linked to it are retrieved just like during a login, but the
+        session is not touched and :meth:`login_finished` is not called.
+
+        :param token: The bearer token. If omitted, it is taken from the
+                      ``Authorization`` header of the current request.
+        :param provider: The name of the auth provider that issued the
+                         token. May be omitted if only one auth provider
+                         supports bearer tokens.
+        :return: An :class:`.IdentityInfo` instance, or a list of them if
+                 ``MULTIPASS_ALL_MATCHING_IDENTITIES`` is set. If no token
+                 was sent, ``None`` is returned.
+        """
+        if token is None:
+            auth_type, _, token = request.headers.get('Authorization', '').partition(' ')
+            if auth_type.lower() != 'bearer' or not token.strip():
+                return None
+            token = token.strip()
+        if provider is None:
+            providers = [p for p in self.auth_providers.values() if p.supports_bearer_token]
+            if len(providers) != 1:
+                raise ValueError('Provider must be specified unless exactly one provider supports bearer tokens')
+            provider = providers[0]
+        else:
+            try:
+                provider = self.auth_providers[provider]
+            except KeyError:
+                raise MultipassException('Provider does not exist: ' + provider)
+            if not provider.supports_bearer_token:
+                raise MultipassException('Provider does not support bearer tokens: ' + provider.name,
+                                           provider=provider)
+        with self._track_provider(provider):
+            auth_info = provider.verify_bearer_token(token)
+        identities = self._get_identities_from_auth(auth_info)
+        if not identities and current_app.config['MULTIPASS_REQUIRE_IDENTITY']:
+            raise IdentityRetrievalFailed('No identity found', provider=provider)
+        if current_app.config['MULTIPASS_ALL_MATCHING_IDENTITIES']:
+            return identities
+        return identities[0] if identities else None
+
     def handle_auth_error(self, exc, redirect_to_login=False):
         """Handles an authentication failure.
 
@@ -272,7 +376,7 @@ class Multipass:
         :param redirect_to_login: Returns a redirect response to the
                                   login page.
         """
-        session['_multipass_auth_failed'] = True
+        multipass_session['_multipass_auth_failed'] = True
         flash(current_app.config['MULTIPASS_FAILURE_MESSAGE'].format(error=str(exc)),
               current_app.config['MULTIPASS_FAILURE_CATEGORY'])
         if redirect_to_login:
@@ -339,7 +443,7 @@ class Multipass:
             raise IdentityRetrievalFailed('Provider does not exist: ' + provider_name)
         if not provider.supports_refresh:
             raise IdentityRetrievalFailed('Provider does not support refreshing: ' + provider_name, provider=provider)
-        return provider.refresh_identity(identifier, multipass_data)
+        return self._call_provider(provider, 'refresh_identity', identifier, multipass_data)
 
     def get_identity(self, provider, identifier):
         """Retrieves user identity information from a provider.
@@ -359,36 +463,49 @@ class Multipass:
         if not provider.supports_get:
             raise IdentityRetrievalFailed('Provider does not support getting identities: ' + provider.name,
                                           provider=provider)
-        return provider.get_identity(identifier)
+        return self._call_provider(provider, 'get_identity', identifier)
+
+    @staticmethod
+    def _get_search_kwargs(provider, match):
+        if match == 'prefix' and provider.supports_prefix_search:
+            return {'match': match}
+        # providers without prefix matching perform a substring search, which includes all prefix matches
+        return {'exact': match == 'exact'}
 
-    def search_identities(self, providers=None, exact=False, **criteria):
+    def search_identities(self, providers=None, exact=False, match=None, **criteria):
         """Searches user identities matching certain criteria.
 
         :param providers: A list of providers to search in. If not
                           specified, all providers are searched.
         :param exact: If criteria need to match exactly, i.e. no
                       substring matches are performed.
+        :param match: How criteria are matched: ``'contains'``,
+                      ``'exact'`` or ``'prefix'``.  Prefix matching is
+                      much faster than substring matching in providers
+                      that can use an index, e.g. for autocompletion.
+                      Providers which do not support it perform a
+                      substring search instead.
         :param criteria: The criteria to search for. A criterion can
                          have a list, tuple or set as value if there are
                          many values for the same criterion.
         :return: An iterable of matching user identities.
         """
-        for k, v in criteria.items():
-            if isinstance(v, multi_value_types):
-                criteria[k] = v = set(v)
-            elif not isinstance(v, set):
-                criteria[k] = v = {v}
-            if any(not x for x in v):
-                raise ValueError('Empty search criterion: ' + k)
+        match = resolve_search_match(exact, match)
+        _normalize_search_criteria(criteria)
 
         for provider in self.identity_providers.values():
             if providers is not None and provider.name not in providers:
                 continue
             if not provider.supports_search:
                 continue
-            yield from provider.search_identities(provider.map_search_criteria(criteria), exact=exact)
+            breaker = self._get_circuit_breaker(provider)
+            if not breaker.allow_request():
+                continue
+            with breaker.track(provider):
+                yield from provider.search_identities(provider.map_search_criteria(criteria),
+                                                      **self._get_search_kwargs(provider, match))
 
-    def search_identities_ex(self, providers=None, exact=False, limit=None, criteria=None):
+    def search_identities_ex(self, providers=None, exact=False, limit=None, criteria=None, match=None):
         """Search user identities matching search criteria.
 
         This is very similar to :meth:`search_identities`, but instead of just
@@ -399,13 +516,8 @@ class Multipass:
 
         :return: A tuple containing ``(identities, total_count)``.
         """
-        for k, v in criteria.items():
-            if isinstance(v, multi_value_types):
-                criteria[k] = v = set(v)
-            elif not isinstance(v, set):
-                criteria[k] = v = {v}
-            if any(not x for x in v):
-                raise ValueError('Empty search criterion: ' + k)
+        match = resolve_search_match(exact, match)
+        _normalize_search_criteria(criteria)
 
         found_identities = []
         total = 0
@@ -414,24 +526,128 @@ class Multipass:
                 continue
             if not provider.supports_search:
                 continue
-            if provider.supports_search_ex:
-                result, subtotal = provider.search_identities_ex(provider.map_search_criteria(criteria), exact=exact,
-                                                                 limit=limit)
-                found_identities += result
-                total += subtotal
-            else:
-                result_iter = provider.search_identities(provider.map_search_criteria(criteria), exact=exact)
-                if limit is not None:
-                    result = list(itertools.islice(result_iter, limit))
+            breaker = self._get_circuit_breaker(provider)
+            if not breaker.allow_request():
+                continue
+            with breaker.track(provider):
+                if provider.supports_search_ex:
+                    result, subtotal = provider.search_identities_ex(provider.map_search_criteria(criteria),
+                                                                     limit=limit,
+                                                                     **self._get_search_kwargs(provider, match))
                     found_identities += result
-                    total += len(result) + sum(1 for _ in result_iter)
+                    total += subtotal
                 else:
-                    result = list(result_iter)
-                    found_identities += result
-                    total += len(result)
+                    result_iter = provider.search_identities(provider.map_search_criteria(criteria),
+                                                             **self._get_search_kwargs(provider, match))
+                    if limit is not None:
+                        result = list(itertools.islice(result_iter, limit))
+                        found_identities += result
+                        total += len(result) + sum(1 for _ in result_iter)
+                    else:
+                        result = list(result_iter)
+                        found_identities += result
+                        total += len(result)
 
         return found_identities, total
 
+    def _iter_search_results(self, provider, criteria, match):
+        breaker = self._get_circuit_breaker(provider)
+        if not breaker.allow_request():
+            return
+        with breaker.track(provider):
+            yield from provider.search_identities(provider.map_search_criteria(criteria),
+                                                  **self._get_search_kwargs(provider, match))
+
+    def _search_identities_limited(self, provider, criteria, match, limit):
+        breaker = self._get_circuit_breaker(provider)
+        if not breaker.allow_request():
+            return []
+        with breaker.track(provider):
+            identities, __ = provider.search_identities_ex(provider.map_search_criteria(criteria), limit=limit,
+                                                           **self._get_search_kwargs(provider, match))
+            return identities
+
+    def search_identities_top(self, limit, key=None, providers=None, exact=False, match=None, criteria=None):
+        """Searches the best identities matching criteria in all providers.
+
+        Unlike :meth:`search_identities_ex`, `limit` applies to the
+        combined results of all providers: the identities are sorted by
+        `key` and only the first `limit` ones are returned.
+
+        Providers which support
+        :meth:`~.IdentityProvider.search_identities_ex` are asked for at
+        most `limit` identities (so e.g. a database can apply the limit);
+        unless they already return identities in the requested order
+        (see :attr:`.IdentityProvider.search_order`), only the best of
+        those they return are used.  The results of other providers in
+        the requested order are only consumed until they cannot make it
+        into the result anymore.  Only the results of all other
+        providers need to be sorted, and only `limit` of them are kept
+        while doing so.
+
+        :param limit: The max number of identities to return.
+        :param key: A function returning the sort key of an identity,
+                    e.g. :func:`.exact_match_first`.  If not specified,
+                    identities are sorted by their identifier.
+        :param providers: A list of providers to search in. If not
+                          specified, all providers are searched.
+        :param exact: If criteria need to match exactly, i.e. no
+                      substring matches are performed.
+        :param match: How criteria are matched: ``'contains'``,
+                      ``'exact'`` or ``'prefix'``.
+        :param criteria: A dict containing the criteria to search for.
+        :return: A list of up to `limit` identities.  Identities with the
+                 same sort key are returned in provider order.
+        """
+        match = resolve_search_match(exact, match)
+        _normalize_search_criteria(criteria)
+        sort_key = key or operator.attrgetter('identifier')
+        streams = []
+        for provider in self.identity_providers.values():
+            if providers is not None and provider.name not in providers:
+                continue
+            if not provider.supports_search:
+                continue
+            ordered = key is None and provider.search_order == 'identifier'
+            if provider.supports_search_ex:
+                identities = self._search_identities_limited(provider, criteria, match, limit)
+                streams.append(identities if ordered else sorted(identities, key=sort_key))
+            elif ordered:
+                streams.append(self._iter_search_results(provider, criteria, match))
+            else:
+                results = self._iter_search_results(provider, criteria, match)
+                streams.append(heapq.nsmallest(limit, results, key=sort_key))
+        try:
+            return list(itertools.islice(heapq.merge(*streams, key=sort_key), limit))
+        finally:
+            for stream in streams:
+                if not isinstance(stream, list):
+                    stream.close()
+
+    def autocomplete(self, query, fields=('name',), providers=None, limit=10, client=None):
+        """Searches identities for a type-ahead user picker.
+
+        Identities are found if one of the `fields` starts with the
+        query; case and redundant whitespace are ignored.  Results are
+        cached for ``MULTIPASS_AUTOCOMPLETE_CACHE_TTL`` seconds, and when
+        the query is extended the cached results of the shorter query
+        are narrowed down locally if they were complete.
+
+        :param query: The string the user typed.
+        :param fields: The identity data keys to search in.
+        :param providers: A list of providers to search in. If not
+                          specified, all providers are searched.
+        :param limit: The maximum number of identities to return.
+        :param client: An opaque key identifying the client (e.g. the
+                       session id).  If set, a newer query from the same
+                       client cancels this one if it has not finished
+                       yet.
+        :return: A list of the best matching identities, with exact
+                 matches first and shorter values before longer ones,
+                 or ``None`` if the query has been superseded.
+        """
+        return get_state().autocompleter.complete(self, query, fields, providers, limit, client)
+
     def get_group(self, provider, name):
         """Returns a specific group.
 
@@ -443,9 +659,10 @@ class Multipass:
             provider = self.identity_providers[provider]
         except KeyError:
             raise GroupRetrievalFailed('Provider does not exist: ' + provider)
-        return provider.get_group(name)
+        return self._request_cached(('get_group', provider.name, name),
+                                    self._call_provider, provider, 'get_group', name)
 
-    def search_groups(self, name, providers=None, exact=False):
+    def search_groups(self, name, providers=None, exact=False, match=None):
         """Searches groups by name.
 
         :param name: The name to search for.
@@ -453,14 +670,21 @@ class Multipass:
                           specified, all providers are searched.
         :param exact: If the name needs to match exactly, i.e. no
                       substring matches are performed.
+        :param match: How the name is matched: ``'contains'``,
+                      ``'exact'`` or ``'prefix'``.
         :return: An iterable of matching groups.
         """
+        match = resolve_search_match(exact, match)
         for provider in self.identity_providers.values():
             if providers is not None and provider.name not in providers:
                 continue
             if not provider.supports_groups:
                 continue
-            yield from provider.search_groups(name, exact=exact)
+            breaker = self._get_circuit_breaker(provider)
+            if not breaker.allow_request():
+                continue
+            with breaker.track(provider):
+                yield from provider.search_groups(name, **self._get_search_kwargs(provider, match))
 
     def is_identity_in_group(self, provider, identity_identifier, group_name):
         """Checks if a user identity is in a group.
@@ -469,27 +693,281 @@ class Multipass:
         :param identity_identifier: The identifier of the user.
         :param group_name: The name of the group.
         """
-        group = self.get_group(provider, group_name)
-        return identity_identifier in group
+        def _is_identity_in_group():
+            group = self.get_group(provider, group_name)
+            return identity_identifier in group
+
+        return self._request_cached(('has_member', provider, group_name, identity_identifier), _is_identity_in_group)
+
+    def check_memberships(self, provider, pairs):
+        """Checks many group memberships at once.
+
+        The pairs are grouped by group, so each group is retrieved once
+        and all identities are checked using a single
+        :meth:`.Group.has_members` call.  Identities which are checked
+        against several groups are handled using a single
+        :meth:`get_identity_groups` call instead if the provider supports
+        it (and does not use a membership snapshot).
+
+        :param provider: The name of the provider containing the groups.
+        :param pairs: An iterable of ``(identity_identifier, group_name)``
+                      tuples.
+        :return: A dict mapping each pair to a bool indicating whether
+                 the identity is a member of the group.  Groups which do
+                 not exist have no members.
+        """
+        use_cache = current_app.config['MULTIPASS_REQUEST_CACHE']
+        cache = _get_request_cache() if use_cache else {}
+        results = {}
+        identifiers_by_group = {}
+        for identifier, group_name in set(pairs):
+            try:
+                results[identifier, group_name] = cache['has_member', provider, group_name, identifier]
+            except KeyError:
+                identifiers_by_group.setdefault(group_name, set()).add(identifier)
+        identity_provider = self.identity_providers.get(provider)
+        snapshot = getattr(identity_provider, 'membership_snapshot', None)
+        if snapshot is None and getattr(identity_provider, 'supports_get_identity_groups', False):
+            results.update(self._check_memberships_by_identity(provider, identifiers_by_group, cache, use_cache))
+        for group_name, identifiers in identifiers_by_group.items():
+            if not identifiers:
+                continue
+            members = snapshot.has_members(group_name, identifiers) if snapshot is not None else None
+            if members is None:
+                group = self.get_group(provider, group_name)
+                members = group.has_members(identifiers) if group is not None else set()
+            for identifier in identifiers:
+                results[identifier, group_name] = is_member = identifier in members
+                if use_cache:
+                    cache['has_member', provider, group_name, identifier] = is_member
+        return results
+
+    def _check_memberships_by_identity(self, provider, identifiers_by_group, cache, use_cache):
+        """Checks the memberships of identities checked against several groups.
+
+        The groups of each such identity are retrieved once and the
+        identity is removed from `identifiers_by_group`.
+        """
+        groups_by_identifier = {}
+        for group_name, identifiers in identifiers_by_group.items():
+            for identifier in identifiers:
+                groups_by_identifier.setdefault(identifier, set()).add(group_name)
+        results = {}
+        for identifier, group_names in groups_by_identifier.items():
+            if len(group_names) < 2:
+                continue
+            identity_groups = {group.name for group in self.get_identity_groups(provider, identifier)}
+            for group_name in group_names:
+                results[identifier, group_name] = is_member = group_name in identity_groups
+                identifiers_by_group[group_name].discard(identifier)
+                if use_cache:
+                    cache['has_member', provider, group_name, identifier] = is_member
+        return results
+
+    def get_identity_groups(self, provider, identifier):
+        """Returns the groups a user identity is a member of.
+
+        If the provider has a ``membership_snapshot``, the groups are
+        taken from it, so only groups contained in the snapshot are
+        returned.
+
+        :param provider: The name of the provider containing the groups.
+        :param identifier: The identifier of the user.
+        :return: A set of :class:`.Group` instances.
+        """
+        try:
+            provider = self.identity_providers[provider]
+        except KeyError:
+            raise GroupRetrievalFailed('Provider does not exist: ' + provider)
+        if provider.membership_snapshot is not None:
+            groups = provider.membership_snapshot.get_identity_groups(identifier)
+            if groups is not None:
+                return groups
+        if not provider.supports_get_identity_groups:
+            raise GroupRetrievalFailed('Provider does not support getting identity groups: ' + provider.name,
+                                       provider=provider)
+        return self._request_cached(('get_identity_groups', provider.name, identifier),
+                                    self._call_provider, provider, 'get_identity_groups', identifier)
+
+    def _get_identities_from_auth(self, auth_info):
+        """Retrieves the identities linked to an auth provider.
+
+        :param auth_info: An :class:`.AuthInfo` instance.
+        :return: A list of :class:`.IdentityInfo` instances. Unless
+                 ``MULTIPASS_ALL_MATCHING_IDENTITIES`` is set, it contains
+                 only the first identity found.
+        """
+        links = self.provider_map[auth_info.provider.name]
+        all_matching = current_app.config['MULTIPASS_ALL_MATCHING_IDENTITIES']
+        if current_app.config['MULTIPASS_PARALLEL_IDENTITY_LOOKUPS'] and len(links) > 1:
+            results = self._get_identities_from_links_parallel(auth_info, links)
+        else:
+            results = (self._get_identity_from_link(auth_info, link) for link in links)
+        identities = []
+        for identity_info in results:
+            if identity_info is None:
+                continue
+            if identity_info.secure_login is None:
+                # if no information about login security has been set by the identity
+                # provider, copy whatever the auth provider may have
+                identity_info.secure_login = auth_info.secure_login
+            identities.append(identity_info)
+            if not all_matching:
+                break
+        return identities
+
+    def _get_identity_from_link(self, auth_info, link):
+        """Retrieves the identity for a single auth/identity provider link."""
+        provider = self.identity_providers[link['identity_provider']]
+        with self._track_provider(provider):
+            return provider.get_identity_from_auth(auth_info.map(link.get('mapping', {})))
+
+    def _get_identities_from_links_parallel(self, auth_info, links):
+        """Retrieves the identities for provider links concurrently.
+
+        All lookups are started immediately, but the results are yielded
+        in the order of the links, so the first identity found is still
+        the one from the first matching link.  Any lookups that are still
+        running once the caller stops consuming the results are abandoned.
+        """
+        executor = ThreadPoolExecutor(max_workers=len(links), thread_name_prefix='multipass-identity')
+        try:
+            if has_request_context():
+                futures = [executor.submit(copy_current_request_context(self._get_identity_from_link), auth_info, link)
+                           for link in links]
+            else:
+                app = current_app._get_current_object()
+                futures = [executor.submit(self._get_identity_from_link_in_app_context, app, auth_info, link)
+                           for link in links]
+            for future in futures:
+                yield future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_identity_from_link_in_app_context(self, app, auth_info, link):
+        with app.app_context():
+            return self._get_identity_from_link(auth_info, link)
+
+    def _get_circuit_breaker(self, provider):
+        """Returns the circuit breaker of a provider."""
+        kind = 'auth' if isinstance(provider, AuthProvider) else 'identity'
+        return get_state().circuit_breakers[kind][provider.name]
+
+    def _track_provider(self, provider):
+        """Tracks a call to a provider using its circuit breaker.
+
+        :param provider: The provider that will be called.
+        :return: A context manager wrapping the call to the provider.
+        :raise ProviderUnavailable: if the provider's circuit breaker is
+                                    open.
+        """
+        breaker = self._get_circuit_breaker(provider)
+        if not breaker.allow_request():
+            raise ProviderUnavailable('Provider is temporarily unavailable: ' + provider.name, provider=provider)
+        return breaker.track(provider)
+
+    def _call_provider(self, provider, operation, arg, *args):
+        """Calls a lookup method of a provider.
+
+        The call is tracked by the provider's circuit breaker.  If
+        ``MULTIPASS_SINGLE_FLIGHT`` is enabled, concurrent calls for the
+        same provider, operation and argument are coalesced, so only
+        the first one reaches the provider and the others share its
+        result or exception.
+
+        :param provider: The provider to call.
+        :param operation: The name of the provider method to call.
+        :param arg: The argument identifying what is looked up.
+        :param args: Further arguments passed to the provider method.
+        """
+        def _call():
+            with self._track_provider(provider):
+                return getattr(provider, operation)(arg, *args)
+
+        if not current_app.config['MULTIPASS_SINGLE_FLIGHT']:
+            return _call()
+        return get_state().single_flight.call((provider.name, operation, arg), _call)
+
+    def _request_cached(self, key, func, *args):
+        """Calls a function, remembering its result for the app context.
+
+        Unless ``MULTIPASS_REQUEST_CACHE`` is enabled, the function is
+        simply called.  Exceptions are not cached.
+
+        :param key: A hashable key identifying the call.
+        :param func: The function to call.
+        :param args: Arguments passed to the function.
+        """
+        if not current_app.config['MULTIPASS_REQUEST_CACHE']:
+            return func(*args)
+        cache = _get_request_cache()
+        try:
+            return cache[key]
+        except KeyError:
+            rv = cache[key] = func(*args)
+            return rv
 
     def _create_providers(self, key, base):
         """Instantiates all providers.
 
+        If ``MULTIPASS_LAZY_PROVIDERS`` is enabled, the providers are
+        only instantiated when they are first accessed.
+
         :param key: The key to insert into the config option name
                     ``MULTIPASS_*_PROVIDERS``
         :param base: The base class of the provider type.
         """
         registry = self.provider_registry[AuthProvider if key == 'AUTH' else IdentityProvider]
-        providers = {}
+        factories = {}
         provider_classes = set()
         for name, settings in current_app.config[f'MULTIPASS_{key}_PROVIDERS'].items():
             settings = settings.copy()
+            settings.pop('circuit_breaker', None)
             cls = resolve_provider_type(base, settings.pop('type'), registry)
             if not cls.multi_instance and cls in provider_classes:
                 raise RuntimeError('Provider does not support multiple instances: ' + cls.__name__)
-            providers[name] = cls(self, name, settings)
+            if key == 'AUTH':
+                self._create_provider_rules(name, cls, settings)
+            factories[name] = partial(cls, self, name, settings)
             provider_classes.add(cls)
-        return providers
+        if current_app.config.get('MULTIPASS_LAZY_PROVIDERS'):
+            return _LazyProviderDict(current_app._get_current_object(), factories)
+        return ImmutableDict({name: factory() for name, factory in factories.items()})
+
+    def _create_circuit_breakers(self, key):
+        """Creates the circuit breakers of all providers.
+
+        The ``circuit_breaker`` dict in the settings of a provider
+        overrides the defaults from ``MULTIPASS_CIRCUIT_BREAKER``. If it
+        is ``False``, the provider's circuit breaker never opens.
+
+        :param key: The key to insert into the config option name
+                    ``MULTIPASS_*_PROVIDERS``
+        """
+        defaults = current_app.config['MULTIPASS_CIRCUIT_BREAKER'] or {}
+        breakers = {}
+        for name, settings in current_app.config[f'MULTIPASS_{key}_PROVIDERS'].items():
+            breaker_settings = settings.get('circuit_breaker')
+            if breaker_settings is False:
+                breakers[name] = CircuitBreaker(name)
+            else:
+                breakers[name] = CircuitBreaker(name, **{**defaults, **(breaker_settings or {})})
+        return breakers
+
+    def _create_provider_rules(self, name, cls, settings):
+        """Creates the URL rules of an auth provider.
+
+        :param name: The name of the auth provider instance
+        :param cls: The class of the auth provider
+        :param settings: The settings dictionary of the provider
+        """
+        for rule, endpoint, view, methods in cls.get_url_rules(name, settings):
+            view_func = partial(self._dispatch_provider_view, name, view)
+            current_app.add_url_rule(rule, endpoint, view_func, methods=methods)
+
+    def _dispatch_provider_view(self, provider_name, view, **kwargs):
+        """Calls a view function of an auth provider."""
+        return getattr(self.auth_providers[provider_name], view)(**kwargs)
 
     def _create_login_rule(self):
         """Creates the login URL rule if necessary."""
@@ -508,14 +986,14 @@ class Multipass:
         URL is used.
         """
         try:
-            return session.pop('_multipass_next_url')
+            return multipass_session.pop('_multipass_next_url')
         except KeyError:
             return url_for(current_app.config['MULTIPASS_SUCCESS_ENDPOINT'])
 
     def _login_selector(self):
         """Shows the login method (auth provider) selector."""
         next_url = request.args.get('next')
-        auth_failed = session.pop('_multipass_auth_failed', False)
+        auth_failed = multipass_session.pop('_multipass_auth_failed', False)
         login_endpoint = current_app.config['MULTIPASS_LOGIN_ENDPOINT']
         if not auth_failed and self.single_auth_provider:
             return redirect(url_for(login_endpoint, provider=self.single_auth_provider.name, next=next_url))
@@ -540,7 +1018,8 @@ class Multipass:
         :return: A flask response or ``None`` in case of an error.
         """
         try:
-            response = provider.process_local_login(data)
+            with self._track_local_login(provider):
+                response = provider.process_local_login(data)
         except MultipassException as e:
             if isinstance(e, NoSuchUser) and current_app.config['MULTIPASS_HIDE_NO_SUCH_USER']:
                 e = InvalidCredentials(e.provider)
@@ -548,6 +1027,23 @@ class Multipass:
         else:
             return response
 
+    def _track_local_login(self, provider):
+        """Tracks the processing of a login form by a provider.
+
+        Only the provider's own work counts for its circuit breaker: the
+        tracking ends as soon as the provider passes the login on to
+        :meth:`handle_auth_success`, so errors from the identity providers
+        or the application's callbacks are not blamed on it.
+
+        :param provider: The provider processing the login form.
+        :return: A context manager wrapping the call to the provider.
+        """
+        stack = ExitStack()
+        stack.enter_context(self._track_provider(provider))
+        stack.callback(g.pop, '_multipass_tracked_login', None)
+        g._multipass_tracked_login = stack
+        return stack
+
     def _login_form(self, provider):
         """Starts the local form-based login process."""
         form = provider.login_form()
@@ -560,6 +1056,59 @@ class Multipass:
         return self.render_template('LOGIN_FORM', form=form, provider=provider)
 
 
+@appcontext_tearing_down.connect
+def _clear_request_cache(*args, **kwargs):
+    if has_app_context():
+        g.pop('_multipass_request_cache', None)
+
+
+def _get_request_cache():
+    """Returns the cache dictionary for the current app context."""
+    try:
+        return g._multipass_request_cache
+    except AttributeError:
+        g._multipass_request_cache = cache = {}
+        return cache
+
+
+class _LazyProviderDict(Mapping):
+    """A read-only dict of providers which are instantiated on first access.
+
+    :param app: The application the providers belong to
+    :param factories: A dict mapping provider names to callables creating
+                      the provider.
+    """
+
+    def __init__(self, app, factories):
+        self._app = app
+        self._factories = factories
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        try:
+            return self._providers[name]
+        except KeyError:
+            factory = self._factories[name]
+        with self._lock:
+            if name not in self._providers:
+                if has_app_context():
+                    self._providers[name] = factory()
+                else:
+                    with self._app.app_context():
+                        self._providers[name] = factory()
+            return self._providers[name]
+
+    def __iter__(self):
+        return iter(self._factories)
+
+    def __len__(self):
+        return len(self._factories)
+
+    def __repr__(self):
+        return f'<LazyProviderDict({", ".join(self._factories)})>'
+
+
 class _MultipassState:
     def __init__(self, multipass, app):
         self.multipass = multipass
@@ -567,6 +1116,9 @@ class _MultipassState:
         self.auth_providers = {}
         self.identity_providers = {}
         self.provider_map = {}
+        self.circuit_breakers = {'auth': {}, 'identity': {}}
+        self.single_flight = SingleFlight()
+        self.autocompleter = None
 
     def __repr__(self):
         return f'<MultipassState({self.multipass}, {self.app})>'
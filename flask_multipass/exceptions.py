@@ -43,3 +43,12 @@ class IdentityRetrievalFailed(MultipassException):
 
 class GroupRetrievalFailed(MultipassException):
     """Indicates a failure while retrieving group information."""
+
+
+class ProviderUnavailable(MultipassException):
+    """Indicates that a provider cannot be used right now.
+
+    This is raised when the service behind a provider is unreachable
+    or when the provider's circuit breaker is open after repeated
+    failures.
+    """
@@ -4,6 +4,7 @@
 # Flask-Multipass is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
+from flask_multipass.membership import MemberBitmap
 from flask_multipass.util import SupportsMeta
 
 
@@ -34,20 +35,86 @@ class Group(metaclass=SupportsMeta):
         if self.supports_member_list:
             raise NotImplementedError
 
+    def count_members(self):
+        """Returns the number of members of the group.
+
+        If the group is in the membership snapshot of the identity
+        provider, the count is taken from there.  Otherwise, if the
+        provider has a ``member_count_cache_ttl`` setting, the count is
+        cached for that many seconds.
+
+        :return: The number of members.
+        """
+        snapshot = getattr(self.provider, 'membership_snapshot', None)
+        if snapshot is not None and (count := snapshot.count_members(self.name)) is not None:
+            return count
+        cache = getattr(self.provider, '_member_count_cache', None)
+        count = cache.get(self.name) if cache is not None else None
+        if count is None:
+            count = self._count_members()
+            if cache is not None:
+                cache.set(self.name, count)
+        return count
+
+    def _count_members(self):
+        """Counts the members of the group.
+
+        Subclasses should override this if they can count the members
+        without retrieving all of them.
+        """
+        if not self.supports_member_list:
+            raise NotImplementedError
+        return sum(1 for __ in self.get_members())
+
+    def get_member_bitmap(self):
+        """Returns the members of the group as a bitmap.
+
+        The bitmap contains the IDs assigned to the members by the
+        ``identifier_table`` of the identity provider, so bitmaps of
+        different groups can be combined using set operations.  The
+        members are taken from the membership snapshot of the provider
+        if the group is in it, otherwise :meth:`get_members` is used.
+
+        :return: A :class:`.MemberBitmap`.
+        """
+        snapshot = getattr(self.provider, 'membership_snapshot', None)
+        identifiers = snapshot.get_members(self.name) if snapshot is not None else None
+        if identifiers is None:
+            identifiers = {identity.identifier for identity in self.get_members()}
+        return MemberBitmap(self.provider.identifier_table.get_ids(identifiers))
+
     def has_member(self, identifier):  # pragma: no cover
         """Checks if a given identity is a member of the group.
 
-        This check can also be performed using the ``in`` operator.
+        This check can also be performed using the ``in`` operator,
+        which uses the membership snapshot of the identity provider if
+        the group is in it.
 
         :param identifier: The `identifier` from an :class:`.IdentityInfo`
                            provided by the associated identity provider.
         """
         raise NotImplementedError
 
+    def has_members(self, identifiers):
+        """Checks which of the given identities are members of the group.
+
+        By default this calls :meth:`has_member` for each identity, but
+        providers may check all of them at once.
+
+        :param identifiers: An iterable of `identifier` values from
+                            :class:`.IdentityInfo` objects provided by
+                            the associated identity provider.
+        :return: A set containing the identifiers of the members.
+        """
+        return {identifier for identifier in set(identifiers) if self.has_member(identifier)}
+
     def __iter__(self):  # pragma: no cover
         return self.get_members()
 
-    def __contains__(self, identifier):  # pragma: no cover
+    def __contains__(self, identifier):
+        snapshot = getattr(self.provider, 'membership_snapshot', None)
+        if snapshot is not None and (members := snapshot.has_members(self.name, {identifier})) is not None:
+            return identifier in members
         return self.has_member(identifier)
 
     def __repr__(self):
@@ -6,7 +6,8 @@
 
 from flask import current_app
 
-from flask_multipass.util import SupportsMeta, convert_app_data
+from flask_multipass.membership import IdentifierTable, MembershipSnapshot
+from flask_multipass.util import SupportsMeta, TTLCache, convert_app_data
 
 
 class IdentityProvider(metaclass=SupportsMeta):
@@ -37,6 +38,12 @@ class IdentityProvider(metaclass=SupportsMeta):
     supports_search = False
     #: If the provider supports the extended identity search feature
     supports_search_ex = False
+    #: If the provider supports searching with ``match='prefix'``
+    supports_prefix_search = False
+    #: Set to ``'identifier'`` if :meth:`search_identities` yields the
+    #: identities sorted by their identifier (in the same order Python
+    #: sorts them)
+    search_order = None
     #: If the provider also provides groups and membership information
     supports_groups = False
     #: If the provider supports getting the list of groups an identity belongs to
@@ -58,6 +65,12 @@ class IdentityProvider(metaclass=SupportsMeta):
         self.supports_search = search_enabled
         if not self.supports_search:
             self.supports_search_ex = False
+        self._member_count_cache = TTLCache(self.settings.pop('member_count_cache_ttl', 0))
+        snapshot_settings = self.settings.pop('membership_snapshot', None)
+        self.membership_snapshot = MembershipSnapshot(self, snapshot_settings) if snapshot_settings else None
+        #: The table mapping the identifiers of this provider's identities to the
+        #: dense IDs used in :class:`.MemberBitmap`
+        self.identifier_table = IdentifierTable(self.settings.pop('identifier_table_file', None))
 
     def get_identity_from_auth(self, auth_info):  # pragma: no cover
         """Retrieves identity information after authentication.
@@ -111,12 +124,15 @@ class IdentityProvider(metaclass=SupportsMeta):
         else:
             raise RuntimeError('This provider does not support getting the list of groups for an identity')
 
-    def search_identities(self, criteria, exact=False):  # pragma: no cover
+    def search_identities(self, criteria, exact=False, match=None):  # pragma: no cover
         """Searches user identities matching certain criteria.
 
         :param criteria: A dict containing the criteria to search for.
         :param exact: If criteria need to match exactly, i.e. no
                       substring matches are performed.
+        :param match: How criteria are matched (``'contains'``,
+                      ``'exact'`` or ``'prefix'``); only passed if
+                      :attr:`supports_prefix_search` is set.
         :return: An iterable of matching identities.
         """
         if self.supports_search:
@@ -124,12 +140,15 @@ class IdentityProvider(metaclass=SupportsMeta):
         else:
             raise RuntimeError('This provider does not support searching')
 
-    def search_identities_ex(self, criteria, exact=False, limit=None):  # pragma: no cover
+    def search_identities_ex(self, criteria, exact=False, limit=None, match=None):  # pragma: no cover
         """Search user identities matching certain criteria.
 
         :param criteria: A dict containing the criteria to search for.
         :param exact: If criteria need to match exactly, i.e. no
                       substring matches are performed.
+        :param match: How criteria are matched (``'contains'``,
+                      ``'exact'`` or ``'prefix'``); only passed if
+                      :attr:`supports_prefix_search` is set.
         :param limit: The max number of identities to return.
         :return: A tuple containing ``(identities, total_count)``.
         """
@@ -149,12 +168,15 @@ class IdentityProvider(metaclass=SupportsMeta):
         else:
             raise RuntimeError('This provider does not provide groups')
 
-    def search_groups(self, name, exact=False):  # pragma: no cover
+    def search_groups(self, name, exact=False, match=None):  # pragma: no cover
         """Searches groups by name.
 
         :param name: The name to search for
         :param exact: If the name needs to match exactly, i.e. no
                       substring matches are performed
+        :param match: How the name is matched (``'contains'``,
+                      ``'exact'`` or ``'prefix'``); only passed if
+                      :attr:`supports_prefix_search` is set
         :return: An iterable of matching :attr:`group_class` objects
         """
         if self.supports_groups:
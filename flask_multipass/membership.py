@@ -0,0 +1,398 @@
+# This file is part of Flask-Multipass.
+# Copyright (C) 2015 - 2021 CERN
+#
+# Flask-Multipass is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from flask import current_app, has_app_context
+
+from flask_multipass.util import FileLock
+
+if sys.version_info >= (3, 10):
+    _popcount = int.bit_count
+else:
+    def _popcount(value):
+        return bin(value).count('1')
+
+
+class IdentifierTable:
+    """Maps identity identifiers to dense integer IDs.
+
+    IDs are assigned in the order identifiers are first seen, starting at
+    0, and never change.  If `path` is set, the table is stored in an
+    SQLite database, so all processes using the same file share the IDs
+    and they are kept across restarts; otherwise they are only stable
+    within the current process.
+
+    :param path: The path of the database file.
+    :param timeout: The time in seconds to wait for a locked database.
+    """
+
+    def __init__(self, path=None, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._identifiers = {}
+        if self.path:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('CREATE TABLE IF NOT EXISTS identity_ids '
+                                 '(id INTEGER PRIMARY KEY, identifier TEXT NOT NULL UNIQUE)')
+            finally:
+                conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def _remember(self, rows):
+        for id_, identifier in rows:
+            self._ids[identifier] = id_
+            self._identifiers[id_] = identifier
+
+    def _assign(self, identifiers):
+        if not self.path:
+            self._remember(enumerate(identifiers, len(self._ids)))
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO identity_ids (identifier) VALUES (?)',
+                                 [(identifier,) for identifier in identifiers])
+            for i in range(0, len(identifiers), 500):
+                chunk = identifiers[i:i + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                sql = f'SELECT id - 1, identifier FROM identity_ids WHERE identifier IN ({placeholders})'  # noqa: S608
+                self._remember(conn.execute(sql, chunk))
+        finally:
+            conn.close()
+
+    def get_ids(self, identifiers):
+        """Returns the IDs of identifiers, assigning new ones if needed.
+
+        :param identifiers: An iterable of identifiers.
+        :return: A list containing the ID of each identifier.
+        """
+        identifiers = list(identifiers)
+        if missing := [identifier for identifier in identifiers if identifier not in self._ids]:
+            with self._lock:
+                missing = [identifier for identifier in dict.fromkeys(missing) if identifier not in self._ids]
+                if missing:
+                    self._assign(missing)
+        return [self._ids[identifier] for identifier in identifiers]
+
+    def get_id(self, identifier):
+        """Returns the ID of an identifier, assigning a new one if needed."""
+        return self.get_ids([identifier])[0]
+
+    def get_identifiers(self, ids):
+        """Returns the identifiers with the given IDs.
+
+        :param ids: An iterable of IDs, e.g. a :class:`MemberBitmap`.
+        :return: A list containing the identifier of each ID.
+        :raise KeyError: if an ID has not been assigned.
+        """
+        ids = list(ids)
+        if self.path and (missing := [id_ for id_ in ids if id_ not in self._identifiers]):
+            conn = self._connect()
+            try:
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    placeholders = ', '.join('?' * len(chunk))
+                    sql = f'SELECT id - 1, identifier FROM identity_ids WHERE id - 1 IN ({placeholders})'  # noqa: S608
+                    with self._lock:
+                        self._remember(conn.execute(sql, chunk))
+            finally:
+                conn.close()
+        return [self._identifiers[id_] for id_ in ids]
+
+
+class MemberBitmap:
+    """A set of dense identity IDs stored as a bitmap.
+
+    The bitmap is backed by a Python integer, so set operations work on
+    whole machine words and intersecting or merging groups with many
+    thousands of members only takes microseconds.  It can be exported
+    using :meth:`to_bytes` (one bit per ID, little-endian).
+
+    :param ids: An iterable of IDs assigned by an :class:`IdentifierTable`.
+    """
+
+    __slots__ = ('_bits',)
+
+    def __init__(self, ids=()):
+        ids = list(ids)
+        buf = bytearray((max(ids) >> 3) + 1 if ids else 0)
+        for id_ in ids:
+            buf[id_ >> 3] |= 1 << (id_ & 7)
+        self._bits = int.from_bytes(buf, 'little')
+
+    @classmethod
+    def _from_int(cls, bits):
+        bitmap = cls()
+        bitmap._bits = bits
+        return bitmap
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Creates a bitmap from the output of :meth:`to_bytes`."""
+        return cls._from_int(int.from_bytes(data, 'little'))
+
+    def to_bytes(self):
+        """Returns the bitmap as bytes."""
+        return self._bits.to_bytes((self._bits.bit_length() + 7) >> 3, 'little')
+
+    def __contains__(self, id_):
+        return id_ >= 0 and bool(self._bits >> id_ & 1)
+
+    def __iter__(self):
+        for offset, byte in enumerate(self.to_bytes()):
+            while byte:
+                low = byte & -byte
+                yield (offset << 3) + low.bit_length() - 1
+                byte ^= low
+
+    def __len__(self):
+        return _popcount(self._bits)
+
+    def __bool__(self):
+        return bool(self._bits)
+
+    def __eq__(self, other):
+        if not isinstance(other, MemberBitmap):
+            return NotImplemented
+        return self._bits == other._bits
+
+    def __hash__(self):
+        return hash(self._bits)
+
+    def __and__(self, other):
+        return self._from_int(self._bits & other._bits)
+
+    def __or__(self, other):
+        return self._from_int(self._bits | other._bits)
+
+    def __sub__(self, other):
+        return self._from_int(self._bits & ~other._bits)
+
+    def __xor__(self, other):
+        return self._from_int(self._bits ^ other._bits)
+
+    def __repr__(self):
+        return f'<MemberBitmap({len(self)})>'
+
+
+class MembershipSnapshot:
+    """A local index of the members of selected groups of an identity provider.
+
+    The members of the groups are retrieved using :meth:`.Group.get_members`
+    and stored in an SQLite database, so membership checks do not need to
+    query the provider at all.  The database file is shared by all
+    processes using the same ``index_file`` and rebuilt in a background
+    thread once it is older than ``refresh_interval`` seconds.  Only one
+    process rebuilds it at a time (using a lock file next to the index);
+    the others keep using the current index in the meantime.  If it is
+    older than ``max_age`` seconds (e.g. because refreshing failed) it is
+    not used anymore until it has been rebuilt.
+
+    Only groups listed in ``groups`` are stored in the snapshot; any other
+    group is still checked using the provider.  The snapshot also keeps the
+    name and DN (if any) of each group, so the groups returned by
+    :meth:`get_identity_groups` are created without looking them up.
+
+    :param provider: The identity provider containing the groups
+    :param settings: The ``membership_snapshot`` settings of the provider
+    """
+
+    def __init__(self, provider, settings):
+        self.provider = provider
+        self.groups = set(settings.get('groups', ()))
+        if not self.groups:
+            raise ValueError('`membership_snapshot` requires a list of `groups`')
+        self.refresh_interval = settings.get('refresh_interval', 300)
+        self.max_age = settings.get('max_age', 3 * self.refresh_interval)
+        self.index_file = settings.get('index_file') or os.path.join(tempfile.gettempdir(),
+                                                                     f'flask-multipass-members-{provider.name}.sqlite')
+        self.app = current_app._get_current_object() if has_app_context() else None
+        self.last_sync = None
+        self.last_sync_duration = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._refresh_lock = FileLock(f'{self.index_file}.lock')
+
+    @property
+    def age(self):
+        """The time in seconds since the index was built, or ``None``."""
+        try:
+            return time.time() - os.path.getmtime(self.index_file)
+        except OSError:
+            return None
+
+    @property
+    def metrics(self):
+        """A dict describing the state of the snapshot."""
+        return {
+            'age': self.age,
+            'last_sync': self.last_sync,
+            'last_sync_duration': self.last_sync_duration,
+            'last_error': str(self.last_error) if self.last_error is not None else None,
+            'refreshing': self._refreshing,
+        }
+
+    def _build_group(self, conn, group_name):
+        group = self.provider.get_group(group_name)
+        if group is None:
+            return
+        # keep what is needed to create the group object again without looking it up
+        conn.execute('INSERT INTO groups VALUES (?, ?, ?)', (group_name, group.name, getattr(group, 'dn', None)))
+        rows = ((group_name, identifier) for identifier in {identity.identifier for identity in group.get_members()})
+        while batch := [row for _, row in zip(range(1000), rows)]:
+            conn.executemany('INSERT OR IGNORE INTO members VALUES (?, ?)', batch)
+
+    def _build(self, path):
+        conn = sqlite3.connect(path)
+        try:
+            with conn:
+                conn.execute('DROP TABLE IF EXISTS groups')
+                conn.execute('CREATE TABLE groups (group_name TEXT PRIMARY KEY, name TEXT, dn TEXT)')
+                conn.execute('DROP TABLE IF EXISTS members')
+                conn.execute('CREATE TABLE members (group_name TEXT, identifier TEXT, '
+                             'PRIMARY KEY (group_name, identifier)) WITHOUT ROWID')
+                for group_name in self.groups:
+                    self._build_group(conn, group_name)
+                conn.execute('CREATE INDEX ix_members_identifier ON members (identifier)')
+        finally:
+            conn.close()
+
+    def refresh(self):
+        """Retrieve the members of all groups and rebuild the index."""
+        start = time.monotonic()
+        tmp_index = f'{self.index_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            self._build(tmp_index)
+            os.replace(tmp_index, self.index_file)
+        except Exception as exc:
+            self.last_error = exc
+            raise
+        finally:
+            try:
+                os.remove(tmp_index)
+            except FileNotFoundError:
+                pass
+        self.last_sync = time.time()
+        self.last_sync_duration = time.monotonic() - start
+        self.last_error = None
+
+    def _refresh_locked(self):
+        """Refresh the index unless another process is doing so or just did."""
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            age = self.age
+            if age is None or age >= self.refresh_interval:
+                self.refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                if self.app is not None:
+                    with self.app.app_context():
+                        self._refresh_locked()
+                else:
+                    self._refresh_locked()
+            except Exception:
+                logging.getLogger('multipass.membership').exception('Refreshing membership snapshot failed')
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_run, name=f'multipass-membership-{self.provider.name}', daemon=True).start()
+
+    def _query(self, sql, params=()):
+        """Queries the index, or returns ``None`` if it is not available."""
+        age = self.age
+        if age is None or age >= self.refresh_interval:
+            self._refresh_in_background()
+        if age is None or age > self.max_age:
+            return None
+        conn = sqlite3.connect(f'file:{self.index_file}?mode=ro', uri=True)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def has_members(self, group_name, identifiers):
+        """Checks which of the given identities are members of a group.
+
+        :return: A set containing the identifiers of the members, or
+                 ``None`` if the group is not in the snapshot.
+        """
+        if group_name not in self.groups:
+            return None
+        identifiers = list(set(identifiers))
+        members = set()
+        # stay below SQLite's limit for the number of query parameters
+        for i in range(0, max(len(identifiers), 1), 500):
+            chunk = identifiers[i:i + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            sql = f'SELECT identifier FROM members WHERE group_name = ? AND identifier IN ({placeholders})'  # noqa: S608
+            rows = self._query(sql, (group_name, *chunk))
+            if rows is None:
+                return None
+            members.update(row[0] for row in rows)
+        return members
+
+    def get_members(self, group_name):
+        """Returns the identifiers of the members of a group.
+
+        :return: A set of identifiers, or ``None`` if the group is not in
+                 the snapshot.
+        """
+        if group_name not in self.groups:
+            return None
+        rows = self._query('SELECT identifier FROM members WHERE group_name = ?', (group_name,))
+        return {row[0] for row in rows} if rows is not None else None
+
+    def count_members(self, group_name):
+        """Returns the number of members of a group.
+
+        :return: The number of members, or ``None`` if the group is not
+                 in the snapshot.
+        """
+        if group_name not in self.groups:
+            return None
+        rows = self._query('SELECT COUNT(*) FROM members WHERE group_name = ?', (group_name,))
+        return rows[0][0] if rows is not None else None
+
+    def get_identity_groups(self, identifier):
+        """Returns the groups in the snapshot an identity is a member of.
+
+        :return: A set of :class:`.Group` instances, or ``None`` if the
+                 snapshot is not available.
+        """
+        rows = self._query('SELECT groups.name, groups.dn FROM members '
+                           'JOIN groups ON groups.group_name = members.group_name '
+                           'WHERE members.identifier = ?', (identifier,))
+        if rows is None:
+            return None
+        return {self._make_group(name, dn) for name, dn in rows}
+
+    def _make_group(self, name, dn):
+        args = (dn,) if dn is not None else ()
+        return self.provider.group_class(self.provider, name, *args)
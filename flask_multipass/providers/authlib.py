@@ -4,19 +4,40 @@
 # Flask-Multipass is free software; you can redistribute it
 # and/or modify it under the terms of the MIT License.
 
+import base64
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
 from urllib.parse import urlencode, urljoin
 
 from authlib.common.errors import AuthlibBaseError
-from authlib.integrations.flask_client import FlaskIntegration, OAuth
-from flask import current_app, redirect, request, session, url_for
+from authlib.integrations.flask_client import FlaskIntegration, FlaskOAuth2App, OAuth
+from flask import redirect, request, url_for
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError, RequestException, Timeout
 
 from flask_multipass.auth import AuthProvider
 from flask_multipass.data import AuthInfo, IdentityInfo
-from flask_multipass.exceptions import AuthenticationFailed, IdentityRetrievalFailed, MultipassException
+from flask_multipass.exceptions import (
+    AuthenticationFailed,
+    IdentityRetrievalFailed,
+    ProviderUnavailable,
+)
 from flask_multipass.identity import IdentityProvider
-from flask_multipass.util import login_view
+from flask_multipass.session import multipass_session
+from flask_multipass.util import TTLCache, login_view
+
+try:
+    from joserfc import jwt as _joserfc_jwt
+    from joserfc.errors import JoseError
+    from joserfc.jwk import KeySet
+except ImportError:
+    # older authlib versions do not use joserfc yet
+    from authlib.jose import JsonWebKey, JsonWebToken
+    _joserfc_jwt = None
 
 # jwt/oidc-specific fields that are not relevant to applications
 INTERNAL_FIELDS = ('nonce', 'session_state', 'acr', 'jti', 'exp', 'azp', 'iss', 'iat', 'auth_time', 'typ', 'nbf', 'aud')
@@ -24,6 +45,37 @@ INTERNAL_FIELDS = ('nonce', 'session_state', 'acr', 'jti', 'exp', 'azp', 'iss',
 _notset = object()
 
 
+def _get_jwt_kid(token):
+    try:
+        header = token.split('.', 1)[0]
+        header = json.loads(base64.urlsafe_b64decode(header + '=' * (-len(header) % 4)))
+    except ValueError:
+        return None
+    return header.get('kid') if isinstance(header, dict) else None
+
+
+def _decode_jwt(token, jwks, algorithms, claims_options, leeway):
+    """Decode a JWT and validate its signature and claims.
+
+    :raise ValueError: If the token is not valid
+    :return: A dict containing the claims
+    """
+    if _joserfc_jwt is not None:
+        try:
+            decoded = _joserfc_jwt.decode(token, KeySet.import_key_set(jwks), algorithms=algorithms)
+            _joserfc_jwt.JWTClaimsRegistry(leeway=leeway, **claims_options).validate(decoded.claims)
+        except JoseError as exc:
+            raise ValueError(str(exc)) from exc
+        return dict(decoded.claims)
+    try:
+        claims = JsonWebToken(algorithms).decode(token, JsonWebKey.import_key_set(jwks),
+                                                 claims_options=claims_options)
+        claims.validate(leeway=leeway)
+    except AuthlibBaseError as exc:
+        raise ValueError(str(exc)) from exc
+    return dict(claims)
+
+
 class _MultipassFlaskIntegration(FlaskIntegration):
     @staticmethod
     def load_config(oauth, name, params):
@@ -31,8 +83,213 @@ class _MultipassFlaskIntegration(FlaskIntegration):
         return {}
 
 
+class _ServerMetadataCache:
+    """Caches the OIDC discovery document and JWKS of an authlib client.
+
+    Stale data keeps being served while it is refreshed in a background
+    thread, and JWKS refreshes caused by unknown key ids are rate-limited.
+    If a snapshot file is set, the cached data is also written to disk so
+    new worker processes do not need to fetch it again.
+
+    :param client: The authlib client
+    :param ttl: The time in seconds after which the data is refreshed, or
+                ``None`` to never refresh it
+    :param jwks_refresh_interval: The minimum time in seconds between two
+                                  forced JWKS refreshes
+    :param snapshot_file: The path of the on-disk snapshot, or ``None``
+    :param timeout: The timeout in seconds for fetching the data
+    """
+
+    def __init__(self, client, ttl=None, jwks_refresh_interval=60, snapshot_file=None, timeout=None):
+        self.client = client
+        self.ttl = ttl
+        self.jwks_refresh_interval = jwks_refresh_interval
+        self.snapshot_file = snapshot_file
+        self.timeout = timeout
+        self.loaded_at = None
+        self._jwks_fetched_at = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    @property
+    def _metadata_url(self):
+        return self.client._server_metadata_url
+
+    @property
+    def is_stale(self):
+        return self.ttl is not None and self.loaded_at is not None and time.time() - self.loaded_at >= self.ttl
+
+    def _fetch_json(self, url):
+        with self.client._get_pooled_session() as session:
+            resp = session.request('GET', url, withhold_token=True, timeout=self.timeout)
+            resp.raise_for_status()
+            return resp.json()
+
+    def _update(self, metadata, loaded_at, write_snapshot=True):
+        metadata['_loaded_at'] = loaded_at
+        # replace the dict instead of updating it so readers never see partial data
+        self.client.server_metadata = metadata
+        self.loaded_at = loaded_at
+        if write_snapshot and self.snapshot_file:
+            self._write_snapshot()
+
+    def _refresh(self):
+        metadata = self._fetch_json(self._metadata_url)
+        if 'jwks' in self.client.server_metadata and metadata.get('jwks_uri'):
+            metadata['jwks'] = self._fetch_json(metadata['jwks_uri'])
+            self._jwks_fetched_at = time.monotonic()
+        self._update(metadata, time.time())
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                self._refresh()
+            except Exception:
+                logging.getLogger('multipass.authlib').exception('Refreshing OIDC metadata failed')
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_run, name=f'multipass-authlib-metadata-{self.client.name}', daemon=True).start()
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_file) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            logging.getLogger('multipass.authlib').warning('Could not read OIDC metadata snapshot %s',
+                                                           self.snapshot_file)
+            return False
+        if snapshot.get('url') != self._metadata_url:
+            return False
+        self._update(snapshot['metadata'], snapshot['loaded_at'], write_snapshot=False)
+        if 'jwks' in snapshot['metadata']:
+            self._jwks_fetched_at = time.monotonic()
+        return True
+
+    def _write_snapshot(self):
+        metadata = dict(self.client.server_metadata)
+        loaded_at = metadata.pop('_loaded_at')
+        data = {'url': self._metadata_url, 'loaded_at': loaded_at, 'metadata': metadata}
+        tmp_file = f'{self.snapshot_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_file, self.snapshot_file)
+        except OSError:
+            logging.getLogger('multipass.authlib').warning('Could not write OIDC metadata snapshot %s',
+                                                           self.snapshot_file)
+
+    def get_metadata(self):
+        """Get the server metadata, fetching it if needed."""
+        if not self._metadata_url:
+            return self.client.server_metadata
+        if self.loaded_at is None:
+            with self._lock:
+                if self.loaded_at is None and not (self.snapshot_file and self._load_snapshot()):
+                    self._refresh()
+        if self.is_stale:
+            self._refresh_in_background()
+        return self.client.server_metadata
+
+    def get_jwks(self, force=False):
+        """Get the JWKS, fetching it if needed.
+
+        :param force: Whether to fetch the JWKS even if it is cached,
+                      e.g. because a token uses an unknown key id. This
+                      is ignored if the JWKS has been fetched recently.
+        """
+        metadata = self.get_metadata()
+        jwks = metadata.get('jwks')
+        if jwks and (not force or not self._may_refresh_jwks()):
+            return jwks
+        with self._lock:
+            metadata = self.client.server_metadata
+            if metadata.get('jwks') is not jwks and metadata.get('jwks'):
+                # another thread refreshed it in the meantime
+                return metadata['jwks']
+            uri = metadata.get('jwks_uri')
+            if not uri:
+                raise RuntimeError('Missing "jwks_uri" in metadata')
+            jwks = self._fetch_json(uri)
+            self._jwks_fetched_at = time.monotonic()
+            self.client.server_metadata = dict(metadata, jwks=jwks)
+            if self._metadata_url and self.snapshot_file:
+                self._write_snapshot()
+        return jwks
+
+    def _may_refresh_jwks(self):
+        if self._jwks_fetched_at is None:
+            return True
+        return time.monotonic() - self._jwks_fetched_at >= self.jwks_refresh_interval
+
+
+class _PooledHTTPAdapter(HTTPAdapter):
+    """An HTTP adapter whose connection pool outlives the sessions using it.
+
+    Authlib creates a new session for every request and closes it
+    afterwards, so sharing this adapter between those sessions is what
+    allows connections to be kept alive and reused.
+    """
+
+    def close(self):
+        # the pool is shared, so closing a session must not close its connections
+        pass
+
+    @property
+    def stats(self):
+        """Statistics about the connections and requests of the pool."""
+        # the pool container does not support iterating over it directly
+        container = self.poolmanager.pools
+        pool_keys = container.keys()
+        pools = [pool for pool in map(container.get, pool_keys) if pool is not None]
+        num_requests = sum(pool.num_requests for pool in pools)
+        num_connections = sum(pool.num_connections for pool in pools)
+        reuse_rate = (1 - num_connections / num_requests) if num_requests else None
+        return {'requests': num_requests, 'connections': num_connections, 'reuse_rate': reuse_rate}
+
+
+class _MultipassOAuth2App(FlaskOAuth2App):
+    #: The :class:`_ServerMetadataCache` used by the client
+    metadata_cache = None
+    #: The :class:`_PooledHTTPAdapter` shared by all sessions of the client
+    http_adapter = None
+
+    def _mount_http_adapter(self, session):
+        if self.http_adapter is not None:
+            session.mount('https://', self.http_adapter)
+            session.mount('http://', self.http_adapter)
+        return session
+
+    def _get_pooled_session(self):
+        return self._mount_http_adapter(self.client_cls(**self.client_kwargs))
+
+    def _get_session(self):
+        return self._mount_http_adapter(super()._get_session())
+
+    def _get_oauth_client(self, **metadata):
+        return self._mount_http_adapter(super()._get_oauth_client(**metadata))
+
+    def load_server_metadata(self):
+        if self.metadata_cache is None:
+            return super().load_server_metadata()
+        return self.metadata_cache.get_metadata()
+
+    def fetch_jwk_set(self, force=False):
+        if self.metadata_cache is None:
+            return super().fetch_jwk_set(force=force)
+        return self.metadata_cache.get_jwks(force=force)
+
+
 class _MultipassOAuth(OAuth):
     framework_integration_cls = _MultipassFlaskIntegration
+    oauth2_client_cls = _MultipassOAuth2App
 
     def init_app(self, app, cache=None, fetch_token=None, update_token=None):
         # we do not use any of the flask extension functionality nor the registry
@@ -80,25 +337,86 @@ class AuthlibAuthProvider(AuthProvider):
     - ``request_timeout``: the timeout in seconds for fetching the oauth token and
                            requesting data from the userinfo endpoint (10 by default,
                            set to None to disable)
+    - ``connect_timeout``: the timeout in seconds for establishing a connection to the
+                           oauth server; if set, ``request_timeout`` only applies to
+                           reading the response
+    - ``http_keep_alive``: whether to keep connections to the oauth server open and
+                           reuse them for later requests (``True`` by default)
+    - ``http_pool_size``:  the maximum number of connections per host that are kept
+                           open when ``http_keep_alive`` is enabled (10 by default)
+    - ``metadata_cache_ttl``: the time in seconds after which the cached OIDC
+                              metadata and JWKS are refreshed in the background;
+                              stale data is used until the refresh succeeded
+                              (``None`` by default, i.e. they are never refreshed)
+    - ``jwks_refresh_interval``: the minimum time in seconds between two JWKS
+                                 refreshes caused by a token signed with an
+                                 unknown key (60 by default)
+    - ``metadata_cache_file``: the path of a file where the OIDC metadata and
+                               JWKS are stored, so new worker processes can load
+                               them from there instead of the OIDC server
+    - ``bearer_token_audience``: the audience (or list of audiences) accepted in
+                                 JWT bearer tokens passed to
+                                 :meth:`.Multipass.authenticate_bearer_token`
+                                 (defaults to the client id)
+    - ``bearer_token_issuer``: the issuer (``iss``) required in bearer tokens; defaults
+                               to the ``issuer`` from the OIDC metadata. it must be set
+                               if the signing keys are configured (``jwks_uri`` or
+                               ``jwks``) without using ``server_metadata_url``
+    - ``bearer_token_algorithms``: the signing algorithms accepted for bearer tokens
+                                   (defaults to ``RS256`` and ``ES256``)
+    - ``bearer_token_cache_ttl``: the time in seconds for which verified bearer tokens
+                                  are cached (60 by default, never longer than the
+                                  token is valid; set to 0 to disable)
     """
 
+    #: If the provider can verify bearer tokens sent along with API
+    #: requests
+    supports_bearer_token = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        callback_uri = self.settings.get('callback_uri', f'/multipass/authlib/{self.name}')
         self.authlib_client = _authlib_oauth.register(self.name, **self.authlib_settings)
         self.include_token = self.settings.get('include_token', False)
         self.request_timeout = self.settings.get('request_timeout')
+        if (connect_timeout := self.settings.get('connect_timeout')) is not None:
+            self.request_timeout = (connect_timeout, self.request_timeout)
+        if isinstance(self.authlib_client, _MultipassOAuth2App):
+            if self.settings.get('http_keep_alive', True):
+                pool_size = self.settings.get('http_pool_size', 10)
+                self.authlib_client.http_adapter = _PooledHTTPAdapter(pool_maxsize=pool_size)
+            self.authlib_client.metadata_cache = _ServerMetadataCache(
+                self.authlib_client,
+                ttl=self.settings.get('metadata_cache_ttl'),
+                jwks_refresh_interval=self.settings.get('jwks_refresh_interval', 60),
+                snapshot_file=self.settings.get('metadata_cache_file'),
+                timeout=self.request_timeout,
+            )
         self.use_id_token = self.settings.get('use_id_token')
         self.logout_uri = self.settings.get('logout_uri', self.authlib_settings.get('logout_uri', _notset))
         self.logout_args = self.settings.get('logout_args', {'client_id', 'id_token_hint', 'post_logout_redirect_uri'})
+        self.bearer_token_audience = self.settings.get('bearer_token_audience', self.authlib_settings.get('client_id'))
+        self.bearer_token_algorithms = self.settings.get('bearer_token_algorithms', ['RS256', 'ES256'])
+        self.bearer_token_issuer = self.settings.get('bearer_token_issuer', self.authlib_settings.get('issuer'))
+        # bearer tokens can only be verified if we know where to get the signing keys
+        self.supports_bearer_token = any(key in self.authlib_settings
+                                         for key in ('server_metadata_url', 'jwks_uri', 'jwks'))
+        if (self.supports_bearer_token and not self.bearer_token_issuer and
+                'server_metadata_url' not in self.authlib_settings):
+            # without an issuer any token signed with one of the keys would be accepted
+            raise ValueError('Bearer tokens cannot be verified without an issuer; set "bearer_token_issuer" '
+                             'or use "server_metadata_url"')
+        self._bearer_token_cache = TTLCache(self.settings.get('bearer_token_cache_ttl', 60))
         if self.use_id_token is None:
             # default to using the id token when using the openid scope (oidc)
             client_kwargs = self.authlib_settings.get('client_kwargs', {})
             scopes = client_kwargs.get('scope', '').split()
             self.use_id_token = 'openid' in scopes
         self.authorized_endpoint = '_flaskmultipass_authlib_' + self.name
-        current_app.add_url_rule(callback_uri, self.authorized_endpoint, self._authorize_callback,
-                                 methods=('GET', 'POST'))
+
+    @classmethod
+    def get_url_rules(cls, name, settings):
+        callback_uri = settings.get('callback_uri', f'/multipass/authlib/{name}')
+        return [(callback_uri, '_flaskmultipass_authlib_' + name, '_authorize_callback', ('GET', 'POST'))]
 
     @property
     def authlib_settings(self):
@@ -108,6 +426,17 @@ class AuthlibAuthProvider(AuthProvider):
     def _id_token_key(self):
         return f'_multipass_authlib_id_token:{self.name}'
 
+    @property
+    def http_pool_stats(self):
+        """Statistics about the connections to the oauth server.
+
+        This is a dict containing the number of ``requests`` sent, the
+        number of ``connections`` opened for them and the resulting
+        connection ``reuse_rate``, or ``None`` if keep-alive is disabled.
+        """
+        adapter = getattr(self.authlib_client, 'http_adapter', None)
+        return adapter.stats if adapter is not None else None
+
     def _get_redirect_uri(self):
         return url_for(self.authorized_endpoint, _external=True)
 
@@ -134,11 +463,48 @@ class AuthlibAuthProvider(AuthProvider):
             query_args['client_id'] = client_id
         if 'post_logout_redirect_uri' in self.logout_args:
             query_args['post_logout_redirect_uri'] = return_url
-        if (id_token := session.pop(self._id_token_key, None)) and 'id_token_hint' in self.logout_args:
+        if (id_token := multipass_session.pop(self._id_token_key, None)) and 'id_token_hint' in self.logout_args:
             query_args['id_token_hint'] = id_token
         query = urlencode(query_args)
         return redirect((logout_uri + '?' + query) if query else logout_uri)
 
+    def verify_bearer_token(self, token):
+        cache_key = hashlib.sha256(token.encode()).hexdigest()
+        claims = self._bearer_token_cache.get(cache_key)
+        if claims is None:
+            claims = self._verify_jwt(token)
+            self._bearer_token_cache.set(cache_key, claims, ttl=min(self._bearer_token_cache.ttl,
+                                                                    claims['exp'] - time.time()))
+        data = {k: v for k, v in claims.items() if k not in INTERNAL_FIELDS}
+        if not data:
+            raise AuthenticationFailed('Bearer token contains no user data', provider=self)
+        return AuthInfo(self, **data)
+
+    def _verify_jwt(self, token):
+        try:
+            metadata = self.authlib_client.load_server_metadata()
+            jwks = self.authlib_client.fetch_jwk_set()
+            kid = _get_jwt_kid(token)
+            if kid is not None and not any(key.get('kid') == kid for key in jwks.get('keys', [])):
+                # the keys may have been rotated
+                jwks = self.authlib_client.fetch_jwk_set(force=True)
+        except RequestException as exc:
+            logging.getLogger('multipass.authlib').exception('Getting JWKS failed')
+            raise ProviderUnavailable('Verifying bearer tokens is currently not possible', provider=self) from exc
+        issuer = self.bearer_token_issuer or metadata.get('issuer')
+        if not issuer:
+            raise RuntimeError('Missing "issuer" in metadata')
+        audience = self.bearer_token_audience
+        claims_options = {
+            'exp': {'essential': True},
+            'iss': {'essential': True, 'value': issuer},
+            'aud': {'essential': True, 'values': [audience] if isinstance(audience, str) else list(audience)},
+        }
+        try:
+            return _decode_jwt(token, jwks, self.bearer_token_algorithms, claims_options, leeway=30)
+        except ValueError as exc:
+            raise AuthenticationFailed('Invalid bearer token', details=str(exc), provider=self) from exc
+
     @login_view
     def _authorize_callback(self):
         # if authorization failed abort early
@@ -150,7 +516,7 @@ class AuthlibAuthProvider(AuthProvider):
                 token_data = self.authlib_client.authorize_access_token(timeout=self.request_timeout)
             except Timeout as exc:
                 logging.getLogger('multipass.authlib').error('Getting token timed out')
-                raise MultipassException('Token request timed out, please try again later') from exc
+                raise ProviderUnavailable('Token request timed out, please try again later', provider=self) from exc
             except HTTPError as exc:
                 try:
                     data = exc.response.json()
@@ -162,7 +528,7 @@ class AuthlibAuthProvider(AuthProvider):
                 raise
             authinfo_token_data = {}
             if (id_token := token_data.get('id_token')) and 'id_token_hint' in self.logout_args:
-                session[self._id_token_key] = id_token
+                multipass_session[self._id_token_key] = id_token
             if self.include_token == 'only':  # noqa: S105
                 return self.multipass.handle_auth_success(AuthInfo(self, token=token_data))
             elif self.include_token:
@@ -179,7 +545,7 @@ class AuthlibAuthProvider(AuthProvider):
                     id_token.pop(key, None)
                 return self.multipass.handle_auth_success(AuthInfo(self, **dict(authinfo_token_data, **id_token)))
             else:
-                user_info = self.authlib_client.userinfo(token=token_data)
+                user_info = self.authlib_client.userinfo(token=token_data, timeout=self.request_timeout)
                 return self.multipass.handle_auth_success(AuthInfo(self, **dict(authinfo_token_data, **user_info)))
         except AuthlibBaseError as exc:
             raise AuthenticationFailed(str(exc), provider=self)
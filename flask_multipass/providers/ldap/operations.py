@@ -4,15 +4,26 @@
 # Flask-Multipass is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
+import threading
+from queue import Full, Queue
+
 from ldap import NO_SUCH_OBJECT, SCOPE_BASE, SCOPE_SUBTREE
 from ldap.controls import SimplePagedResultsControl
 
 from flask_multipass.exceptions import GroupRetrievalFailed, IdentityRetrievalFailed
 from flask_multipass.providers.ldap.globals import current_ldap
-from flask_multipass.providers.ldap.util import build_search_filter, find_one, get_page_cookie
+from flask_multipass.providers.ldap.util import (
+    build_search_filter,
+    find_one,
+    get_page_cookie,
+    ldap_context,
+    to_unicode,
+)
+
+_shard_done = object()
 
 
-def build_user_search_filter(criteria, mapping=None, exact=False):  # pragma: no cover
+def build_user_search_filter(criteria, mapping=None, exact=False, match=None):  # pragma: no cover
     """Builds the LDAP search filter for retrieving users.
 
     :param criteria: dict -- Criteria to be `AND`ed together to build
@@ -20,13 +31,14 @@ def build_user_search_filter(criteria, mapping=None, exact=False):  # pragma: no
     :param mapping: dict -- Mapping from criteria to LDAP attributes
     :param exact: bool -- Match attributes values exactly if ``True``,
                   othewise perform substring matching.
+    :param match: str -- ``'contains'``, ``'exact'`` or ``'prefix'``.
     :return: str -- Valid LDAP search filter.
     """
     type_filter = current_ldap.settings['user_filter']
-    return build_search_filter(criteria, type_filter, mapping, exact)
+    return build_search_filter(criteria, type_filter, mapping, exact, match)
 
 
-def build_group_search_filter(criteria, mapping=None, exact=False):  # pragma: no cover
+def build_group_search_filter(criteria, mapping=None, exact=False, match=None):  # pragma: no cover
     """Builds the LDAP search filter for retrieving groups.
 
     :param criteria: dict -- Criteria to be `AND`ed together to build
@@ -34,10 +46,11 @@ def build_group_search_filter(criteria, mapping=None, exact=False):  # pragma: n
     :param mapping: dict -- Mapping from criteria to LDAP attributes
     :param exact: bool -- Match attributes values exactly if ``True``,
                   othewise perform substring matching.
+    :param match: str -- ``'contains'``, ``'exact'`` or ``'prefix'``.
     :return: str -- Valid LDAP search filter.
     """
     type_filter = current_ldap.settings['group_filter']
-    return build_search_filter(criteria, type_filter, mapping, exact)
+    return build_search_filter(criteria, type_filter, mapping, exact, match)
 
 
 def get_user_by_id(uid, attributes=None):
@@ -53,7 +66,14 @@ def get_user_by_id(uid, attributes=None):
     if not uid:
         raise IdentityRetrievalFailed('No identifier specified')
     user_filter = build_user_search_filter({current_ldap.settings['uid']: {uid}}, exact=True)
-    return find_one(current_ldap.settings['user_base'], user_filter, attributes=attributes)
+    user_base = current_ldap.settings['user_base']
+    if isinstance(user_base, str):
+        return find_one(user_base, user_filter, attributes=attributes)
+    for base_dn in user_base:
+        user_dn, user_data = find_one(base_dn, user_filter, attributes=attributes)
+        if user_dn:
+            return user_dn, user_data
+    return None, None
 
 
 def get_group_by_id(gid, attributes=None):
@@ -106,6 +126,151 @@ def search(base_dn, search_filter, attributes):
             break
 
 
+def search_subtrees(base_dns, search_filter, attributes):
+    """Searches several subtrees concurrently.
+
+    Each subtree is searched in a separate thread using its own LDAP
+    connection and paging state, and the results are yielded in the
+    order they arrive.  The connections are taken from the idle
+    connections of the provider's :class:`.LDAPServerPool` and returned
+    there afterwards, so they are reused by later searches.
+
+    :param base_dns: list -- The base DNs of the subtrees to search.
+                     May also be a single base DN.
+    :param search_filter: str -- Representation of the filter to apply
+                          in the search.
+    :param attributes: list -- Attributes to be retrieved for each
+                       entry. If ``None``, all attributes will be
+                       retrieved.
+    :returns: A generator which yields one search result at a time as a
+              tuple containing a `dn` as ``str`` and `attributes` as
+              ``dict``.
+    """
+    if isinstance(base_dns, str):
+        base_dns = [base_dns]
+    if len(base_dns) == 1:
+        yield from search(base_dns[0], search_filter, attributes)
+        return
+
+    settings = current_ldap.settings
+    results = Queue(maxsize=settings['page_size'])
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def _search_subtree(base_dn):
+        with ldap_context(settings, use_cache=False, pooled=True):
+            for entry in search(base_dn, search_filter, attributes):
+                if not _put(entry):
+                    break
+
+    def _run(base_dn):
+        try:
+            _search_subtree(base_dn)
+        except Exception as exc:
+            _put(exc)
+        finally:
+            _put(_shard_done)
+
+    for base_dn in base_dns:
+        threading.Thread(target=_run, args=(base_dn,), name=f'multipass-ldap-search-{base_dn}',
+                         daemon=True).start()
+    try:
+        remaining = len(base_dns)
+        while remaining:
+            item = results.get()
+            if item is _shard_done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # stop the other searches if we failed or the caller is not interested in more results
+        stop.set()
+
+
+def get_group_member_dns(group_dn, member_attr):
+    """Retrieves the DNs of the direct members of a group.
+
+    The DNs are read from the member attribute of the group (e.g.
+    `member` or `uniqueMember`).  Active Directory only returns a
+    limited number of values (1500 by default) of large attributes at
+    once, so the remaining ones are retrieved using ranged retrieval
+    (`member;range=1500-*`).
+
+    :param group_dn: str -- DN of the group.
+    :param member_attr: str -- Name of the member attribute.
+    :returns: A generator which yields the member DNs in chunks as
+              ``list`` of ``str``.
+    """
+    connection, settings = current_ldap
+    attr = member_attr
+    while True:
+        try:
+            entry = connection.search_ext_s(group_dn, SCOPE_BASE, attrlist=[attr], timeout=settings['timeout'],
+                                            sizelimit=1)
+        except NO_SUCH_OBJECT:
+            return
+        group_data = next((data for dn, data in entry if dn), {})
+        values = []
+        range_end = None
+        for key, key_values in group_data.items():
+            attr_name, __, option = key.partition(';')
+            if attr_name.lower() != member_attr.lower():
+                continue
+            if option.lower().startswith('range='):
+                values = key_values
+                range_end = option.rpartition('-')[2]
+            elif range_end is None:
+                values = key_values
+        if values:
+            yield [to_unicode(value) for value in values]
+        if range_end is None or range_end == '*':
+            break
+        attr = f'{member_attr};range={int(range_end) + 1}-*'
+
+
+def read_entries(dns, search_filter, attributes):
+    """Reads many entries using base-scope searches.
+
+    The searches are sent in batches of `page_size` without waiting for
+    the results of the previous ones.
+
+    :param dns: list -- The DNs of the entries to read.
+    :param search_filter: str -- Representation of the filter the
+                          entries need to match.
+    :param attributes: list -- Attributes to be retrieved for each
+                       entry. If ``None``, all attributes will be
+                       retrieved.
+    :returns: A generator which yields the entries matching the filter
+              as tuple containing a `dn` as ``str`` and `attributes` as
+              ``dict``.
+    """
+    connection, settings = current_ldap
+    dns = list(dns)
+    batch_size = settings['page_size']
+    for i in range(0, len(dns), batch_size):
+        msg_ids = [connection.search_ext(dn, SCOPE_BASE, filterstr=search_filter, attrlist=attributes,
+                                         timeout=settings['timeout'])
+                   for dn in dns[i:i + batch_size]]
+        for msg_id in msg_ids:
+            try:
+                _, r_data, __, ___ = connection.result3(msg_id, timeout=settings['timeout'])
+            except NO_SUCH_OBJECT:
+                continue
+            for dn, entry in r_data:
+                if dn:
+                    yield dn, entry
+
+
 def get_token_groups_from_user_dn(user_dn):
     """Get the list of SIDs of nested groups the user is a member of.
 
@@ -4,6 +4,9 @@
 # Flask-Multipass is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
+import time
+from functools import partial
+from itertools import islice
 from warnings import warn
 
 from flask_wtf import FlaskForm
@@ -21,11 +24,14 @@ from flask_multipass.providers.ldap.operations import (
     build_group_search_filter,
     build_user_search_filter,
     get_group_by_id,
+    get_group_member_dns,
     get_token_groups_from_user_dn,
     get_user_by_id,
+    read_entries,
     search,
+    search_subtrees,
 )
-from flask_multipass.providers.ldap.util import ldap_context, to_unicode
+from flask_multipass.providers.ldap.util import get_server_pool, ldap_context, to_unicode
 from flask_multipass.util import convert_app_data
 
 try:
@@ -33,6 +39,12 @@ try:
 except ImportError:
     certifi = None
 
+#: OID of the matching rule for checking nested group memberships in Active Directory
+LDAP_MATCHING_RULE_IN_CHAIN = '1.2.840.113556.1.4.1941'
+
+#: Number of members retrieved using each strategy when choosing one for ``member_lookup = 'auto'``
+MEMBER_LOOKUP_PROBE_SIZE = 100
+
 
 class LoginForm(FlaskForm):
     username = StringField('Username', [DataRequired()])
@@ -44,6 +56,11 @@ class LDAPProviderMixin:
     def ldap_settings(self):
         return self.settings['ldap']
 
+    @property
+    def ldap_server_health(self):
+        """The health of the LDAP servers used by the provider."""
+        return get_server_pool(self.ldap_settings).health
+
     def set_defaults(self):
         self.ldap_settings.setdefault('timeout', 30)
         self.ldap_settings.setdefault('verify_cert', True)
@@ -115,19 +132,82 @@ class LDAPGroup(Group):
                 to_visit.update({group_dn for group_dn, group_data in groups if group_dn not in visited})
 
     def get_members(self):
+        lookup = self.provider._get_member_lookup()
+        if lookup is None:
+            lookup = self._probe_member_lookups()
+        if lookup == 'member_attr':
+            entries = self._iter_member_attr_entries(self.provider._attributes)
+        elif self.ldap_settings['member_lookup'] == 'auto':
+            entries = self._iter_member_of_entries_or_member_attr()
+        else:
+            entries = self._iter_member_of_entries()
+        for _, user_data in entries:
+            user_data = to_unicode(user_data)
+            try:
+                identifier = user_data[self.ldap_settings['uid']][0]
+            except KeyError:
+                # user does not have an identifier -> skip it
+                continue
+            yield IdentityInfo(self.provider, identifier=identifier, **user_data)
+
+    def _probe_member_lookups(self):
+        """Chooses the strategy used to retrieve the members of groups.
+
+        Used with ``member_lookup`` set to ``'auto'`` the first time the
+        members of a group are retrieved.  Each strategy retrieves at
+        most ``MEMBER_LOOKUP_PROBE_SIZE`` members of the group.  The
+        member-of strategy is only chosen if it returned the same
+        non-empty set of members as the member attribute of the group
+        (or both returned the maximum number of members) and was faster.
+        Otherwise, e.g. because the directory does not maintain the
+        member-of attribute or the group is empty, the member attribute
+        is used since it is always correct.  The decision is kept for
+        all groups of the provider.
+
+        :return: The chosen strategy
+        """
+        samples = {}
+        durations = {}
+        strategies = (('member_attr', partial(self._iter_member_attr_entries, self.provider._attributes)),
+                      ('member_of', self._iter_member_of_entries))
+        for lookup, iter_entries in strategies:
+            start = time.monotonic()
+            entries = iter_entries()
+            try:
+                samples[lookup] = {dn.lower() for dn, __ in islice(entries, MEMBER_LOOKUP_PROBE_SIZE)}
+            finally:
+                entries.close()
+            durations[lookup] = time.monotonic() - start
+        truncated = all(len(sample) == MEMBER_LOOKUP_PROBE_SIZE for sample in samples.values())
+        if samples['member_attr'] and (samples['member_attr'] == samples['member_of'] or truncated):
+            self.provider._member_lookup = min(durations, key=durations.get)
+        else:
+            self.provider._member_lookup = 'member_attr'
+        return self.provider._member_lookup
+
+    def _iter_member_of_entries_or_member_attr(self):
+        """Yields the members using the member-of strategy.
+
+        If it does not find any members, they are read from the member
+        attribute of the group instead, so a directory which stopped
+        maintaining the member-of attribute does not result in empty
+        groups.
+        """
+        found = False
+        for entry in self._iter_member_of_entries():
+            found = True
+            yield entry
+        if not found:
+            yield from self._iter_member_attr_entries(self.provider._attributes)
+
+    def _iter_member_of_entries(self):
+        """Yields the members by searching users whose member-of attribute contains the group."""
         with ldap_context(self.ldap_settings):
             group_dns = self._iter_group()
             group_dn = next(group_dns)
             while group_dn:
                 user_filter = build_user_search_filter({self.ldap_settings['member_of_attr']: {group_dn}}, exact=True)
-                for _, user_data in self.provider._search_users(user_filter):
-                    user_data = to_unicode(user_data)
-                    try:
-                        identifier = user_data[self.ldap_settings['uid']][0]
-                    except KeyError:
-                        # user does not have an identifier -> skip it
-                        continue
-                    yield IdentityInfo(self.provider, identifier=identifier, **user_data)
+                yield from self.provider._search_users(user_filter)
                 group_filter = build_group_search_filter({self.ldap_settings['member_of_attr']: {group_dn}}, exact=True)
                 subgroups = list(self.provider._search_groups(group_filter))
                 try:
@@ -135,7 +215,68 @@ class LDAPGroup(Group):
                 except StopIteration:
                     break
 
+    def _iter_member_attr_entries(self, attributes):
+        """Yields the members by reading the member attribute of the group.
+
+        Member DNs are read in chunks and resolved using batched
+        base-scope reads; members which are not users are resolved as
+        nested groups.  Each member is only yielded once.
+        """
+        user_filter = self.ldap_settings['user_filter']
+        group_filter = self.ldap_settings['group_filter']
+        seen = set()
+        with ldap_context(self.ldap_settings):
+            group_dns = self._iter_group()
+            group_dn = next(group_dns)
+            while group_dn:
+                subgroups = []
+                for member_dns in get_group_member_dns(group_dn, self.ldap_settings['member_attr']):
+                    member_dns = [dn for dn in member_dns if dn.lower() not in seen]
+                    seen.update(dn.lower() for dn in member_dns)
+                    users = set()
+                    for user_dn, user_data in read_entries(member_dns, user_filter, attributes):
+                        users.add(user_dn.lower())
+                        yield user_dn, user_data
+                    other_dns = [dn for dn in member_dns if dn.lower() not in users]
+                    subgroups += read_entries(other_dns, group_filter, ['1.1'])
+                try:
+                    group_dn = group_dns.send(subgroups)
+                except StopIteration:
+                    break
+
+    def _count_members(self):
+        # only the DNs of the members are retrieved ('1.1' requests no attributes)
+        with ldap_context(self.ldap_settings):
+            if self.provider._get_member_lookup() == 'member_of':
+                count = self._count_member_of_entries()
+                if count or self.ldap_settings['member_lookup'] != 'auto':
+                    return count
+            return sum(1 for __ in self._iter_member_attr_entries(['1.1']))
+
+    def _count_member_of_entries(self):
+        user_base = self.ldap_settings['user_base']
+        member_of_attr = self.ldap_settings['member_of_attr']
+        if self.ldap_settings['ad_group_style']:
+            member_of_attr += ':' + LDAP_MATCHING_RULE_IN_CHAIN + ':'
+            user_filter = build_user_search_filter({member_of_attr: {self.dn}}, exact=True)
+            return sum(1 for __ in search_subtrees(user_base, user_filter, ['1.1']))
+        member_dns = set()
+        group_dns = self._iter_group()
+        group_dn = next(group_dns)
+        while group_dn:
+            user_filter = build_user_search_filter({member_of_attr: {group_dn}}, exact=True)
+            member_dns.update(dn for dn, __ in search_subtrees(user_base, user_filter, ['1.1']))
+            group_filter = build_group_search_filter({member_of_attr: {group_dn}}, exact=True)
+            subgroups = list(self.provider._search_groups(group_filter))
+            try:
+                group_dn = group_dns.send(subgroups)
+            except StopIteration:
+                break
+        return len(member_dns)
+
     def has_member(self, user_identifier):
+        if self.provider._get_member_lookup() == 'member_attr':
+            return user_identifier in self.has_members({user_identifier})
         with ldap_context(self.ldap_settings):
             user_dn, user_data = get_user_by_id(user_identifier, attributes=[self.ldap_settings['member_of_attr']])
             if not user_dn:
@@ -149,6 +290,76 @@ class LDAPGroup(Group):
                 user_data = to_unicode(user_data)
                 return self.dn in user_data.get(self.ldap_settings['member_of_attr'], [])
 
+    def has_members(self, user_identifiers):
+        """Checks which of the given users are members of the group.
+
+        All users are checked using a single search.  With
+        ``ad_group_style`` members of nested groups are matched using
+        the ``LDAP_MATCHING_RULE_IN_CHAIN`` rule.  If the members are
+        retrieved using the member attribute of the group, the DNs of
+        the users are looked up in the member attribute instead.
+        """
+        user_identifiers = set(user_identifiers)
+        if not user_identifiers:
+            return set()
+        if self.provider._get_member_lookup() == 'member_attr':
+            return self._has_members_by_member_attr(user_identifiers)
+        uid_attr = self.ldap_settings['uid']
+        member_of_attr = self.ldap_settings['member_of_attr']
+        if self.ldap_settings['ad_group_style']:
+            member_of_attr += ':' + LDAP_MATCHING_RULE_IN_CHAIN + ':'
+        found = set()
+        with ldap_context(self.ldap_settings):
+            user_filter = build_user_search_filter({uid_attr: user_identifiers, member_of_attr: {self.dn}},
+                                                   exact=True)
+            for _, user_data in search_subtrees(self.ldap_settings['user_base'], user_filter, [uid_attr]):
+                found.update(uid.lower() for uid in to_unicode(user_data).get(uid_attr, []))
+        # LDAP attribute values are usually matched case-insensitively
+        return {identifier for identifier in user_identifiers if identifier.lower() in found}
+
+    def _has_members_by_member_attr(self, user_identifiers):
+        uid_attr = self.ldap_settings['uid']
+        user_uids = {}
+        found = set()
+        with ldap_context(self.ldap_settings):
+            user_filter = build_user_search_filter({uid_attr: user_identifiers}, exact=True)
+            for user_dn, user_data in search_subtrees(self.ldap_settings['user_base'], user_filter, [uid_attr]):
+                user_uids[user_dn.lower()] = {uid.lower() for uid in to_unicode(user_data).get(uid_attr, [])}
+            for user_dn in self._find_member_dns(set(user_uids)):
+                found |= user_uids[user_dn]
+        return {identifier for identifier in user_identifiers if identifier.lower() in found}
+
+    def _find_member_dns(self, user_dns):
+        """Finds which of the given users are in the member attribute of the group.
+
+        Members of nested groups are found as well.  Large member
+        attributes are read in chunks (using ranged retrieval in Active
+        Directory) and reading stops as soon as all users have been found.
+
+        :param user_dns: A set of lowercase user DNs
+        :return: The subset of `user_dns` which are members of the group
+        """
+        group_filter = self.ldap_settings['group_filter']
+        found = set()
+        seen = set()
+        group_dns = self._iter_group()
+        group_dn = next(group_dns)
+        while group_dn and found != user_dns:
+            subgroups = []
+            for member_dns in get_group_member_dns(group_dn, self.ldap_settings['member_attr']):
+                member_dns = [dn for dn in member_dns if dn.lower() not in seen]
+                seen.update(dn.lower() for dn in member_dns)
+                found.update(dn.lower() for dn in member_dns if dn.lower() in user_dns)
+                if found == user_dns:
+                    break
+                other_dns = [dn for dn in member_dns if dn.lower() not in user_dns]
+                subgroups += read_entries(other_dns, group_filter, ['1.1'])
+            try:
+                group_dn = group_dns.send(subgroups)
+            except StopIteration:
+                break
+        return found
+
 
 class LDAPIdentityProvider(LDAPProviderMixin, IdentityProvider):
     """Provides identity information using LDAP."""
@@ -157,6 +368,8 @@ class LDAPIdentityProvider(LDAPProviderMixin, IdentityProvider):
     supports_refresh = True
     #: If the provider supports searching users
     supports_search = True
+    #: If the provider supports searching with ``match='prefix'``
+    supports_prefix_search = True
     #: If the provider also provides groups and membership information
     supports_groups = True
     #: The class that represents groups from this provider
@@ -169,6 +382,11 @@ class LDAPIdentityProvider(LDAPProviderMixin, IdentityProvider):
         self.ldap_settings.setdefault('group_filter', '(objectClass=groupOfNames)')
         self.ldap_settings.setdefault('member_of_attr', 'memberOf')
         self.ldap_settings.setdefault('ad_group_style', False)
+        self.ldap_settings.setdefault('member_attr', 'member')
+        self.ldap_settings.setdefault('member_lookup', 'member_of')
+        if self.ldap_settings['member_lookup'] not in ('member_of', 'member_attr', 'auto'):
+            raise ValueError('Invalid member lookup: ' + self.ldap_settings['member_lookup'])
+        self._member_lookup = None
         self.settings['mapping'] = to_unicode(self.settings['mapping'])
         self._attributes = list(
             convert_app_data(self.settings['mapping'], {}, self.settings['identity_info_keys']).values())
@@ -178,6 +396,15 @@ class LDAPIdentityProvider(LDAPProviderMixin, IdentityProvider):
     def supports_get_identity_groups(self):
         return self.ldap_settings['ad_group_style']
 
+    def _get_member_lookup(self):
+        """Returns the strategy used to retrieve the members of groups.
+
+        With ``member_lookup`` set to ``'auto'``, this is ``None`` until
+        a strategy has been chosen by :meth:`LDAPGroup.get_members`.
+        """
+        lookup = self.ldap_settings['member_lookup']
+        return lookup if lookup != 'auto' else self._member_lookup
+
     def _get_identity(self, identifier):
         with ldap_context(self.ldap_settings):
             user_dn, user_data = get_user_by_id(identifier, self._attributes)
@@ -187,7 +414,7 @@ class LDAPIdentityProvider(LDAPProviderMixin, IdentityProvider):
         return IdentityInfo(self, identifier=user_data[self.ldap_settings['uid']][0], **user_data)
 
     def _search_users(self, search_filter):  # pragma: no cover
-        return search(self.ldap_settings['user_base'], search_filter, self._attributes)
+        return search_subtrees(self.ldap_settings['user_base'], search_filter, self._attributes)
 
     def _search_groups(self, search_filter):  # pragma: no cover
         return search(self.ldap_settings['group_base'], search_filter, attributes=[self.ldap_settings['gid']])
@@ -201,9 +428,9 @@ class LDAPIdentityProvider(LDAPProviderMixin, IdentityProvider):
     def get_identity(self, identifier):  # pragma: no cover
         return self._get_identity(identifier)
 
-    def search_identities(self, criteria, exact=False):
+    def search_identities(self, criteria, exact=False, match=None):
         with ldap_context(self.ldap_settings):
-            search_filter = build_user_search_filter(criteria, self.settings['mapping'], exact=exact)
+            search_filter = build_user_search_filter(criteria, self.settings['mapping'], exact=exact, match=match)
             if not search_filter:
                 raise IdentityRetrievalFailed('Unable to generate search filter from criteria', provider=self)
             for _, user_data in self._search_users(search_filter):
@@ -240,9 +467,9 @@ class LDAPIdentityProvider(LDAPProviderMixin, IdentityProvider):
         group_name = to_unicode(group_data[self.ldap_settings['gid']][0])
         return self.group_class(self, group_name, group_dn)
 
-    def search_groups(self, name, exact=False):
+    def search_groups(self, name, exact=False, match=None):
         with ldap_context(self.ldap_settings):
-            search_filter = build_group_search_filter({self.ldap_settings['gid']: {name}}, exact=exact)
+            search_filter = build_group_search_filter({self.ldap_settings['gid']: {name}}, exact=exact, match=match)
             if not search_filter:
                 raise GroupRetrievalFailed('Unable to generate search filter from criteria', provider=self)
             for group_dn, group_data in self._search_groups(search_filter):
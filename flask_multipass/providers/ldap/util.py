@@ -4,10 +4,13 @@
 # Flask-Multipass is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
+import threading
+import time
 from collections import namedtuple
 from contextlib import contextmanager
 from urllib.parse import urlsplit
 from warnings import warn
+from weakref import WeakKeyDictionary
 
 import ldap
 from flask import appcontext_tearing_down, current_app, g, has_app_context
@@ -15,10 +18,10 @@ from ldap.controls import SimplePagedResultsControl
 from ldap.filter import escape_filter_chars
 from ldap.ldapobject import ReconnectLDAPObject
 
-from flask_multipass.exceptions import MultipassException
+from flask_multipass.exceptions import MultipassException, ProviderUnavailable
 from flask_multipass.providers.ldap.exceptions import LDAPServerError
 from flask_multipass.providers.ldap.globals import _ldap_ctx_stack, current_ldap
-from flask_multipass.util import convert_app_data
+from flask_multipass.util import convert_app_data, resolve_search_match
 
 #: A context holding the LDAP connection and the LDAP provider settings.
 LDAPContext = namedtuple('LDAPContext', ('connection', 'settings'))
@@ -26,16 +29,220 @@ LDAPContext = namedtuple('LDAPContext', ('connection', 'settings'))
 conn_keys = {'uri', 'bind_dn', 'bind_password', 'tls', 'starttls'}
 
 
+def _get_connection_key(settings):
+    return frozenset((k, hash(tuple(v) if isinstance(v, list) else v)) for k, v in settings.items() if k in conn_keys)
+
+
+class _LDAPServer:
+    def __init__(self, uri):
+        self.uri = uri
+        self.latency = None
+        self.outstanding = 0
+        self.failures = 0
+        self.down_until = None
+        self.probe = None
+
+    @property
+    def is_up(self):
+        return self.down_until is None
+
+
+class LDAPServerPool:
+    """Keeps track of the health of the servers of an LDAP provider.
+
+    New connections go to the healthy server with the lowest connect
+    latency or the fewest outstanding operations (depending on the
+    ``server_selection`` setting).  A server that cannot be reached is
+    skipped until a background probe manages to connect to it again;
+    the time between probes doubles after each failure.
+
+    The pool also keeps up to `max_idle_connections` idle connections
+    for each set of credentials, which are used by code that cannot use
+    the connection cached in the app context (e.g. the threads searching
+    several subtrees), so they do not need to connect and bind again for
+    every search.
+
+    :param uris: The URIs of the servers.
+    :param strategy: ``'latency'`` or ``'outstanding'``
+    :param retry_interval: The time in seconds after which a failed
+                           server is probed for the first time.
+    :param max_idle_connections: The maximum number of idle connections
+                                 kept for each set of credentials.
+    """
+
+    #: The weight of a new latency sample in the moving average
+    latency_weight = 0.3
+    #: The maximum time in seconds between two probes of a failed server
+    max_retry_interval = 600
+
+    def __init__(self, uris, strategy='latency', retry_interval=30, max_idle_connections=4):
+        if strategy not in {'latency', 'outstanding'}:
+            raise ValueError('Invalid server selection strategy: ' + strategy)
+        self.servers = [_LDAPServer(uri) for uri in uris]
+        self.strategy = strategy
+        self.retry_interval = retry_interval
+        self.max_idle_connections = max_idle_connections
+        self._lock = threading.Lock()
+        self._connection_servers = WeakKeyDictionary()
+        self._idle_connections = {}
+
+    def _sort_key(self, server):
+        latency = server.latency if server.latency is not None else 0
+        if self.strategy == 'latency':
+            return latency, server.outstanding
+        return server.outstanding, latency
+
+    def select(self):
+        """Returns the servers in the order they should be tried.
+
+        Servers which are down come last so they are only used if no
+        other server is reachable.
+        """
+        with self._lock:
+            up = sorted((s for s in self.servers if s.is_up), key=self._sort_key)
+            down = sorted((s for s in self.servers if not s.is_up), key=lambda s: s.down_until)
+        return up + down
+
+    def get_server(self, connection):
+        """Returns the server a connection from :func:`ldap_connect` uses."""
+        with self._lock:
+            return self._connection_servers.get(connection)
+
+    def connected(self, server, latency, connection=None):
+        """Records a successful connection to a server."""
+        with self._lock:
+            if connection is not None:
+                self._connection_servers[connection] = server
+            if server.latency is None:
+                server.latency = latency
+            else:
+                server.latency += self.latency_weight * (latency - server.latency)
+            server.failures = 0
+            server.down_until = None
+
+    def failed(self, server, settings):
+        """Marks a server as down and schedules a background probe.
+
+        :param server: The server that could not be reached.
+        :param settings: The LDAP settings used to probe the server.
+        """
+        with self._lock:
+            server.failures += 1
+            delay = min(self.retry_interval * 2 ** (server.failures - 1), self.max_retry_interval)
+            server.down_until = time.monotonic() + delay
+            if server.probe is not None:
+                return
+            server.probe = threading.Timer(delay, self._probe, (server, settings))
+            server.probe.daemon = True
+        server.probe.start()
+
+    def _probe(self, server, settings):
+        with self._lock:
+            server.probe = None
+        start = time.monotonic()
+        try:
+            connection = _connect_server(server.uri, settings)
+        except ldap.LDAPError:
+            self.failed(server, settings)
+        else:
+            self.connected(server, time.monotonic() - start)
+            _unbind(connection)
+
+    def acquire_connection(self, settings):
+        """Returns an idle connection, or a new one if there is none.
+
+        Idle connections to a server which is down are closed instead.
+
+        :param settings: dict -- The settings for a LDAP provider.
+        """
+        stale = []
+        connection = None
+        with self._lock:
+            idle = self._idle_connections.get(_get_connection_key(settings), [])
+            while idle and connection is None:
+                connection = idle.pop()
+                server = self._connection_servers.get(connection)
+                if server is not None and not server.is_up:
+                    stale.append(connection)
+                    connection = None
+        for conn in stale:
+            _unbind(conn)
+        return connection if connection is not None else ldap_connect(settings, use_cache=False)
+
+    def release_connection(self, connection, settings, reusable=True):
+        """Returns a connection from :meth:`acquire_connection` to the pool.
+
+        :param connection: The connection to return.
+        :param settings: dict -- The settings for a LDAP provider.
+        :param reusable: bool -- Whether the connection can be used again.
+                         If not, or if there are enough idle connections
+                         already, it is closed.
+        """
+        if reusable:
+            with self._lock:
+                idle = self._idle_connections.setdefault(_get_connection_key(settings), [])
+                if len(idle) < self.max_idle_connections:
+                    idle.append(connection)
+                    return
+        _unbind(connection)
+
+    @contextmanager
+    def track(self, server):
+        """Counts the operations running on a server."""
+        with self._lock:
+            server.outstanding += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                server.outstanding -= 1
+
+    @property
+    def health(self):
+        """The state of each server."""
+        with self._lock:
+            return [{'uri': s.uri, 'up': s.is_up, 'latency': s.latency, 'outstanding': s.outstanding,
+                     'failures': s.failures} for s in self.servers]
+
+
+_server_pools = {}
+_server_pools_lock = threading.Lock()
+
+
+def get_server_pool(settings):
+    """Returns the :class:`LDAPServerPool` for the URIs in the settings.
+
+    The pool is shared by all providers using the same URIs.
+
+    :param settings: dict -- The settings for a LDAP provider.
+    """
+    uris = settings['uri']
+    uris = (uris,) if isinstance(uris, str) else tuple(uris)
+    key = (uris, settings.get('server_selection', 'latency'))
+    with _server_pools_lock:
+        try:
+            return _server_pools[key]
+        except KeyError:
+            pool = _server_pools[key] = LDAPServerPool(uris, strategy=key[1],
+                                                       retry_interval=settings.get('server_retry_interval', 30),
+                                                       max_idle_connections=settings.get('connection_pool_size', 4))
+            return pool
+
+
+def _unbind(connection):
+    try:
+        connection.unbind_s()
+    except ldap.LDAPError:
+        # That's ugly but we couldn't care less about a failure while disconnecting
+        pass
+
+
 @appcontext_tearing_down.connect
 def _clear_ldap_cache(*args, **kwargs):
     if not has_app_context() or '_multipass_ldap_connections' not in g:
         return
     for conn in g._multipass_ldap_connections.values():
-        try:
-            conn.unbind_s()
-        except ldap.LDAPError:
-            # That's ugly but we couldn't care less about a failure while disconnecting
-            pass
+        _unbind(conn)
     del g._multipass_ldap_connections
 
 
@@ -51,7 +258,7 @@ def _get_ldap_cache():
 
 
 @contextmanager
-def ldap_context(settings, use_cache=True):
+def ldap_context(settings, use_cache=True, pooled=False):
     """Establishes an LDAP session context.
 
     Establishes a connection to the LDAP server from the `uri` in the
@@ -62,26 +269,42 @@ def ldap_context(settings, use_cache=True):
 
     :param settings: dict -- The settings for a LDAP provider.
     :param use_cache: bool -- If the connection should be cached.
+    :param pooled: bool -- If the connection should be taken from the
+                   idle connections of the :class:`LDAPServerPool` and
+                   returned there afterwards.  Unlike the cache, this
+                   works outside the app context and across requests.
     """
+    pool = get_server_pool(settings)
     try:
-        connection = ldap_connect(settings, use_cache=use_cache)
+        connection = pool.acquire_connection(settings) if pooled else ldap_connect(settings, use_cache=use_cache)
         ldap_ctx = LDAPContext(connection=connection, settings=settings)
+        server = pool.get_server(connection)
         _ldap_ctx_stack.push(ldap_ctx)
+        reusable = True
         try:
-            yield ldap_ctx
-        except ldap.LDAPError:
+            if server is None:
+                yield ldap_ctx
+            else:
+                with pool.track(server):
+                    yield ldap_ctx
+        except ldap.LDAPError as exc:
             # If something went wrong we get rid of cached connections.
             # This is mostly for the python shell where you have a very
             # long-living application context that usually results in
             # the ldap connection timing out.
             _clear_ldap_cache()
+            reusable = False
+            if server is not None and isinstance(exc, ldap.SERVER_DOWN):
+                pool.failed(server, settings)
             raise
         finally:
             assert _ldap_ctx_stack.pop() is ldap_ctx, 'Popped wrong LDAP context'
+            if pooled:
+                pool.release_connection(connection, settings, reusable)
     except ldap.SERVER_DOWN:
         if has_app_context() and current_app.debug:
             raise
-        raise MultipassException('The LDAP server is unreachable')
+        raise ProviderUnavailable('The LDAP server is unreachable')
     except ldap.INVALID_CREDENTIALS:
         if has_app_context() and current_app.debug:
             raise
@@ -91,7 +314,7 @@ def ldap_context(settings, use_cache=True):
     except ldap.TIMELIMIT_EXCEEDED:
         raise MultipassException('The time limit for the operation has been exceeded.')
     except ldap.TIMEOUT:
-        raise MultipassException('The operation timed out.')
+        raise ProviderUnavailable('The operation timed out.')
     except ldap.FILTER_ERROR:
         raise ValueError('The filter supplied to the operation is invalid. '
                          '(This is most likely due to a bad user or group filter.')
@@ -101,10 +324,12 @@ def ldap_connect(settings, use_cache=True):
     """Establishes an LDAP connection.
 
     Establishes a connection to the LDAP server from the `uri` in the
-    ``settings``.
+    ``settings``.  If it contains a list of URIs, the server is chosen
+    by the :class:`LDAPServerPool` of these URIs and unreachable servers
+    are skipped.
 
     To establish a connection, the settings must be specified:
-     - ``uri``: valid URI which points to a LDAP server,
+     - ``uri``: valid URI (or list of URIs) pointing to LDAP servers,
      - ``bind_dn``: `dn` used to initially bind every LDAP connection
      - ``bind_password``" password used for the initial bind
      - ``tls``: ``True`` if the connection should use TLS encryption
@@ -122,17 +347,42 @@ def ldap_connect(settings, use_cache=True):
     """
     if use_cache:
         cache = _get_ldap_cache()
-        cache_key = frozenset((k, hash(v)) for k, v in settings.items() if k in conn_keys)
+        cache_key = _get_connection_key(settings)
         conn = cache.get(cache_key)
         if conn is not None:
             return conn
 
-    uri_info = urlsplit(settings['uri'])
+    pool = get_server_pool(settings)
+    if len(pool.servers) == 1:
+        ldap_connection = _connect_server(pool.servers[0].uri, settings)
+    else:
+        for server in pool.select():
+            start = time.monotonic()
+            try:
+                ldap_connection = _connect_server(server.uri, settings)
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT) as exc:
+                pool.failed(server, settings)
+                error = exc
+                continue
+            pool.connected(server, time.monotonic() - start, ldap_connection)
+            break
+        else:
+            raise error
+    if use_cache:
+        cache[cache_key] = ldap_connection
+    return ldap_connection
+
+
+def _connect_server(uri, settings):
+    """Connects and binds to a single LDAP server."""
+    uri_info = urlsplit(uri)
     use_ldaps = uri_info.scheme == 'ldaps'
     credentials = (settings['bind_dn'], settings['bind_password'])
-    ldap_connection = ReconnectLDAPObject(settings['uri'], bytes_mode=False)
+    ldap_connection = ReconnectLDAPObject(uri, bytes_mode=False)
     ldap_connection.protocol_version = ldap.VERSION3
     ldap_connection.set_option(ldap.OPT_REFERRALS, 0)
+    if settings.get('connect_timeout') is not None:
+        ldap_connection.set_option(ldap.OPT_NETWORK_TIMEOUT, settings['connect_timeout'])
     if settings['verify_cert'] and settings['cert_file']:
         ldap_connection.set_option(ldap.OPT_X_TLS_CACERTFILE, settings['cert_file'])
     ldap_connection.set_option(ldap.OPT_X_TLS_REQUIRE_CERT,
@@ -146,8 +396,6 @@ def ldap_connect(settings, use_cache=True):
         ldap_connection.start_tls_s()
     # TODO: allow anonymous bind
     ldap_connection.simple_bind_s(*credentials)
-    if use_cache:
-        cache[cache_key] = ldap_connection
     return ldap_connection
 
 
@@ -173,8 +421,15 @@ def find_one(base_dn, search_filter, attributes=None):
     return next(((dn, data) for dn, data in entry if dn), (None, None))
 
 
-def _build_assert_template(value, exact):
-    assert_template = '(%s=%s)' if exact else '(%s=*%s*)'
+_assert_templates = {
+    'contains': '(%s=*%s*)',
+    'exact': '(%s=%s)',
+    'prefix': '(%s=%s*)',
+}
+
+
+def _build_assert_template(value, match):
+    assert_template = _assert_templates[match]
     if len(value) == 1:
         return assert_template
     else:
@@ -194,7 +449,7 @@ def _filter_format(filter_template, assertion_values):
     return filter_template % tuple(_escape_filter_chars(v) for v in assertion_values)
 
 
-def build_search_filter(criteria, type_filter, mapping=None, exact=False):
+def build_search_filter(criteria, type_filter, mapping=None, exact=False, match=None):
     """Builds a valid LDAP search filter for retrieving entries.
 
     :param criteria: dict -- Criteria to be ANDed together to build the
@@ -203,10 +458,15 @@ def build_search_filter(criteria, type_filter, mapping=None, exact=False):
     :param mapping: dict -- Mapping from criteria to LDAP attributes
     :param exact: bool -- Match attributes values exactly if ``True``,
                   othewise perform substring matching.
+    :param match: str -- ``'contains'``, ``'exact'`` or ``'prefix'``.
+                  Prefix matching (`attr=value*`) can usually be
+                  answered using an index, unlike substring matching.
+                  If ``None``, it is determined by `exact`.
     :return: str -- Valid LDAP search filter.
     """
+    match = resolve_search_match(exact, match)
     assertions = convert_app_data(criteria, mapping or {})
-    assert_templates = [_build_assert_template(value, exact) for _, value in assertions.items()]
+    assert_templates = [_build_assert_template(value, match) for _, value in assertions.items()]
     assertions = [(k, v) for k, values in assertions.items() if k and values for v in values]
     if not assertions:
         return None
@@ -4,37 +4,290 @@
 # Flask-Multipass is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
-from urllib.parse import urlsplit
+import copy
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlencode, urlsplit
+from urllib.request import urlopen
 
 from flask import current_app, make_response, redirect, request, session, url_for
+from lxml import etree
 from onelogin.saml2.auth import OneLogin_Saml2_Auth
+from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
 
 from flask_multipass.auth import AuthProvider
 from flask_multipass.data import AuthInfo, IdentityInfo
-from flask_multipass.exceptions import AuthenticationFailed, IdentityRetrievalFailed, MultipassException
+from flask_multipass.exceptions import (
+    AuthenticationFailed,
+    IdentityRetrievalFailed,
+    MultipassException,
+    ProviderUnavailable,
+)
 from flask_multipass.identity import IdentityProvider
-from flask_multipass.util import login_view
+from flask_multipass.session import multipass_session
+from flask_multipass.util import FileLock, TTLCache, login_view
+
+_MD_NS = 'urn:oasis:names:tc:SAML:2.0:metadata'
+_MDUI_NS = 'urn:oasis:names:tc:SAML:metadata:ui'
+
+
+def _get_idp_display_name(entity):
+    names = entity.findall(f'{{{_MD_NS}}}IDPSSODescriptor/{{{_MD_NS}}}Extensions/{{{_MDUI_NS}}}UIInfo/'
+                           f'{{{_MDUI_NS}}}DisplayName')
+    names += entity.findall(f'{{{_MD_NS}}}Organization/{{{_MD_NS}}}OrganizationDisplayName')
+    name = next((x for x in names if x.get('{http://www.w3.org/XML/1998/namespace}lang') == 'en'), None)
+    if name is None and names:
+        name = names[0]
+    return name.text.strip() if name is not None and name.text else entity.get('entityID')
+
+
+class _FederationMetadataStore:
+    """Stores the IdPs from a SAML federation metadata aggregate.
+
+    The aggregate is parsed incrementally and the metadata of each IdP is
+    stored in an SQLite database indexed by its entity ID, so neither
+    parsing nor looking up an IdP needs to keep the whole aggregate in
+    memory.  The database file is shared by all processes using the same
+    ``index_file`` and refreshed in a background thread once it is older
+    than ``refresh_interval`` seconds.  A lock file next to the index makes
+    sure only one of the processes downloads and parses the aggregate while
+    the others keep using the current index.
+
+    :param name: The name of the auth provider using the store
+    :param settings: The ``saml_federation`` settings of the provider
+    """
+
+    def __init__(self, name, settings):
+        self.metadata_url = settings.get('metadata_url')
+        self.metadata_file = settings.get('metadata_file')
+        if not self.metadata_url and not self.metadata_file:
+            raise MultipassException('`saml_federation` requires `metadata_url` or `metadata_file`')
+        self.cert = settings.get('cert')
+        self.refresh_interval = settings.get('refresh_interval', 6 * 3600)
+        self.timeout = settings.get('timeout', 60)
+        self.build_timeout = settings.get('build_timeout', 300)
+        self.index_file = settings.get('index_file') or os.path.join(tempfile.gettempdir(),
+                                                                     f'flask-multipass-saml-{name}.sqlite')
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._refresh_lock = FileLock(f'{self.index_file}.lock')
+
+    @property
+    def age(self):
+        """The time in seconds since the index was built, or ``None``."""
+        try:
+            return time.time() - os.path.getmtime(self.index_file)
+        except OSError:
+            return None
+
+    def _needs_refresh(self):
+        age = self.age
+        return age is None or age >= self.refresh_interval
+
+    def _refresh_locked(self):
+        """Refresh the index unless another process is doing so or just did."""
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            if self._needs_refresh():
+                self.refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def _wait_for_index(self):
+        """Wait until the index exists, building it unless someone else does.
+
+        Threads and processes waiting for an index built by someone else
+        poll for it instead of queueing up on a lock, so they can use it as
+        soon as it has been written.
+        """
+        deadline = time.monotonic() + self.build_timeout
+        while self.age is None:
+            if self._refresh_lock.acquire(blocking=False):
+                try:
+                    if self.age is None:
+                        self.refresh()
+                finally:
+                    self._refresh_lock.release()
+                return
+            if time.monotonic() >= deadline:
+                raise ProviderUnavailable('The SAML federation metadata has not been loaded yet')
+            time.sleep(0.1)
+
+    def _download(self, target):
+        if self.metadata_file:
+            shutil.copyfile(self.metadata_file, target)
+            return
+        with urlopen(self.metadata_url, timeout=self.timeout) as resp, open(target, 'wb') as f:  # noqa: S310
+            shutil.copyfileobj(resp, f)
+
+    def _iter_idps(self, source):
+        for _, entity in etree.iterparse(source, events=('end',), tag=f'{{{_MD_NS}}}EntityDescriptor',
+                                         resolve_entities=False, no_network=True, huge_tree=True):
+            if entity.find(f'{{{_MD_NS}}}IDPSSODescriptor') is not None and entity.get('entityID'):
+                yield entity.get('entityID'), _get_idp_display_name(entity), etree.tostring(entity)
+            # free the memory used by the entities we already processed
+            entity.clear()
+            while entity.getprevious() is not None:
+                del entity.getparent()[0]
+
+    def refresh(self):
+        """Download the metadata aggregate and rebuild the index."""
+        index_dir = os.path.dirname(os.path.abspath(self.index_file))
+        fd, source = tempfile.mkstemp(suffix='.xml', dir=index_dir)
+        os.close(fd)
+        tmp_index = f'{self.index_file}.{os.getpid()}.tmp'
+        try:
+            self._download(source)
+            if self.cert:
+                xml = Path(source).read_bytes()
+                if not OneLogin_Saml2_Utils.validate_metadata_sign(xml, cert=self.cert, validatecert=True):
+                    raise MultipassException('Invalid signature in SAML federation metadata')
+                del xml
+            conn = sqlite3.connect(tmp_index)
+            try:
+                with conn:
+                    conn.execute('DROP TABLE IF EXISTS idps')
+                    conn.execute('CREATE TABLE idps (entity_id TEXT PRIMARY KEY, name TEXT, metadata BLOB)')
+                    rows = self._iter_idps(source)
+                    while batch := [row for _, row in zip(range(500), rows)]:
+                        conn.executemany('INSERT OR REPLACE INTO idps VALUES (?, ?, ?)', batch)
+            finally:
+                conn.close()
+            os.replace(tmp_index, self.index_file)
+        finally:
+            for path in (source, tmp_index):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                self._refresh_locked()
+            except Exception:
+                logging.getLogger('multipass.saml').exception('Refreshing SAML federation metadata failed')
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_run, name='multipass-saml-federation', daemon=True).start()
+
+    def _query(self, sql, params=()):
+        age = self.age
+        if age is None:
+            # nothing we could use yet, so wait until the index has been built (possibly by another process)
+            self._wait_for_index()
+        elif age >= self.refresh_interval:
+            self._refresh_in_background()
+        conn = sqlite3.connect(f'file:{self.index_file}?mode=ro', uri=True)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def get_metadata(self, entity_id):
+        """Get the metadata XML of an IdP, or ``None`` if it does not exist."""
+        rows = self._query('SELECT metadata FROM idps WHERE entity_id = ?', (entity_id,))
+        return rows[0][0] if rows else None
+
+    def search(self, query=None, limit=50):
+        """Search IdPs by entity ID or name.
+
+        :return: A list of ``(entity_id, name)`` tuples.
+        """
+        if not query:
+            return self._query('SELECT entity_id, name FROM idps ORDER BY name LIMIT ?', (limit,))
+        pattern = '%{}%'.format(query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+        return self._query(r"SELECT entity_id, name FROM idps WHERE name LIKE ? ESCAPE '\' "
+                           r"OR entity_id LIKE ? ESCAPE '\' ORDER BY name LIMIT ?", (pattern, pattern, limit))
 
 
 class SAMLAuthProvider(AuthProvider):
     """Provides authentication using SAML.
 
     The type name to instantiate this provider is *saml*.
+
+    The SP metadata is generated, signed (if enabled in the SAML security
+    settings) and validated only once and then served from memory for
+    ``saml_metadata_max_age`` seconds (one day by default).  This value
+    must be lower than the validity of the metadata, which is two days
+    unless ``metadataValidUntil`` is set in the SAML security settings.
+
+    Instead of a single IdP in ``saml_config``, the provider can also use
+    all IdPs from a federation metadata aggregate.  To do so, set
+    ``saml_federation`` to a dict containing:
+
+    - ``metadata_url`` or ``metadata_file``: where to load the aggregate from
+    - ``cert``: the certificate used to verify the signature of the aggregate
+      (strongly recommended when loading it from an URL)
+    - ``refresh_interval``: the time in seconds after which the aggregate is
+      loaded again (6 hours by default)
+    - ``index_file``: the path of the SQLite database storing the IdPs (a file
+      in the temp dir by default); it is shared by all processes using it
+    - ``build_timeout``: the time in seconds to wait for another process that
+      is building the index when there is none yet (5 minutes by default)
+    - ``discovery_url``: the URL of a SAML discovery service used to select an
+      IdP when none has been specified
+
+    The IdP to log in with is selected using the ``idp`` query string argument
+    (containing its entity ID) of the login URL.  The settings for an IdP are
+    only built when someone logs in using it.
     """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.strip_prefix = self.settings.setdefault('strip_prefix', 'http://schemas.xmlsoap.org/claims/')
-        self.saml_acs_uri = self.settings.setdefault('saml_acs_uri', f'/multipass/saml/{self.name}/acs')
-        self.saml_sls_uri = self.settings.setdefault('saml_sls_uri', f'/multipass/saml/{self.name}/sls')
-        self.saml_metadata_uri = self.settings.setdefault('saml_metadata_uri', f'/multipass/saml/{self.name}/metadata')
-        self.saml_acs_endpoint = f'_flaskmultipass_saml_acs_{self.name}'
-        self.saml_sls_endpoint = f'_flaskmultipass_saml_sls_{self.name}'
-        self.saml_metadata_endpoint = f'_flaskmultipass_saml_metadata_{self.name}'
+        routes = self._get_routes(self.name, self.settings)
+        self.saml_acs_uri, self.saml_acs_endpoint = routes['acs']
+        self.saml_sls_uri, self.saml_sls_endpoint = routes['sls']
+        self.saml_metadata_uri, self.saml_metadata_endpoint = routes['metadata']
+        self.settings.update(saml_acs_uri=self.saml_acs_uri, saml_sls_uri=self.saml_sls_uri,
+                             saml_metadata_uri=self.saml_metadata_uri)
         self.use_friendly_names = self.settings.get('saml_friendly_names', False)
-        current_app.add_url_rule(self.saml_acs_uri, self.saml_acs_endpoint, self._saml_acs, methods=('GET', 'POST'))
-        current_app.add_url_rule(self.saml_sls_uri, self.saml_sls_endpoint, self._saml_sls, methods=('GET', 'POST'))
-        current_app.add_url_rule(self.saml_metadata_uri, self.saml_metadata_endpoint, self._saml_metadata)
+        # parsing and validating the settings is expensive, so we only do it once per
+        # set of ACS/SLS URLs (which depend on the host/scheme used to access the app)
+        self.federation = None
+        if federation_settings := self.settings.get('saml_federation'):
+            self.federation = _FederationMetadataStore(self.name, federation_settings)
+        settings_ttl = min(86400, self.federation.refresh_interval) if self.federation else 86400
+        self._saml_settings_cache = TTLCache(ttl=settings_ttl, max_size=1000)
+        self.saml_metadata_max_age = self.settings.get('saml_metadata_max_age', 86400)
+        self._saml_metadata_cache = TTLCache(ttl=self.saml_metadata_max_age, max_size=100)
+
+    @staticmethod
+    def _get_routes(name, settings):
+        """Get the URIs and endpoint names of the SAML views.
+
+        :return: A dict mapping ``acs``, ``sls`` and ``metadata`` to
+                 ``(uri, endpoint)`` tuples.
+        """
+        return {view: (settings.get(f'saml_{view}_uri', f'/multipass/saml/{name}/{view}'),
+                       f'_flaskmultipass_saml_{view}_{name}')
+                for view in ('acs', 'sls', 'metadata')}
+
+    @classmethod
+    def get_url_rules(cls, name, settings):
+        routes = cls._get_routes(name, settings)
+        return [
+            (*routes['acs'], '_saml_acs', ('GET', 'POST')),
+            (*routes['sls'], '_saml_sls', ('GET', 'POST')),
+            (*routes['metadata'], '_saml_metadata', ('GET',)),
+        ]
 
     @property
     def saml_config(self):
@@ -53,8 +306,8 @@ class SAMLAuthProvider(AuthProvider):
             'lowercase_urlencoding': self.settings.get('lowercase_urlencoding', False),
         }
 
-    def _init_saml_auth(self):
-        config = dict(self.saml_config)
+    def _build_saml_config(self, acs_url, sls_url):
+        config = copy.deepcopy(self.saml_config)
         config.setdefault('strict', True)
         config.setdefault('debug', False)
         idp_config = config.setdefault('idp', {})
@@ -75,19 +328,73 @@ class SAMLAuthProvider(AuthProvider):
         config['sp'].setdefault('NameIDFormat', 'urn:oasis:names:tc:SAML:2.0:nameid-format:persistent')
         acs_config = config['sp'].setdefault('assertionConsumerService', {})
         acs_config.setdefault('binding', 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST')
-        acs_config['url'] = url_for(self.saml_acs_endpoint, _external=True)
+        acs_config['url'] = acs_url
         slo_config = config['sp'].get('singleLogoutService')
         if slo_config is not None:
             slo_config.setdefault('binding', 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect')
-            slo_config['url'] = url_for(self.saml_sls_endpoint, _external=True)
+            slo_config['url'] = sls_url
+        return config
+
+    def _get_saml_settings(self, entity_id=None):
+        acs_url = url_for(self.saml_acs_endpoint, _external=True)
+        sls_url = url_for(self.saml_sls_endpoint, _external=True)
+        cache_key = (entity_id, acs_url, sls_url)
+        saml_settings = self._saml_settings_cache.get(cache_key)
+        if saml_settings is None:
+            config = self._build_saml_config(acs_url, sls_url)
+            if entity_id is not None:
+                idp_metadata = self.federation.get_metadata(entity_id)
+                if idp_metadata is None:
+                    raise AuthenticationFailed('Unknown identity provider', provider=self)
+                config['idp'] = {}
+                idp_data = OneLogin_Saml2_IdPMetadataParser.parse(idp_metadata, entity_id=entity_id)
+                config = OneLogin_Saml2_IdPMetadataParser.merge_settings(config, idp_data)
+            saml_settings = OneLogin_Saml2_Settings(config)
+            self._saml_settings_cache.set(cache_key, saml_settings)
+        return saml_settings
+
+    def _init_saml_auth(self, entity_id=None):
+        if entity_id is None and self.federation is not None:
+            entity_id = multipass_session.get(self._make_session_key('idp'))
         req = self._prepare_flask_request()
-        return OneLogin_Saml2_Auth(req, config)
+        return OneLogin_Saml2_Auth(req, self._get_saml_settings(entity_id))
+
+    def search_idps(self, query=None, limit=50):
+        """Searches the IdPs of the federation.
+
+        This is useful to show a list of IdPs the user can choose from.
+
+        :param query: A string contained in the name or entity ID of
+                      the IdPs.
+        :param limit: The max number of IdPs to return.
+        :return: A list of ``(entity_id, name)`` tuples.
+        """
+        if self.federation is None:
+            raise RuntimeError('This provider does not use a SAML federation')
+        return self.federation.search(query, limit=limit)
 
     def _make_session_key(self, name):
         return f'_flaskmultipass_saml_{self.name}_{name}'
 
     def initiate_external_login(self):
-        auth = self._init_saml_auth()
+        if self.federation is None:
+            auth = self._init_saml_auth()
+            return redirect(auth.login())
+        entity_id = request.args.get('idp')
+        if not entity_id:
+            discovery_url = self.settings['saml_federation'].get('discovery_url')
+            if not discovery_url:
+                exc = AuthenticationFailed('No identity provider selected', provider=self)
+                return self.multipass.handle_auth_error(exc, True)
+            return_url = url_for(current_app.config['MULTIPASS_LOGIN_ENDPOINT'], provider=self.name, _external=True)
+            sp_entity_id = self.saml_config['sp']['entityId']
+            query = urlencode({'entityID': sp_entity_id, 'return': return_url, 'returnIDParam': 'idp'})
+            return redirect(f'{discovery_url}?{query}')
+        try:
+            auth = self._init_saml_auth(entity_id)
+        except AuthenticationFailed as exc:
+            return self.multipass.handle_auth_error(exc, True)
+        multipass_session[self._make_session_key('idp')] = entity_id
         return redirect(auth.login())
 
     def process_logout(self, return_url):
@@ -95,11 +402,11 @@ class SAMLAuthProvider(AuthProvider):
         if auth.get_slo_url() is None:
             return None
         name_id = session_index = name_id_format = name_id_nq = name_id_spnq = None
-        name_id = session.get(self._make_session_key('name_id'), None)
-        name_id_format = session.get(self._make_session_key('name_id_format'), None)
-        name_id_nq = session.get(self._make_session_key('name_id_nq'), None)
-        name_id_spnq = session.get(self._make_session_key('name_id_spnq'), None)
-        session_index = session.get(self._make_session_key('session_index'), None)
+        name_id = multipass_session.get(self._make_session_key('name_id'), None)
+        name_id_format = multipass_session.get(self._make_session_key('name_id_format'), None)
+        name_id_nq = multipass_session.get(self._make_session_key('name_id_nq'), None)
+        name_id_spnq = multipass_session.get(self._make_session_key('name_id_spnq'), None)
+        session_index = multipass_session.get(self._make_session_key('session_index'), None)
         return redirect(auth.logout(name_id=name_id, session_index=session_index, nq=name_id_nq,
                                     name_id_format=name_id_format, spnq=name_id_spnq,
                                     return_to=return_url))
@@ -113,7 +420,7 @@ class SAMLAuthProvider(AuthProvider):
         session_key_name_id_nq = self._make_session_key('name_id_nq')
         session_key_name_id_spnq = self._make_session_key('name_id_spnq')
         session_key_session_index = self._make_session_key('session_index')
-        request_id = session.get(session_key_request_id)
+        request_id = multipass_session.get(session_key_request_id)
         auth.process_response(request_id=request_id)
         errors = auth.get_errors()
         if errors:
@@ -121,12 +428,12 @@ class SAMLAuthProvider(AuthProvider):
             if auth.get_settings().is_debug_active():
                 error_reason += f' ({auth.get_last_error_reason()})'
             raise AuthenticationFailed(error_reason)
-        session.pop(session_key_request_id, None)
-        session[session_key_name_id] = saml_nameid = auth.get_nameid()
-        session[session_key_name_id_format] = auth.get_nameid_format()
-        session[session_key_name_id_nq] = saml_nameid_nq = auth.get_nameid_nq()
-        session[session_key_name_id_spnq] = saml_nameid_spnq = auth.get_nameid_spnq()
-        session[session_key_session_index] = auth.get_session_index()
+        multipass_session.pop(session_key_request_id, None)
+        multipass_session[session_key_name_id] = saml_nameid = auth.get_nameid()
+        multipass_session[session_key_name_id_format] = auth.get_nameid_format()
+        multipass_session[session_key_name_id_nq] = saml_nameid_nq = auth.get_nameid_nq()
+        multipass_session[session_key_name_id_spnq] = saml_nameid_spnq = auth.get_nameid_spnq()
+        multipass_session[session_key_session_index] = auth.get_session_index()
 
         attributes = auth.get_friendlyname_attributes() if self.use_friendly_names else auth.get_attributes()
         if self.strip_prefix:
@@ -146,8 +453,12 @@ class SAMLAuthProvider(AuthProvider):
     def _saml_sls(self):
         auth = self._init_saml_auth()
         session_key_logout_request_id = self._make_session_key('logout_request_id')
-        request_id = session.get(session_key_logout_request_id)
-        dscb = lambda: session.clear()
+        request_id = multipass_session.get(session_key_logout_request_id)
+
+        def dscb():
+            multipass_session.clear()
+            session.clear()
+
         url = auth.process_slo(request_id=request_id, delete_session_cb=dscb)
         errors = auth.get_errors()
         if errors:
@@ -160,17 +471,36 @@ class SAMLAuthProvider(AuthProvider):
         else:
             return redirect(auth.redirect_to(request.form.get('RelayState', '/')))
 
-    def _saml_metadata(self):
-        auth = self._init_saml_auth()
-        settings = auth.get_settings()
-        metadata = settings.get_sp_metadata()
-        errors = settings.validate_metadata(metadata)
+    def _get_sp_metadata(self):
+        """Get the (cached) SP metadata.
 
+        :return: A tuple containing the metadata, a list of validation
+                 errors, the ETag of the metadata and the time (as
+                 returned by :func:`time.monotonic`) when it expires.
+        """
+        saml_settings = self._get_saml_settings()
+        cached = self._saml_metadata_cache.get(id(saml_settings))
+        if cached is not None and cached[0] is saml_settings:
+            return cached[1:]
+        metadata = saml_settings.get_sp_metadata()
+        errors = saml_settings.validate_metadata(metadata)
+        if isinstance(metadata, str):
+            metadata = metadata.encode()
+        etag = hashlib.sha256(metadata).hexdigest()
+        expires = time.monotonic() + self.saml_metadata_max_age
+        self._saml_metadata_cache.set(id(saml_settings), (saml_settings, metadata, errors, etag, expires))
+        return metadata, errors, etag, expires
+
+    def _saml_metadata(self):
+        metadata, errors, etag, expires = self._get_sp_metadata()
         if errors:
             return make_response(', '.join(errors), 500)
         resp = make_response(metadata, 200)
         resp.headers['Content-Type'] = 'text/xml'
-        return resp
+        resp.set_etag(etag)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = max(0, int(expires - time.monotonic()))
+        return resp.make_conditional(request)
 
 
 class SAMLIdentityProvider(IdentityProvider):
@@ -6,7 +6,7 @@
 
 from urllib.parse import quote
 
-from flask import current_app, redirect, request, url_for
+from flask import redirect, request, url_for
 
 from flask_multipass.auth import AuthProvider
 from flask_multipass.data import AuthInfo, IdentityInfo
@@ -38,8 +38,13 @@ class ShibbolethAuthProvider(AuthProvider):
             raise MultipassException('`callback_uri` must be specified in the provider settings', provider=self)
         self.from_headers = self.settings.get('from_headers', False)
         self.shibboleth_endpoint = '_flaskmultipass_shibboleth_' + self.name
-        current_app.add_url_rule(self.settings['callback_uri'], self.shibboleth_endpoint,
-                                 self._shibboleth_callback, methods=('GET', 'POST'))
+
+    @classmethod
+    def get_url_rules(cls, name, settings):
+        if not settings.get('callback_uri'):
+            return ()
+        return [(settings['callback_uri'], '_flaskmultipass_shibboleth_' + name, '_shibboleth_callback',
+                 ('GET', 'POST'))]
 
     def initiate_external_login(self):
         return redirect(url_for(self.shibboleth_endpoint))
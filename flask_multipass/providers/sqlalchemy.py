@@ -5,11 +5,20 @@
 # and/or modify it under the terms of the Revised BSD License.
 
 from flask_wtf import FlaskForm
-from sqlalchemy import inspect
+from sqlalchemy import inspect, or_
+from sqlalchemy.orm import contains_eager
 from wtforms.fields import PasswordField, StringField
 from wtforms.validators import DataRequired
 
 from flask_multipass import AuthInfo, AuthProvider, IdentityInfo, IdentityProvider, InvalidCredentials, NoSuchUser
+from flask_multipass.util import resolve_search_match
+
+#: Collations which sort strings like Python does (by code point)
+_binary_collations = {'sqlite': 'binary', 'postgresql': 'C', 'mysql': 'utf8mb4_bin', 'mariadb': 'utf8mb4_bin'}
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
 
 class LoginForm(FlaskForm):
@@ -71,6 +80,12 @@ class SQLAlchemyIdentityProviderBase(IdentityProvider):
     The provider returns all columns from the user model; use the
     configurable mapping to restrict the data returned.
 
+    Getting and refreshing identities is available if
+    :attr:`identity_model`, :attr:`provider_column` and
+    :attr:`identifier_column` are set.  Searching is available if
+    :attr:`search_columns` is set as well.  All filtering, limiting and
+    counting is done by the database.
+
     To use it, you have to subclass it in your application.
     """
 
@@ -81,19 +96,124 @@ class SQLAlchemyIdentityProviderBase(IdentityProvider):
     identity_user_relationship = None
     #: The Flask-SQLAlchemy model representing a user.
     user_model = None
-    #: Getting an identity based on the identifier does not make lots
-    #: of sense for identities coming from the local database.
-    supports_get = False
+    #: The Flask-SQLAlchemy model representing a user identity.  Only
+    #: needed to get, refresh or search identities.
+    identity_model = None
+    #: The column of the identity model that contains the provider
+    #: name, e.g. ``Identity.provider``
+    provider_column = None
+    #: The column of the identity model that contains the identifier,
+    #: e.g. ``Identity.identifier``
+    identifier_column = None
+    #: A dict mapping search criteria (after applying the provider's
+    #: mapping) to the columns of the user model they are matched
+    #: against, e.g. ``{'email': User.email, 'name': User.name}``
+    search_columns = None
+    #: If the provider supports refreshing identity information.  This
+    #: is disabled unless the identity model and columns are set.
+    supports_refresh = True
+    #: If the provider supports getting identity information based from
+    #: an identifier.  This is disabled unless the identity model and
+    #: columns are set.
+    supports_get = True
+    #: If the provider supports searching identities.  This is disabled
+    #: unless :attr:`search_columns` is set.
+    supports_search = True
+    #: If the provider supports the extended identity search feature
+    supports_search_ex = True
+    #: If the provider supports searching with ``match='prefix'``
+    supports_prefix_search = True
+    #: The collation used to order search results by
+    #: :attr:`identifier_column`, so they are sorted like Python sorts
+    #: strings and :meth:`.Multipass.search_identities_top` can let the
+    #: database apply its limit.  A binary collation is used by default
+    #: on SQLite, PostgreSQL and MySQL/MariaDB; on other databases the
+    #: collation of the column is used unless this is set.
+    identifier_collation = None
+
+    def __init__(self, *args, **kwargs):
+        cls = type(self)
+        if cls.identity_model is None or cls.provider_column is None or cls.identifier_column is None:
+            self.supports_get = self.supports_refresh = self.supports_search = self.supports_search_ex = False
+        elif not cls.search_columns:
+            self.supports_search = self.supports_search_ex = False
+        super().__init__(*args, **kwargs)
 
-    def get_identity_from_auth(self, auth_info):
+    @property
+    def search_order(self):
+        return 'identifier' if self.supports_search and self._get_identifier_collation() else None
+
+    def _get_identifier_collation(self):
+        cls = type(self)
+        if cls.identifier_collation is not None:
+            return cls.identifier_collation
+        dialect = cls.identity_model.query.session.get_bind().dialect
+        return _binary_collations.get(dialect.name)
+
+    @property
+    def _relationship_name(self):
         cls = type(self)
-        identity = auth_info.data['identity']
         if isinstance(cls.identity_user_relationship, str):
-            relationship_name = cls.identity_user_relationship
-        else:
-            relationship_name = cls.identity_user_relationship.key
-        user = getattr(identity, relationship_name)
+            return cls.identity_user_relationship
+        return cls.identity_user_relationship.key
+
+    def _make_identity_info(self, identity):
+        user = getattr(identity, self._relationship_name)
         # Get all columns from the user model
         mapper = inspect(self.user_model)
         data = {x.key: getattr(user, x.key) for x in mapper.attrs}
         return IdentityInfo(self, identity.identifier, **data)
+
+    def _query_identities(self):
+        cls = type(self)
+        relationship = getattr(cls.identity_model, self._relationship_name)
+        return (cls.identity_model.query
+                .join(relationship)
+                .options(contains_eager(relationship))
+                .filter(cls.provider_column == self.name))
+
+    def _build_search_query(self, criteria, match):
+        query = self._query_identities()
+        for key, values in criteria.items():
+            column = self.search_columns.get(key)
+            if column is None:
+                # criterion cannot be matched by this provider
+                return None
+            if match == 'exact':
+                query = query.filter(column.in_(values))
+            elif match == 'prefix':
+                query = query.filter(or_(*(column.ilike(f'{_escape_like(v)}%', escape='\\') for v in values)))
+            else:
+                query = query.filter(or_(*(column.ilike(f'%{_escape_like(v)}%', escape='\\') for v in values)))
+        identifier_column = type(self).identifier_column
+        if collation := self._get_identifier_collation():
+            identifier_column = identifier_column.collate(collation)
+        return query.order_by(identifier_column)
+
+    def get_identity_from_auth(self, auth_info):
+        return self._make_identity_info(auth_info.data['identity'])
+
+    def refresh_identity(self, identifier, multipass_data):
+        return self.get_identity(identifier)
+
+    def get_identity(self, identifier):
+        identity = self._query_identities().filter(type(self).identifier_column == identifier).first()
+        if identity is None:
+            return None
+        return self._make_identity_info(identity)
+
+    def search_identities(self, criteria, exact=False, match=None):
+        query = self._build_search_query(criteria, resolve_search_match(exact, match))
+        if query is None:
+            return
+        for identity in query:
+            yield self._make_identity_info(identity)
+
+    def search_identities_ex(self, criteria, exact=False, limit=None, match=None):
+        query = self._build_search_query(criteria, resolve_search_match(exact, match))
+        if query is None:
+            return [], 0
+        total = query.order_by(None).count()
+        if limit is not None:
+            query = query.limit(limit)
+        return [self._make_identity_info(identity) for identity in query], total
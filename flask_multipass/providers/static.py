@@ -16,6 +16,13 @@ from flask_multipass.data import AuthInfo, IdentityInfo
 from flask_multipass.exceptions import InvalidCredentials, NoSuchUser
 from flask_multipass.group import Group
 from flask_multipass.identity import IdentityProvider
+from flask_multipass.util import resolve_search_match
+
+_compare_funcs = {
+    'contains': operator.contains,
+    'exact': operator.eq,
+    'prefix': str.startswith,
+}
 
 
 class StaticLoginForm(FlaskForm):
@@ -62,6 +69,12 @@ class StaticGroup(Group):
     def has_member(self, identifier):
         return identifier in self.provider.settings['groups'][self.name]
 
+    def has_members(self, identifiers):
+        return set(identifiers) & set(self.provider.settings['groups'][self.name])
+
+    def _count_members(self):
+        return len(set(self.provider.settings['groups'][self.name]))
+
 
 class StaticIdentityProvider(IdentityProvider):
     """Provides identity information from a static list.
@@ -76,12 +89,16 @@ class StaticIdentityProvider(IdentityProvider):
     supports_refresh = True
     #: If the provider supports searching identities
     supports_search = True
+    #: If the provider supports searching with ``match='prefix'``
+    supports_prefix_search = True
     #: If the provider also provides groups and membership information
     supports_groups = True
     #: If the provider supports getting the list of groups an identity belongs to
     supports_get_identity_groups = True
     #: The class that represents groups from this provider
     group_class = StaticGroup
+    #: Search results are sorted by identifier
+    search_order = 'identifier'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -104,17 +121,21 @@ class StaticIdentityProvider(IdentityProvider):
     def get_identity(self, identifier):
         return self._get_identity(identifier)
 
-    def search_identities(self, criteria, exact=False):
-        for identifier, user in self.settings['identities'].items():
+    def search_identities(self, criteria, exact=False, match=None):
+        match = resolve_search_match(exact, match)
+        for identifier, user in sorted(self.settings['identities'].items()):
             for key, values in criteria.items():
                 # same logic as multidict
                 user_value = user.get(key)
                 user_values = set(user_value) if isinstance(user_value, (tuple, list)) else {user_value}
                 if not any(user_values):
                     break
-                elif exact and not user_values & set(values):
+                elif match == 'exact' and not user_values & set(values):
+                    break
+                elif match == 'prefix' and not any(uv.startswith(sv)
+                                                   for sv, uv in itertools.product(values, user_values)):
                     break
-                elif not exact and not any(sv in uv for sv, uv in itertools.product(values, user_values)):
+                elif match == 'contains' and not any(sv in uv for sv, uv in itertools.product(values, user_values)):
                     break
             else:
                 yield IdentityInfo(self, identifier, **user)
@@ -132,8 +153,8 @@ class StaticIdentityProvider(IdentityProvider):
             return None
         return self.group_class(self, name)
 
-    def search_groups(self, name, exact=False):
-        compare = operator.eq if exact else operator.contains
+    def search_groups(self, name, exact=False, match=None):
+        compare = _compare_funcs[resolve_search_match(exact, match)]
         for group_name in self.settings['groups']:
             if compare(group_name, name):
                 yield self.group_class(self, group_name)
@@ -0,0 +1,224 @@
+# This file is part of Flask-Multipass.
+# Copyright (C) 2015 - 2021 CERN
+#
+# Flask-Multipass is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import json
+import secrets
+import sqlite3
+import time
+from collections.abc import MutableMapping
+
+from flask import current_app, g, has_request_context, session
+from werkzeug.local import LocalProxy
+
+from flask_multipass.util import TTLCache
+
+#: The key of the Flask session containing the handle of the server-side data
+SESSION_HANDLE_KEY = '_multipass_session'
+
+
+class SessionStore:
+    """Base class for server-side stores of the multipass session data.
+
+    The data of each session is a dict which only contains JSON-serializable
+    values.  Subclasses must implement all methods of this class.
+    """
+
+    def load(self, handle):  # pragma: no cover
+        """Loads the data of a session.
+
+        :param handle: The handle identifying the session.
+        :return: A dict or ``None`` if there is no (unexpired) data.
+        """
+        raise NotImplementedError
+
+    def save(self, handle, data, ttl):  # pragma: no cover
+        """Saves the data of a session.
+
+        :param handle: The handle identifying the session.
+        :param data: A dict containing the data.
+        :param ttl: The time in seconds after which the data expires.
+        """
+        raise NotImplementedError
+
+    def delete(self, handle):  # pragma: no cover
+        """Deletes the data of a session.
+
+        :param handle: The handle identifying the session.
+        """
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """Stores multipass session data in memory.
+
+    The data is only available within the same process, so this store
+    is only suitable for applications running in a single process.
+
+    :param max_size: The maximum number of sessions to keep.
+    """
+
+    def __init__(self, max_size=10000):
+        self._cache = TTLCache(ttl=86400, max_size=max_size)
+
+    def load(self, handle):
+        data = self._cache.get(handle)
+        return json.loads(data) if data is not None else None
+
+    def save(self, handle, data, ttl):
+        self._cache.set(handle, json.dumps(data), ttl=ttl)
+
+    def delete(self, handle):
+        self._cache.delete(handle)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Stores multipass session data in an SQLite database.
+
+    The database file can be shared by all processes running on the same
+    machine.
+
+    :param path: The path of the database file.
+    :param timeout: The time in seconds to wait for a locked database.
+    """
+
+    #: The probability of deleting all expired sessions when saving data
+    purge_probability = 0.01
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS multipass_sessions '
+                         '(handle TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def load(self, handle):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT data FROM multipass_sessions WHERE handle = ? AND expires > ?',
+                               (handle, time.time())).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row else None
+
+    def save(self, handle, data, ttl):
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO multipass_sessions VALUES (?, ?, ?)',
+                             (handle, json.dumps(data), now + ttl))
+                if secrets.randbelow(10000) < self.purge_probability * 10000:
+                    conn.execute('DELETE FROM multipass_sessions WHERE expires <= ?', (now,))
+        finally:
+            conn.close()
+
+    def delete(self, handle):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM multipass_sessions WHERE handle = ?', (handle,))
+        finally:
+            conn.close()
+
+
+class _ServerSideSession(MutableMapping):
+    """A dict-like view of the multipass data in a :class:`SessionStore`.
+
+    Only an opaque handle is stored in the Flask session. Changes are
+    written to the store once at the end of the request (see
+    :meth:`save`), no matter how many keys have been changed.
+    """
+
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+        self.handle = None
+        self.data = {}
+        self.modified = False
+        self._sync()
+
+    def _sync(self):
+        handle = session.get(SESSION_HANDLE_KEY)
+        if handle != self.handle:
+            # new request, or the flask session has been cleared or replaced
+            self.handle = handle
+            self.data = (self.store.load(handle) if handle else None) or {}
+            self.modified = False
+
+    def _mark_modified(self):
+        if not self.handle and self.data:
+            # the handle must be in the flask session before it is saved
+            self.handle = session[SESSION_HANDLE_KEY] = secrets.token_urlsafe(32)
+        self.modified = True
+
+    def save(self):
+        """Writes the data to the store if it has been modified."""
+        if not self.modified:
+            return
+        self.modified = False
+        if self.data:
+            self.store.save(self.handle, self.data, self.ttl)
+        elif self.handle:
+            self.store.delete(self.handle)
+
+    def __getitem__(self, key):
+        self._sync()
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self._sync()
+        self.data[key] = value
+        self._mark_modified()
+
+    def __delitem__(self, key):
+        self._sync()
+        del self.data[key]
+        self._mark_modified()
+
+    def __iter__(self):
+        self._sync()
+        return iter(list(self.data))
+
+    def __len__(self):
+        self._sync()
+        return len(self.data)
+
+    def clear(self):
+        self._sync()
+        self.data = {}
+        self._mark_modified()
+
+
+def _get_multipass_session():
+    store = current_app.config['MULTIPASS_SESSION_STORE']
+    if store is None or not has_request_context():
+        return session
+    try:
+        return g._multipass_session
+    except AttributeError:
+        g._multipass_session = rv = _ServerSideSession(store, current_app.config['MULTIPASS_SESSION_STORE_TTL'])
+        return rv
+
+
+def save_multipass_session(response):
+    """Writes the changed server-side multipass session data to the store.
+
+    This is registered as an ``after_request`` function, so it runs
+    before the Flask session containing the handle is saved.
+    """
+    server_session = g.get('_multipass_session')
+    if server_session is not None:
+        server_session.save()
+    return response
+
+
+#: Proxy to the storage for the private data multipass needs to keep in
+#: the session.  This is the Flask session unless a server-side store has
+#: been set in ``MULTIPASS_SESSION_STORE``.
+multipass_session = LocalProxy(_get_multipass_session)
@@ -4,14 +4,28 @@
 # Flask-Multipass is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
+import os
 import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
 from importlib.metadata import entry_points as importlib_entry_points
 from inspect import getmro, isclass
 
 from flask import current_app
 
-from flask_multipass.exceptions import MultipassException
+from flask_multipass.exceptions import MultipassException, ProviderUnavailable
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # windows
+    fcntl = None
+
+#: The ways search criteria can be matched
+SEARCH_MATCH_MODES = ('contains', 'exact', 'prefix')
 
 
 def convert_app_data(app_data, mapping, key_filter=None):
@@ -64,6 +78,49 @@ def convert_provider_data(provider_data, mapping, key_filter=None):
     return result
 
 
+def resolve_search_match(exact=False, match=None):
+    """Determines how search criteria are matched.
+
+    :param exact: bool -- Match values exactly; this is the same as
+                  ``match='exact'``.
+    :param match: str -- One of ``'contains'`` (substring matching),
+                  ``'exact'`` or ``'prefix'``.  If ``None``, the mode
+                  is determined by `exact`.
+    :return: str -- The match mode.
+    """
+    if match is None:
+        return 'exact' if exact else 'contains'
+    if match not in SEARCH_MATCH_MODES:
+        raise ValueError(f'Invalid search match mode: {match}')
+    if exact and match != 'exact':
+        raise ValueError(f'`exact` cannot be used with match={match!r}')
+    return match
+
+
+def exact_match_first(criteria):
+    """Returns a sort key which puts identities matching criteria exactly first.
+
+    Identities are sorted by the number of criteria they do not match
+    exactly (ignoring case) and then by their identifier.
+
+    :param criteria: dict -- The search criteria.
+    :return: A function which can be used as the `key` of
+             :meth:`.Multipass.search_identities_top`.
+    """
+    def _casefold_values(value):
+        values = value if isinstance(value, (list, tuple, set, frozenset)) else (value,)
+        return {v.casefold() for v in values if isinstance(v, str)}
+
+    expected = {key: _casefold_values(value) for key, value in criteria.items()}
+
+    def _key(identity):
+        mismatches = sum(1 for key, values in expected.items()
+                         if not values & _casefold_values(identity.data.get(key)))
+        return mismatches, identity.identifier
+
+    return _key
+
+
 def get_canonical_provider_map(provider_map):
     """Converts the configured provider map to a canonical form."""
     canonical = {}
@@ -125,6 +182,55 @@ def login_view(func):
     return decorator
 
 
+class _EntryPointIndex:
+    """An index of the entry points in the provider groups.
+
+    Looking up entry points reads the metadata of every installed
+    distribution, so each group is only scanned once and the result is
+    kept until ``sys.path`` changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path = None
+        self._groups = {}
+
+    def get(self, group, name):
+        """Returns the list of entry points with a given group and name."""
+        path = tuple(sys.path)
+        with self._lock:
+            if path != self._path:
+                self._path = path
+                self._groups = {}
+            try:
+                index = self._groups[group]
+            except KeyError:
+                index = self._groups[group] = self._build(group)
+        return index.get(name, [])
+
+    def clear(self):
+        """Discards the index so it is rebuilt on the next lookup."""
+        with self._lock:
+            self._path = None
+            self._groups = {}
+
+    @staticmethod
+    def _build(group):
+        if sys.version_info < (3, 10):
+            entry_points = importlib_entry_points().get(group, [])
+        else:
+            entry_points = importlib_entry_points(group=group)
+        index = {}
+        for ep in entry_points:
+            entries = index.setdefault(ep.name, [])
+            if ep not in entries:
+                entries.append(ep)
+        return index
+
+
+_entry_point_index = _EntryPointIndex()
+
+
 def resolve_provider_type(base, type_, registry=None):
     """Resolves a provider type to its class.
 
@@ -145,17 +251,13 @@ def resolve_provider_type(base, type_, registry=None):
     if registry is not None and type_ in registry:
         cls = registry[type_]
     else:
-        if sys.version_info < (3, 10):
-            entry_points = {ep for ep in importlib_entry_points().get(base._entry_point, []) if ep.name == type_}
-        else:
-            entry_points = importlib_entry_points(group=base._entry_point, name=type_)
+        entry_points = _entry_point_index.get(base._entry_point, type_)
         if not entry_points:
             raise ValueError('Unknown type: ' + type_)
         elif len(entry_points) != 1:
             defs = ', '.join(ep.module for ep in entry_points)
             raise RuntimeError(f'Type {type_} is not unique. Defined in {defs}')
-        entry_point = list(entry_points)[0]
-        cls = entry_point.load()
+        cls = entry_points[0].load()
     if not issubclass(cls, base):
         raise TypeError(f'Found a class {cls} which is not a subclass of {base}')
     return cls
@@ -175,6 +277,336 @@ def validate_provider_map(state):
         raise ValueError('Broken identity provider links: ' + ', '.join(invalid_keys))
 
 
+class FileLock:
+    """An exclusive lock shared by all processes using the same file.
+
+    The lock is held using :func:`fcntl.flock`, so it is released
+    automatically if the process holding it dies.  On platforms without
+    :mod:`fcntl` it only works within the current process.
+
+    :param path: The path of the lock file; it is created if needed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        """Acquires the lock.
+
+        :param blocking: Whether to wait until the lock is available.
+        :return: ``True`` if the lock was acquired, ``False`` if it is held
+                 by someone else and `blocking` is disabled.
+        """
+        if not self._lock.acquire(blocking):
+            return False
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        except BaseException:
+            self._lock.release()
+            raise
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BaseException as exc:
+                os.close(fd)
+                self._lock.release()
+                if isinstance(exc, BlockingIOError):
+                    return False
+                raise
+        self._fd = fd
+        return True
+
+    def release(self):
+        """Releases the lock."""
+        fd, self._fd = self._fd, None
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class TTLCache:
+    """A small thread-safe cache whose entries expire after some time.
+
+    :param ttl: The default time in seconds after which an entry expires.
+    :param max_size: The maximum number of entries; the oldest ones are
+                     evicted once it is exceeded.
+    """
+
+    def __init__(self, ttl, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the cached value for `key` unless it has expired."""
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Caches a value.
+
+        :param key: The cache key.
+        :param value: The value to cache.
+        :param ttl: The time in seconds after which the entry expires.
+                    Defaults to the cache's TTL.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.monotonic() + ttl, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Removes an entry from the cache."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Removes all entries from the cache."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CircuitBreaker:
+    """Keeps track of the health of a provider.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    no calls to the provider should be made.  Once `reset_timeout`
+    seconds have passed, it becomes half-open and lets up to
+    `half_open_max_calls` probe calls through; if they succeed it is
+    closed again, otherwise it opens for another `reset_timeout`.
+
+    Only exceptions indicating that the provider itself is broken count
+    as failures, i.e. :exc:`.ProviderUnavailable` and any exception
+    which is not a :exc:`.MultipassException`.
+
+    :param name: The name of the provider.
+    :param failure_threshold: The number of consecutive failures after
+                              which the breaker opens. If ``None``, it
+                              never opens but still tracks failures.
+    :param reset_timeout: The time in seconds after which an open
+                          breaker becomes half-open.
+    :param half_open_max_calls: The number of concurrent probe calls
+                                allowed while half-open.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=None, reset_timeout=30, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._probes = 0
+        self._consecutive_failures = 0
+        self._total_failures = 0
+        self._last_error = None
+
+    @property
+    def state(self):
+        """The current state of the breaker."""
+        with self._lock:
+            return self._get_state()
+
+    def _get_state(self):
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    @property
+    def health(self):
+        """A dict describing the health of the provider."""
+        with self._lock:
+            state = self._get_state()
+            retry_in = None
+            if state == self.OPEN:
+                retry_in = max(0, self.reset_timeout - (time.monotonic() - self._opened_at))
+            return {
+                'state': state,
+                'consecutive_failures': self._consecutive_failures,
+                'total_failures': self._total_failures,
+                'last_error': self._last_error,
+                'retry_in': retry_in,
+            }
+
+    def allow_request(self):
+        """Checks if the provider may be called.
+
+        While half-open, a successful check reserves one of the probe
+        calls, so the call must be tracked using :meth:`track`.
+        """
+        with self._lock:
+            state = self._get_state()
+            if state == self.CLOSED:
+                return True
+            elif state == self.HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return True
+            return False
+
+    def record_success(self):
+        """Records a successful call."""
+        with self._lock:
+            self._consecutive_failures = 0
+            if self._state == self.HALF_OPEN:
+                self._state = self.CLOSED
+
+    def record_failure(self, exc=None):
+        """Records a failed call.
+
+        :param exc: The exception raised by the provider.
+        """
+        with self._lock:
+            self._consecutive_failures += 1
+            self._total_failures += 1
+            self._last_error = str(exc) if exc is not None else None
+            if self._state == self.HALF_OPEN or (self.failure_threshold is not None and
+                                                 self._consecutive_failures >= self.failure_threshold):
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def _release(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def is_failure(self, exc, provider=None):
+        """Checks if an exception counts as a failure of the provider.
+
+        :param exc: The exception raised while calling the provider.
+        :param provider: The provider the breaker belongs to.  If set, a
+                         :exc:`.ProviderUnavailable` only counts if it was
+                         raised for this very provider instance, so e.g. an
+                         auth and an identity provider with the same name
+                         are told apart.
+        """
+        if isinstance(exc, ProviderUnavailable):
+            # failures of another provider used by this one do not count
+            if provider is not None:
+                return exc.provider is provider
+            return exc.provider is None or getattr(exc.provider, 'name', None) == self.name
+        return not isinstance(exc, MultipassException)
+
+    @contextmanager
+    def track(self, provider=None):
+        """Records the outcome of the calls made within the context.
+
+        :param provider: The provider being called, see :meth:`is_failure`.
+                         A :exc:`.ProviderUnavailable` raised without a
+                         provider is attributed to it, so calls tracked
+                         further up the stack (e.g. of an auth provider
+                         which triggered an identity lookup) do not count
+                         it as their own failure.
+        """
+        try:
+            yield
+        except Exception as exc:
+            if provider is not None and isinstance(exc, ProviderUnavailable) and exc.provider is None:
+                exc.provider = provider
+            if self.is_failure(exc, provider):
+                self.record_failure(exc)
+            elif isinstance(exc, ProviderUnavailable):
+                self._release()
+            else:
+                self.record_success()
+            raise
+        except BaseException:
+            # e.g. a generator that has not been consumed completely
+            self._release()
+            raise
+        else:
+            self.record_success()
+
+
+class _Flight:
+    __slots__ = ('done', 'exception', 'result')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key.
+
+    While a call for a key is in flight, any other call with the same key
+    waits for it to finish and gets the same result or exception instead
+    of running the function again.  Nothing is cached once the call has
+    finished.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    @property
+    def in_flight(self):
+        """The number of calls currently in flight."""
+        with self._lock:
+            return len(self._flights)
+
+    def call(self, key, func, *args, **kwargs):
+        """Calls a function unless a call with the same key is in flight.
+
+        :param key: A hashable key identifying the call.
+        :param func: The function to call.
+        :param args: Positional arguments passed to the function.
+        :param kwargs: Keyword arguments passed to the function.
+        :return: The return value of the function.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result
+        try:
+            flight.result = func(*args, **kwargs)
+        except BaseException as exc:
+            flight.exception = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+
 class classproperty(property):  # noqa: N801
     """Like a :class:`property`, but for a class.
 
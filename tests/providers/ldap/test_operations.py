@@ -4,19 +4,25 @@
 # Flask-Multipass is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
+import threading
 from unittest.mock import MagicMock
 
+import ldap
 import pytest
 from ldap import NO_SUCH_OBJECT, SCOPE_BASE
+from ldap.controls import SimplePagedResultsControl
 
-from flask_multipass.exceptions import GroupRetrievalFailed, IdentityRetrievalFailed
+from flask_multipass.exceptions import GroupRetrievalFailed, IdentityRetrievalFailed, MultipassException
 from flask_multipass.providers.ldap.operations import (
     get_group_by_id,
+    get_group_member_dns,
     get_token_groups_from_user_dn,
     get_user_by_id,
+    read_entries,
     search,
+    search_subtrees,
 )
-from flask_multipass.providers.ldap.util import ldap_context
+from flask_multipass.providers.ldap.util import _get_connection_key, get_server_pool, ldap_context
 
 
 def test_get_user_by_id_handles_none_id():
@@ -104,6 +110,110 @@ def test_search_none_existing_entry(mocker, settings, base_dn, search_filter, at
             pytest.fail('search should not yield any result')
 
 
+class FakePagedConnection:
+    """Serves two pages of results for each base DN."""
+
+    unbound = False
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def search_ext(self, base_dn, scope, filterstr, attrlist, serverctrls, timeout):
+        return base_dn, int(serverctrls[0].cookie or 0)
+
+    def result3(self, msg_id, timeout):
+        base_dn, page = msg_id
+        if base_dn.startswith('ou=missing'):
+            raise NO_SUCH_OBJECT
+        entries = [(f'uid=user{page}{i},{base_dn}', {'mail': [f'user{page}{i}@{base_dn}']}) for i in range(2)]
+        cookie = str(page + 1) if page == 0 else ''
+        return None, entries, None, [SimplePagedResultsControl(True, size=2, cookie=cookie)]
+
+    def unbind_s(self):
+        self.unbound = True
+
+    def __getattr__(self, name):
+        return MagicMock()
+
+
+def test_search_subtrees(mocker):
+    settings = {
+        'uri': 'ldaps://ldap.example.com:636',
+        'bind_dn': 'uid=admin,DC=example,DC=com',
+        'bind_password': 'LemotdepassedeLDAP',
+        'verify_cert': False,
+        'starttls': False,
+        'timeout': 10,
+        'page_size': 2,
+    }
+    mocker.patch('flask_multipass.providers.ldap.util.ReconnectLDAPObject', side_effect=FakePagedConnection)
+    base_dns = ['ou=a,dc=example,dc=com', 'ou=missing,dc=example,dc=com', 'ou=b,dc=example,dc=com']
+    with ldap_context(settings):
+        results = list(search_subtrees(base_dns, '(objectCategory=user)', ['mail']))
+    expected = {f'uid=user{page}{i},{base_dn}' for base_dn in base_dns[::2] for page in range(2) for i in range(2)}
+    assert len(results) == len(expected)
+    assert {dn for dn, _data in results} == expected
+
+
+class ConcurrentPagedConnection(FakePagedConnection):
+    barrier = None
+    searches = 0
+
+    def search_ext(self, *args, **kwargs):
+        # only passes if both subtrees are searched at the same time
+        self.barrier.wait(timeout=5)
+        self.searches += 1
+        return super().search_ext(*args, **kwargs)
+
+
+def test_search_subtrees_reuses_connections(mocker):
+    settings = {
+        'uri': 'ldaps://pooled.example.com:636',
+        'bind_dn': 'uid=admin,DC=example,DC=com',
+        'bind_password': 'LemotdepassedeLDAP',
+        'verify_cert': False,
+        'starttls': False,
+        'timeout': 10,
+        'page_size': 2,
+    }
+    connections = []
+
+    def _connect(*args, **kwargs):
+        connections.append(ConcurrentPagedConnection())
+        return connections[-1]
+
+    mocker.patch('flask_multipass.providers.ldap.util.ReconnectLDAPObject', side_effect=_connect)
+    ConcurrentPagedConnection.barrier = threading.Barrier(2)
+    base_dns = ['ou=a,dc=example,dc=com', 'ou=b,dc=example,dc=com']
+    for __ in range(3):
+        with ldap_context(settings):
+            results = list(search_subtrees(base_dns, '(objectCategory=user)', ['mail']))
+        assert len(results) == 8
+    # each search uses one connection per subtree, but they are only created once
+    subtree_connections = [conn for conn in connections if conn.searches]
+    assert len(subtree_connections) == 2
+    assert [conn.searches for conn in subtree_connections] == [6, 6]
+    assert not any(conn.unbound for conn in subtree_connections)
+    idle = get_server_pool(settings)._idle_connections[_get_connection_key(settings)]
+    assert {id(conn) for conn in idle} == {id(conn) for conn in subtree_connections}
+
+
+def test_search_subtrees_error(mocker):
+    settings = {
+        'uri': 'ldaps://ldap.example.com:636',
+        'bind_dn': 'uid=admin,DC=example,DC=com',
+        'bind_password': 'LemotdepassedeLDAP',
+        'verify_cert': False,
+        'starttls': False,
+        'timeout': 10,
+        'page_size': 2,
+    }
+    mocker.patch('flask_multipass.providers.ldap.util.ReconnectLDAPObject', side_effect=FakePagedConnection)
+    mocker.patch.object(FakePagedConnection, 'result3', side_effect=ldap.SERVER_DOWN)
+    with ldap_context(settings), pytest.raises(MultipassException):
+        list(search_subtrees(['ou=a,dc=example,dc=com', 'ou=b,dc=example,dc=com'], '(objectCategory=user)', ['mail']))
+
+
 @pytest.mark.parametrize(('user_dn', 'mock_data', 'expected'), (
     ('cn=ielosubmarine,OU=Users,dc=example,dc=com',
      [('cn=ielosubmarine,OU=Users,dc=example,dc=com', {'tokenGroups': [f'token<{i}>' for i in range(5)]})],
@@ -147,3 +257,63 @@ def test_get_token_groups_from_user_dn(mocker, user_dn, mock_data, expected):
         # Token-Groups must be retrieved from a base scope query
         ldap_search.assert_called_once_with(user_dn, SCOPE_BASE, sizelimit=1, timeout=settings['timeout'],
                                             attrlist=['tokenGroups'])
+
+
+@pytest.mark.parametrize(('mock_data', 'expected_attrs', 'expected'), (
+    # OpenLDAP returns all values at once
+    ([[('cn=group', {'member': [b'uid=a', b'uid=b']})]],
+     ['member'],
+     [['uid=a', 'uid=b']]),
+    # Active Directory returns large attributes in ranges
+    ([[('cn=group', {'member': [], 'member;range=0-1': [b'uid=a', b'uid=b']})],
+      [('cn=group', {'member;range=2-3': [b'uid=c', b'uid=d']})],
+      [('cn=group', {'member;range=4-*': [b'uid=e']})]],
+     ['member', 'member;range=2-*', 'member;range=4-*'],
+     [['uid=a', 'uid=b'], ['uid=c', 'uid=d'], ['uid=e']]),
+    ([[('cn=group', {})]],
+     ['member'],
+     []),
+))
+def test_get_group_member_dns(mocker, mock_data, expected_attrs, expected):
+    settings = {
+        'uri': 'ldaps://ldap.example.com:636',
+        'bind_dn': 'uid=admin,DC=example,DC=com',
+        'bind_password': 'LemotdepassedeLDAP',
+        'verify_cert': False,
+        'starttls': False,
+        'timeout': 10,
+    }
+    ldap_search = MagicMock(side_effect=mock_data)
+    ldap_conn = MagicMock(search_ext_s=ldap_search)
+    mocker.patch('flask_multipass.providers.ldap.util.ReconnectLDAPObject', return_value=ldap_conn)
+    with ldap_context(settings):
+        assert list(get_group_member_dns('cn=group', 'member')) == expected
+    assert [c.kwargs['attrlist'] for c in ldap_search.call_args_list] == [[attr] for attr in expected_attrs]
+    assert all(c.args == ('cn=group', SCOPE_BASE) for c in ldap_search.call_args_list)
+
+
+def test_read_entries(mocker):
+    settings = {
+        'uri': 'ldaps://ldap.example.com:636',
+        'bind_dn': 'uid=admin,DC=example,DC=com',
+        'bind_password': 'LemotdepassedeLDAP',
+        'verify_cert': False,
+        'starttls': False,
+        'timeout': 10,
+        'page_size': 2,
+    }
+    entries = {'uid=a': [('uid=a', {'uid': [b'a']})], 'uid=b': [], 'uid=c': [('uid=c', {'uid': [b'c']})]}
+
+    def _result3(msg_id, timeout):
+        if msg_id == 'uid=d':
+            raise NO_SUCH_OBJECT
+        return None, entries[msg_id], None, []
+
+    ldap_conn = MagicMock(search_ext=MagicMock(side_effect=lambda dn, *args, **kwargs: dn),
+                          result3=MagicMock(side_effect=_result3))
+    mocker.patch('flask_multipass.providers.ldap.util.ReconnectLDAPObject', return_value=ldap_conn)
+    with ldap_context(settings):
+        results = read_entries(['uid=a', 'uid=b', 'uid=c', 'uid=d'], '(objectClass=person)', ['uid'])
+        assert list(results) == [('uid=a', {'uid': [b'a']}), ('uid=c', {'uid': [b'c']})]
+    assert [c.args for c in ldap_conn.search_ext.call_args_list] == [(dn, SCOPE_BASE) for dn in entries] + [
+        ('uid=d', SCOPE_BASE)]
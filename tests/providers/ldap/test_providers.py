@@ -12,7 +12,7 @@ from ldap import INVALID_CREDENTIALS
 
 from flask_multipass import Multipass
 from flask_multipass.exceptions import IdentityRetrievalFailed, InvalidCredentials, NoSuchUser
-from flask_multipass.providers.ldap import LDAPAuthProvider, LDAPGroup, LDAPIdentityProvider
+from flask_multipass.providers.ldap import LDAPAuthProvider, LDAPGroup, LDAPIdentityProvider, providers
 
 
 @pytest.mark.parametrize(('settings', 'data'), (
@@ -225,6 +225,194 @@ def test_get_members(mocker, settings, group_dn, mock_data, expected):
             assert member.identifier == expected.pop(0)
 
 
+def _make_member_attr_idp(mocker, member_lookup):
+    settings = {'ldap': {
+        'uri': 'ldaps://ldap.example.com:636',
+        'bind_dn': 'uid=admin,DC=example,DC=com',
+        'bind_password': 'LemotdepassedeLDAP',
+        'verify_cert': True,
+        'starttls': True,
+        'timeout': 10,
+        'uid': 'uid',
+        'member_lookup': member_lookup,
+        'user_base': 'dc=example,dc=com'}}
+    group_members = {'cn=group_1': [['uid=user_1', 'cn=group_2'], ['UID=user_2']],
+                     'cn=group_2': [['uid=user_2', 'uid=user_3', 'cn=group_1']],
+                     'cn=empty': []}
+    users = {'uid=user_1', 'uid=user_2', 'UID=user_2', 'uid=user_3'}
+
+    def _read_entries(dns, search_filter, attributes):
+        for dn in dns:
+            if (dn in users) == (search_filter == '(objectClass=person)'):
+                yield dn, {'uid': [dn.split('=')[1].encode()]}
+
+    mocker.patch('flask_multipass.providers.ldap.util.ReconnectLDAPObject')
+    get_group_member_dns = mocker.patch('flask_multipass.providers.ldap.providers.get_group_member_dns',
+                                        side_effect=lambda group_dn, member_attr: iter(group_members[group_dn]))
+    mocker.patch('flask_multipass.providers.ldap.providers.read_entries', side_effect=_read_entries)
+    app = Flask('test')
+    multipass = Multipass(app)
+    with app.app_context():
+        idp = LDAPIdentityProvider(multipass, 'LDAP test idp', settings)
+    return idp, get_group_member_dns
+
+
+def test_get_members_member_attr(mocker):
+    idp, get_group_member_dns = _make_member_attr_idp(mocker, 'member_attr')
+    idp._search_users = MagicMock()
+    group = LDAPGroup(idp, 'LDAP test group', 'cn=group_1')
+    assert sorted(member.identifier for member in group.get_members()) == ['user_1', 'user_2', 'user_3']
+    assert {c.args for c in get_group_member_dns.call_args_list} == {('cn=group_1', 'member'),
+                                                                     ('cn=group_2', 'member')}
+    assert group.count_members() == 3
+    assert not idp._search_users.called
+
+
+def test_get_members_auto_without_member_of(mocker):
+    idp, __ = _make_member_attr_idp(mocker, 'auto')
+    # the directory does not maintain memberOf, so searching users by it never finds anything
+    idp._search_users = MagicMock(return_value=[])
+    idp._search_groups = MagicMock(return_value=[])
+    group = LDAPGroup(idp, 'LDAP test group', 'cn=group_1')
+    assert idp._get_member_lookup() is None
+    assert sorted(member.identifier for member in group.get_members()) == ['user_1', 'user_2', 'user_3']
+    assert idp._search_users.called
+    assert idp._get_member_lookup() == 'member_attr'
+    idp._search_users.reset_mock()
+    assert sorted(member.identifier for member in group.get_members()) == ['user_1', 'user_2', 'user_3']
+    assert group.count_members() == 3
+    assert not idp._search_users.called
+
+
+def _member_of_entries(*identifiers):
+    return [(f'uid={identifier}', {'uid': [identifier.encode()]}) for identifier in identifiers]
+
+
+def test_get_members_auto_member_of(mocker):
+    idp, get_group_member_dns = _make_member_attr_idp(mocker, 'auto')
+    idp._search_users = MagicMock(return_value=_member_of_entries('user_1', 'user_2', 'user_3'))
+    idp._search_groups = MagicMock(return_value=[])
+    # the member attribute takes 10s, the member-of search 1s
+    mocker.patch('flask_multipass.providers.ldap.providers.time.monotonic', side_effect=[0, 10, 10, 11])
+    group = LDAPGroup(idp, 'LDAP test group', 'cn=group_1')
+    assert sorted(member.identifier for member in group.get_members()) == ['user_1', 'user_2', 'user_3']
+    # both strategies found the same members, so the faster one is used from now on
+    assert idp._get_member_lookup() == 'member_of'
+    get_group_member_dns.reset_mock()
+    assert sorted(member.identifier for member in group.get_members()) == ['user_1', 'user_2', 'user_3']
+    assert not get_group_member_dns.called
+    # if it stops finding members, the member attribute is used instead
+    idp._search_users.return_value = []
+    assert sorted(member.identifier for member in group.get_members()) == ['user_1', 'user_2', 'user_3']
+    assert get_group_member_dns.called
+
+
+@pytest.mark.parametrize(('group_dn', 'member_of', 'expected_lookup', 'expected'), (
+    # the member-of attribute is incomplete
+    ('cn=group_1', ['user_1'], 'member_attr', ['user_1', 'user_2', 'user_3']),
+    # the member-of attribute contains stale entries
+    ('cn=group_1', ['user_1', 'user_2', 'user_3', 'user_4'], 'member_attr', ['user_1', 'user_2', 'user_3']),
+    # an empty group does not tell us anything, so the member attribute is used
+    ('cn=empty', [], 'member_attr', []),
+))
+def test_get_members_auto_mismatch(mocker, group_dn, member_of, expected_lookup, expected):
+    idp, __ = _make_member_attr_idp(mocker, 'auto')
+    idp._search_users = MagicMock(return_value=_member_of_entries(*member_of))
+    idp._search_groups = MagicMock(return_value=[])
+    group = LDAPGroup(idp, 'LDAP test group', group_dn)
+    assert sorted(member.identifier for member in group.get_members()) == expected
+    assert idp._get_member_lookup() == expected_lookup
+
+
+def test_get_members_auto_probe_size(mocker):
+    idp, __ = _make_member_attr_idp(mocker, 'auto')
+    mocker.patch('flask_multipass.providers.ldap.providers.MEMBER_LOOKUP_PROBE_SIZE', 2)
+    retrieved = []
+
+    def _search_users(search_filter):
+        for entry in _member_of_entries('user_1', 'user_2', 'user_3'):
+            retrieved.append(entry[0])
+            yield entry
+
+    idp._search_users = MagicMock(side_effect=_search_users)
+    idp._search_groups = MagicMock(return_value=[])
+    mocker.patch('flask_multipass.providers.ldap.providers.time.monotonic', side_effect=[0, 10, 10, 11])
+    group = LDAPGroup(idp, 'LDAP test group', 'cn=group_1')
+    assert sorted(member.identifier for member in group.get_members()) == ['user_1', 'user_2', 'user_3']
+    # both strategies found the maximum number of members while probing, so the faster one is used
+    assert idp._get_member_lookup() == 'member_of'
+    assert retrieved == ['uid=user_1', 'uid=user_2', 'uid=user_1', 'uid=user_2', 'uid=user_3']
+
+
+def test_has_members_member_attr(mocker):
+    idp, get_group_member_dns = _make_member_attr_idp(mocker, 'member_attr')
+    users = {'user_1': 'uid=user_1', 'user_3': 'UID=user_3', 'user_4': 'uid=user_4'}
+
+    def _search_subtrees(base_dn, search_filter, attributes):
+        return [(dn, {'uid': [uid.encode()]}) for uid, dn in users.items() if f'(uid={uid})' in search_filter.lower()]
+
+    search_subtrees = mocker.patch('flask_multipass.providers.ldap.providers.search_subtrees',
+                                   side_effect=_search_subtrees)
+    group = LDAPGroup(idp, 'LDAP test group', 'cn=group_1')
+    # user_3 is a member of a nested group, user_5 does not exist
+    assert group.has_members(['user_1', 'USER_3', 'user_4', 'user_5']) == {'user_1', 'USER_3'}
+    assert {c.args for c in get_group_member_dns.call_args_list} == {('cn=group_1', 'member'),
+                                                                     ('cn=group_2', 'member')}
+    assert search_subtrees.call_count == 1
+    get_group_member_dns.reset_mock()
+    read_entries = providers.read_entries
+    read_entries.reset_mock()
+    # the member attribute is only read until all users have been found
+    assert group.has_member('user_1')
+    assert get_group_member_dns.call_count == 1
+    assert not read_entries.called
+    assert not group.has_member('user_4')
+    assert not group.has_member('user_5')
+
+
+@pytest.mark.parametrize(('ad_group_style', 'expected'), (
+    (False, 3),
+    (True, 5),
+))
+def test_count_members(mocker, ad_group_style, expected):
+    settings = {'member_count_cache_ttl': 60, 'ldap': {
+        'uri': 'ldaps://ldap.example.com:636',
+        'bind_dn': 'uid=admin,DC=example,DC=com',
+        'bind_password': 'LemotdepassedeLDAP',
+        'verify_cert': True,
+        'starttls': True,
+        'timeout': 10,
+        'ad_group_style': ad_group_style,
+        'uid': 'uid',
+        'member_of_attr': 'memberOf',
+        'user_base': 'dc=example,dc=com'}}
+    members = {'(memberOf=group_1)': ['user_1', 'user_2'],
+               '(memberOf=group_2)': ['user_2', 'user_3'],
+               '(memberOf:1.2.840.113556.1.4.1941:=group_1)': ['user_1', 'user_2', 'user_3', 'user_4', 'user_5']}
+    subgroups = {'(memberOf=group_1)': [('group_2', {})]}
+
+    def _search_subtrees(base_dn, search_filter, attributes):
+        assert attributes == ['1.1']
+        return next(([(dn, {}) for dn in dns] for key, dns in members.items() if key in search_filter), [])
+
+    mocker.patch('flask_multipass.providers.ldap.util.ReconnectLDAPObject')
+    search_subtrees = mocker.patch('flask_multipass.providers.ldap.providers.search_subtrees',
+                                   side_effect=_search_subtrees)
+    app = Flask('test')
+    multipass = Multipass(app)
+    with app.app_context():
+        idp = LDAPIdentityProvider(multipass, 'LDAP test idp', settings)
+    idp._search_groups = MagicMock(side_effect=lambda x: next((v for k, v in subgroups.items() if k in x), []))
+    group = LDAPGroup(idp, 'LDAP test group', 'group_1')
+
+    assert group.count_members() == expected
+    call_count = search_subtrees.call_count
+    assert call_count == (1 if ad_group_style else 2)
+    # the count is cached
+    assert LDAPGroup(idp, 'LDAP test group', 'group_1').count_members() == expected
+    assert search_subtrees.call_count == call_count
+
+
 @pytest.mark.parametrize(('settings', 'group_mock', 'user_mock', 'expected'), (
     ({'ldap': {
         'uri': 'ldaps://ldap.example.com:636',
@@ -421,6 +609,45 @@ def test_has_member_bad_identifier(mocker, settings):
         group.has_member(None)
 
 
+@pytest.mark.parametrize(('ad_group_style', 'member_of_filter'), (
+    (False, '(member_of=cn=group,dc=example,dc=com)'),
+    (True, '(member_of:1.2.840.113556.1.4.1941:=cn=group,dc=example,dc=com)'),
+))
+def test_has_members(mocker, ad_group_style, member_of_filter):
+    settings = {'ldap': {
+        'uri': 'ldaps://ldap.example.com:636',
+        'bind_dn': 'uid=admin,DC=example,DC=com',
+        'bind_password': 'LemotdepassedeLDAP',
+        'verify_cert': True,
+        'starttls': True,
+        'timeout': 10,
+        'ad_group_style': ad_group_style,
+        'uid': 'uid',
+        'member_of_attr': 'member_of',
+        'user_base': 'dc=example,dc=com',
+        'user_filter': '(objectClass=person)'}}
+    mocker.patch('flask_multipass.providers.ldap.util.ReconnectLDAPObject')
+    search_subtrees = mocker.patch('flask_multipass.providers.ldap.providers.search_subtrees',
+                                   return_value=[('uid=foo,dc=example,dc=com', {'uid': [b'Foo']}),
+                                                 ('uid=bar,dc=example,dc=com', {'uid': [b'bar']})])
+    app = Flask('test')
+    multipass = Multipass(app)
+    with app.app_context():
+        idp = LDAPIdentityProvider(multipass, 'LDAP test idp', settings)
+    group = LDAPGroup(idp, 'LDAP test group', 'cn=group,dc=example,dc=com')
+
+    assert group.has_members(['foo', 'bar', 'baz']) == {'foo', 'bar'}
+    search_subtrees.assert_called_once()
+    base_dn, search_filter, attributes = search_subtrees.call_args[0]
+    assert base_dn == 'dc=example,dc=com'
+    assert attributes == ['uid']
+    assert search_filter.startswith('(&(|(uid=')
+    assert all(f'(uid={x})' in search_filter for x in ('foo', 'bar', 'baz'))
+    assert search_filter.endswith(f'){member_of_filter}(objectClass=person))')
+    assert group.has_members([]) == set()
+    search_subtrees.assert_called_once()
+
+
 @pytest.mark.parametrize('settings', (
     {'ldap': {
         'uri': 'ldaps://ldap.example.com:636',
@@ -520,7 +747,9 @@ def test_default_authp_settings(mocker, required_settings, expected_settings):
       'group_base': 'OU=Groups,OU=Required,DC=example,DC=com',
       'group_filter': '(objectClass=groupOfNames)',
       'member_of_attr': 'memberOf',
-      'ad_group_style': False}),
+      'ad_group_style': False,
+      'member_attr': 'member',
+      'member_lookup': 'member_of'}),
     ({'uri': 'ldaps://required.uri',
       'bind_dn': 'uid=admin,OU=Users,OU=Required,DC=example,DC=com',
       'bind_password': 'required_password',
@@ -547,7 +776,9 @@ def test_default_authp_settings(mocker, required_settings, expected_settings):
       'group_base': 'OU=Groups,OU=Required,DC=example,DC=com',
       'group_filter': '(|(objectClass=groupOfNames)(objectClass=custom))',
       'member_of_attr': 'member_of',
-      'ad_group_style': True}),
+      'ad_group_style': True,
+      'member_attr': 'member',
+      'member_lookup': 'member_of'}),
 ))
 def test_default_idp_settings(mocker, required_settings, expected_settings):
     certifi = mocker.patch('flask_multipass.providers.ldap.providers.certifi')
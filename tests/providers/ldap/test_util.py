@@ -11,9 +11,17 @@ from urllib.parse import urlsplit
 import ldap
 import pytest
 
-from flask_multipass.exceptions import MultipassException
+from flask_multipass.exceptions import MultipassException, ProviderUnavailable
 from flask_multipass.providers.ldap.globals import current_ldap
-from flask_multipass.providers.ldap.util import LDAPContext, build_search_filter, find_one, ldap_context, to_unicode
+from flask_multipass.providers.ldap.util import (
+    LDAPContext,
+    LDAPServerPool,
+    build_search_filter,
+    find_one,
+    get_server_pool,
+    ldap_context,
+    to_unicode,
+)
 from flask_multipass.util import convert_app_data
 
 
@@ -59,6 +67,16 @@ def test_build_search_filter(monkeypatch, criteria, type_filter, mapping, exact,
     assert build_search_filter(criteria, type_filter, mapping, exact) == expected
 
 
+@pytest.mark.parametrize(('criteria', 'expected'), (
+    ({'sn': ['Mazz']}, '(&(sn=Mazz*)(objectClass=Person))'),
+    ({'sn': ['Mazz', 'D(']}, r'(&(|(sn=Mazz*)(sn=D\28*))(objectClass=Person))'),
+))
+def test_build_search_filter_prefix(criteria, expected):
+    assert build_search_filter(criteria, '(objectClass=Person)', match='prefix') == expected
+    with pytest.raises(ValueError):
+        build_search_filter(criteria, '(objectClass=Person)', exact=True, match='prefix')
+
+
 @pytest.mark.parametrize(('data', 'expected'), (
     ({'uid': [b'amazzing'], 'givenName': [b'Antonio'], 'sn': [b'Mazzinghy']},
      {'uid': ['amazzing'], 'givenName': ['Antonio'], 'sn': ['Mazzinghy']}),
@@ -190,6 +208,78 @@ def test_ldap_context_invalid_credentials(mocker, method, triggered_exception, c
     assert str(excinfo.value) == message
 
 
+@pytest.mark.parametrize('strategy', ('latency', 'outstanding'))
+def test_ldap_context_failover(mocker, strategy):
+    uris = [f'ldap://{strategy}{i}.example.com' for i in range(3)]
+    settings = {
+        'uri': uris,
+        'bind_dn': 'uid=admin,DC=example,DC=com',
+        'bind_password': 'LemotdepassedeLDAP',
+        'verify_cert': False,
+        'starttls': False,
+        'server_selection': strategy,
+        'server_retry_interval': 3600,
+    }
+    connections = {uri: MagicMock(uri=uri) for uri in uris}
+    connections[uris[0]].simple_bind_s.side_effect = ldap.SERVER_DOWN
+    mocker.patch('flask_multipass.providers.ldap.util.ReconnectLDAPObject',
+                 side_effect=lambda uri, **kwargs: connections[uri])
+    pool = get_server_pool(settings)
+    with ldap_context(settings) as ldap_ctx:
+        assert ldap_ctx.connection.uri == uris[1]
+        assert [s['outstanding'] for s in pool.health] == [0, 1, 0]
+        with ldap_context(settings, use_cache=False) as ldap_ctx:
+            # skips the failed server without trying it again and prefers the one
+            # that is not busy and whose latency is not known yet
+            assert ldap_ctx.connection.uri == uris[2]
+    assert [s['up'] for s in pool.health] == [False, True, True]
+    assert [s['outstanding'] for s in pool.health] == [0, 0, 0]
+    assert connections[uris[0]].simple_bind_s.call_count == 1
+    for conn in connections.values():
+        conn.simple_bind_s.side_effect = ldap.SERVER_DOWN
+    with pytest.raises(ProviderUnavailable), ldap_context(settings):
+        pass
+
+
+def test_server_pool_idle_connections(mocker):
+    uris = ['ldap://ldap1.example.com', 'ldap://ldap2.example.com']
+    settings = {
+        'uri': uris,
+        'bind_dn': 'uid=admin,DC=example,DC=com',
+        'bind_password': 'LemotdepassedeLDAP',
+        'verify_cert': False,
+        'starttls': False,
+    }
+    mocker.patch('flask_multipass.providers.ldap.util.ReconnectLDAPObject',
+                 side_effect=lambda uri, **kwargs: MagicMock(uri=uri))
+    pool = LDAPServerPool(uris, max_idle_connections=2)
+    mocker.patch('flask_multipass.providers.ldap.util.get_server_pool', return_value=pool)
+    connections = [pool.acquire_connection(settings) for __ in range(3)]
+    assert len({id(conn) for conn in connections}) == 3
+    for conn in connections:
+        pool.release_connection(conn, settings)
+    # only a limited number of connections is kept
+    assert connections[2].unbind_s.called
+    assert not connections[0].unbind_s.called
+    assert not connections[1].unbind_s.called
+    assert pool.acquire_connection(settings) is connections[1]
+    # connections are not shared between different credentials
+    other = pool.acquire_connection(dict(settings, bind_dn='uid=other,DC=example,DC=com'))
+    assert other is not connections[0]
+    # broken connections are not kept
+    pool.release_connection(connections[1], settings, reusable=False)
+    assert connections[1].unbind_s.called
+    # nor are connections to servers that went down in the meantime
+    pool.failed(pool.get_server(connections[0]), settings)
+    conn = pool.acquire_connection(settings)
+    assert conn is not connections[0]
+    assert connections[0].unbind_s.called
+    with pool._lock:
+        for server in pool.servers:
+            if server.probe is not None:
+                server.probe.cancel()
+
+
 @pytest.mark.parametrize(('base_dn', 'search_filter', 'data', 'expected'), (
     ('dc=example,dc=com', '(&(mail=alain.dissoir@mail.com)(objectCategory=user))',
      [('cn=alaindi,OU=Users,dc=example,dc=com', {'mail': ['alain.dissoir@mail.com'], 'name': ["Alain D'issoir"]})],
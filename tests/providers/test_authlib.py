@@ -0,0 +1,323 @@
+# This file is part of Flask-Multipass.
+# Copyright (C) 2015 - 2021 CERN
+#
+# Flask-Multipass is free software; you can redistribute it
+# and/or modify it under the terms of the MIT License.
+
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from flask import Flask
+from joserfc import jwt
+from joserfc.jwk import RSAKey
+
+from flask_multipass import AuthenticationFailed, Multipass
+from flask_multipass.providers.authlib import AuthlibAuthProvider, _PooledHTTPAdapter
+
+_names = itertools.count()
+
+
+@pytest.fixture(scope='module')
+def signing_keys():
+    return [RSAKey.generate_key(2048, parameters={'kid': kid}) for kid in ('key1', 'key2')]
+
+
+@pytest.fixture
+def make_provider():
+    app = Flask('test')
+    app.config['SECRET_KEY'] = 'secret'
+    multipass = Multipass(app)
+
+    def _make_provider(settings=None, **authlib_args):
+        # authlib keeps registered clients by name, so every provider needs a new one
+        settings = dict(settings or {}, authlib_args=dict({'client_id': 'client'}, **authlib_args))
+        return AuthlibAuthProvider(multipass, f'oidc{next(_names)}', settings)
+
+    with app.app_context():
+        yield _make_provider
+
+
+def _jwks(*keys):
+    return {'keys': [key.as_dict(private=False) for key in keys]}
+
+
+def _make_token(key, **claims):
+    claims = dict({'iss': 'https://idp.example.com', 'aud': 'client', 'sub': 'user', 'exp': int(time.time()) + 300},
+                  **claims)
+    return jwt.encode({'alg': 'RS256', 'kid': key.kid}, claims, key)
+
+
+def test_verify_bearer_token(make_provider, signing_keys):
+    key = signing_keys[0]
+    provider = make_provider(jwks=_jwks(key), issuer='https://idp.example.com')
+    auth_info = provider.verify_bearer_token(_make_token(key))
+    assert auth_info.data == {'sub': 'user'}
+
+
+@pytest.mark.parametrize('claims', (
+    {'exp': int(time.time()) - 3600},
+    {'aud': 'other-client'},
+    {'iss': 'https://evil.example.com'},
+))
+def test_verify_bearer_token_invalid_claims(make_provider, signing_keys, claims):
+    key = signing_keys[0]
+    provider = make_provider(jwks=_jwks(key), issuer='https://idp.example.com')
+    with pytest.raises(AuthenticationFailed):
+        provider.verify_bearer_token(_make_token(key, **claims))
+
+
+def test_verify_bearer_token_missing_exp(make_provider, signing_keys):
+    key = signing_keys[0]
+    provider = make_provider(jwks=_jwks(key), issuer='https://idp.example.com')
+    token = jwt.encode({'alg': 'RS256', 'kid': key.kid},
+                       {'iss': 'https://idp.example.com', 'aud': 'client', 'sub': 'user'}, key)
+    with pytest.raises(AuthenticationFailed):
+        provider.verify_bearer_token(token)
+
+
+def test_verify_bearer_token_bad_signature(make_provider, signing_keys):
+    key, other_key = signing_keys
+    provider = make_provider(jwks=_jwks(key), issuer='https://idp.example.com')
+    # signed with a different private key but claiming to use the known one
+    token = jwt.encode({'alg': 'RS256', 'kid': key.kid},
+                       {'iss': 'https://idp.example.com', 'aud': 'client', 'sub': 'user',
+                        'exp': int(time.time()) + 300}, other_key)
+    with pytest.raises(AuthenticationFailed):
+        provider.verify_bearer_token(token)
+    # a tampered payload invalidates the signature as well
+    header, __, signature = _make_token(key).split('.')
+    tampered = _make_token(key, sub='admin').split('.')[1]
+    with pytest.raises(AuthenticationFailed):
+        provider.verify_bearer_token(f'{header}.{tampered}.{signature}')
+
+
+def test_verify_bearer_token_requires_issuer(make_provider, signing_keys):
+    key = signing_keys[0]
+    # a misconfiguration is reported right away instead of failing on the first request
+    with pytest.raises(ValueError, match='issuer'):
+        make_provider(jwks=_jwks(key))
+    provider = make_provider({'bearer_token_issuer': 'https://idp.example.com'}, jwks=_jwks(key))
+    assert provider.verify_bearer_token(_make_token(key)).data == {'sub': 'user'}
+    with pytest.raises(AuthenticationFailed):
+        provider.verify_bearer_token(_make_token(key, iss='https://other.example.com'))
+
+
+def test_verify_bearer_token_unknown_kid(mocker, make_provider, signing_keys):
+    old_key, new_key = signing_keys
+    provider = make_provider(jwks=_jwks(old_key), jwks_uri='https://idp.example.com/jwks',
+                             issuer='https://idp.example.com')
+    fetch_json = mocker.patch.object(provider.authlib_client.metadata_cache, '_fetch_json',
+                                     return_value=_jwks(old_key, new_key))
+    # the keys have been rotated, so the JWKS is fetched again
+    assert provider.verify_bearer_token(_make_token(new_key)).data == {'sub': 'user'}
+    fetch_json.assert_called_once_with('https://idp.example.com/jwks')
+    # known keys do not cause another refresh
+    provider.verify_bearer_token(_make_token(old_key, sub='other'))
+    assert fetch_json.call_count == 1
+
+
+METADATA_URL = 'https://idp.example.com/.well-known/openid-configuration'
+
+
+@pytest.fixture
+def idp(mocker):
+    """Mocks the metadata and JWKS endpoints of an OIDC server."""
+    documents = {
+        METADATA_URL: {'issuer': 'https://idp.example.com', 'jwks_uri': 'https://idp.example.com/jwks'},
+        'https://idp.example.com/jwks': {'keys': []},
+    }
+
+    def _fetch_json(url):
+        return json.loads(json.dumps(documents[url]))
+
+    fetch_json = mocker.patch('flask_multipass.providers.authlib._ServerMetadataCache._fetch_json',
+                              side_effect=_fetch_json)
+    fetch_json.documents = documents
+    return fetch_json
+
+
+def test_metadata_cache(idp, make_provider):
+    provider = make_provider({'metadata_cache_ttl': 60}, server_metadata_url=METADATA_URL)
+    client = provider.authlib_client
+    assert client.load_server_metadata()['issuer'] == 'https://idp.example.com'
+    assert client.load_server_metadata()['issuer'] == 'https://idp.example.com'
+    idp.assert_called_once_with(METADATA_URL)
+
+
+def test_metadata_cache_stale(mocker, idp, make_provider):
+    provider = make_provider({'metadata_cache_ttl': 60}, server_metadata_url=METADATA_URL)
+    client = provider.authlib_client
+    cache = client.metadata_cache
+    client.load_server_metadata()
+    assert not cache.is_stale
+    idp.documents[METADATA_URL]['issuer'] = 'https://new.example.com'
+    cache.loaded_at -= 61
+    assert cache.is_stale
+    refresh_in_background = mocker.spy(cache, '_refresh_in_background')
+    thread_start = mocker.patch('flask_multipass.providers.authlib.threading.Thread.start')
+    # stale data is served while it is being refreshed
+    assert client.load_server_metadata()['issuer'] == 'https://idp.example.com'
+    assert refresh_in_background.call_count == 1
+    assert thread_start.call_count == 1
+    # only one refresh runs at a time
+    client.load_server_metadata()
+    assert thread_start.call_count == 1
+    # run the refresh
+    cache._refreshing = False
+    mocker.stop(thread_start)
+    cache._refresh_in_background()
+    for __ in range(100):
+        if not cache._refreshing:
+            break
+        time.sleep(0.01)
+    assert client.load_server_metadata()['issuer'] == 'https://new.example.com'
+    assert not cache.is_stale
+
+
+def test_metadata_cache_stale_refresh_failure(idp, make_provider):
+    provider = make_provider({'metadata_cache_ttl': 60}, server_metadata_url=METADATA_URL)
+    cache = provider.authlib_client.metadata_cache
+    provider.authlib_client.load_server_metadata()
+    cache.loaded_at -= 61
+    idp.side_effect = ConnectionError('IdP is down')
+    with pytest.raises(ConnectionError):
+        cache._refresh()
+    # the stale data is kept if refreshing fails
+    assert provider.authlib_client.load_server_metadata()['issuer'] == 'https://idp.example.com'
+
+
+def test_metadata_cache_jwks_refresh_interval(idp, make_provider):
+    provider = make_provider({'jwks_refresh_interval': 60}, server_metadata_url=METADATA_URL)
+    client = provider.authlib_client
+    cache = client.metadata_cache
+    assert client.fetch_jwk_set() == {'keys': []}
+    assert idp.call_count == 2
+    idp.documents['https://idp.example.com/jwks'] = {'keys': [{'kid': 'new'}]}
+    # the JWKS has just been fetched, so unknown key ids do not cause a refresh
+    assert client.fetch_jwk_set(force=True) == {'keys': []}
+    assert client.fetch_jwk_set(force=True) == {'keys': []}
+    assert idp.call_count == 2
+    cache._jwks_fetched_at -= 61
+    assert client.fetch_jwk_set(force=True) == {'keys': [{'kid': 'new'}]}
+    assert idp.call_count == 3
+    # the refreshed JWKS is cached again
+    assert client.fetch_jwk_set(force=True) == {'keys': [{'kid': 'new'}]}
+    assert idp.call_count == 3
+
+
+def test_metadata_cache_snapshot(tmp_path, idp, make_provider):
+    snapshot_file = tmp_path / 'metadata.json'
+    settings = {'metadata_cache_file': str(snapshot_file)}
+    provider = make_provider(settings, server_metadata_url=METADATA_URL)
+    provider.authlib_client.fetch_jwk_set()
+    snapshot = json.loads(snapshot_file.read_text())
+    assert snapshot['url'] == METADATA_URL
+    assert snapshot['metadata']['jwks'] == {'keys': []}
+    # a new worker uses the snapshot even if the IdP is down
+    idp.reset_mock()
+    idp.side_effect = ConnectionError('IdP is down')
+    provider = make_provider(settings, server_metadata_url=METADATA_URL)
+    assert provider.authlib_client.load_server_metadata()['issuer'] == 'https://idp.example.com'
+    assert provider.authlib_client.fetch_jwk_set() == {'keys': []}
+    assert not idp.called
+
+
+@pytest.mark.parametrize('snapshot', (
+    'not json',
+    json.dumps({'url': 'https://other.example.com/.well-known/openid-configuration', 'loaded_at': 0,
+                'metadata': {'issuer': 'https://other.example.com'}}),
+))
+def test_metadata_cache_snapshot_unusable(tmp_path, idp, make_provider, snapshot):
+    snapshot_file = tmp_path / 'metadata.json'
+    snapshot_file.write_text(snapshot)
+    provider = make_provider({'metadata_cache_file': str(snapshot_file)}, server_metadata_url=METADATA_URL)
+    # the metadata is fetched from the IdP and the snapshot is replaced
+    assert provider.authlib_client.load_server_metadata()['issuer'] == 'https://idp.example.com'
+    idp.assert_called_once_with(METADATA_URL)
+    assert json.loads(snapshot_file.read_text())['url'] == METADATA_URL
+
+
+def test_metadata_cache_snapshot_not_writable(tmp_path, idp, make_provider):
+    snapshot_file = tmp_path / 'missing' / 'metadata.json'
+    provider = make_provider({'metadata_cache_file': str(snapshot_file)}, server_metadata_url=METADATA_URL)
+    # failing to write the snapshot does not break anything
+    assert provider.authlib_client.load_server_metadata()['issuer'] == 'https://idp.example.com'
+    assert not snapshot_file.exists()
+
+
+def test_verify_bearer_token_unsupported(make_provider):
+    # without a source for the signing keys bearer tokens are not supported at all
+    assert not make_provider().supports_bearer_token
+    assert make_provider(server_metadata_url=METADATA_URL).supports_bearer_token
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"issuer": "http://localhost"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _JSONHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_adapter_settings(make_provider):
+    provider = make_provider({'http_pool_size': 3, 'request_timeout': 20, 'connect_timeout': 2})
+    adapter = provider.authlib_client.http_adapter
+    assert isinstance(adapter, _PooledHTTPAdapter)
+    assert adapter._pool_maxsize == 3
+    assert provider.request_timeout == (2, 20)
+    assert provider.authlib_client.metadata_cache.timeout == (2, 20)
+    provider = make_provider({'request_timeout': 5})
+    assert provider.authlib_client.http_adapter._pool_maxsize == 10
+    assert provider.request_timeout == 5
+    provider = make_provider({'http_keep_alive': False})
+    assert provider.authlib_client.http_adapter is None
+    assert provider.http_pool_stats is None
+
+
+def test_http_adapter_shared(make_provider):
+    provider = make_provider()
+    client = provider.authlib_client
+    adapter = client.http_adapter
+    sessions = [client._get_pooled_session(), client._get_pooled_session(), client._get_session(),
+                client._get_oauth_client()]
+    assert len({id(session) for session in sessions}) == 4
+    for session in sessions:
+        assert session.get_adapter('https://idp.example.com/token') is adapter
+        assert session.get_adapter('http://idp.example.com/token') is adapter
+
+
+def test_http_adapter_keep_alive(http_server, make_provider):
+    provider = make_provider({'request_timeout': 5})
+    cache = provider.authlib_client.metadata_cache
+    for __ in range(3):
+        # every request uses a new session which is closed afterwards
+        assert cache._fetch_json(f'{http_server}/metadata') == {'issuer': 'http://localhost'}
+    assert provider.http_pool_stats == {'requests': 3, 'connections': 1, 'reuse_rate': pytest.approx(2 / 3)}
+
+
+def test_http_adapter_keep_alive_disabled(http_server, make_provider):
+    provider = make_provider({'http_keep_alive': False, 'request_timeout': 5})
+    cache = provider.authlib_client.metadata_cache
+    assert cache._fetch_json(f'{http_server}/metadata') == {'issuer': 'http://localhost'}
+    assert provider.http_pool_stats is None
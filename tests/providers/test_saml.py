@@ -0,0 +1,426 @@
+# This file is part of Flask-Multipass.
+# Copyright (C) 2015 - 2021 CERN
+#
+# Flask-Multipass is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from flask import Flask
+from lxml import etree
+from onelogin.saml2.auth import OneLogin_Saml2_Auth
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
+
+from flask_multipass import Multipass
+from flask_multipass.exceptions import ProviderUnavailable
+from flask_multipass.providers.saml import SAMLAuthProvider, _FederationMetadataStore
+
+FEDERATION_METADATA = """<?xml version="1.0"?>
+<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+                       xmlns:mdui="urn:oasis:names:tc:SAML:metadata:ui">
+  <md:EntityDescriptor entityID="https://idp1.example.com">
+    <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+      <md:Extensions>
+        <mdui:UIInfo>
+          <mdui:DisplayName xml:lang="de">Erster IdP</mdui:DisplayName>
+          <mdui:DisplayName xml:lang="en">First IdP</mdui:DisplayName>
+        </mdui:UIInfo>
+      </md:Extensions>
+      <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+                              Location="https://idp1.example.com/sso"/>
+    </md:IDPSSODescriptor>
+  </md:EntityDescriptor>
+  <md:EntityDescriptor entityID="https://sp.example.com">
+    <md:SPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol"/>
+  </md:EntityDescriptor>
+  <md:EntityDescriptor entityID="https://idp2.example.com">
+    <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+      <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+                              Location="https://idp2.example.com/sso"/>
+    </md:IDPSSODescriptor>
+    <md:Organization>
+      <md:OrganizationDisplayName xml:lang="en">Second_IdP</md:OrganizationDisplayName>
+    </md:Organization>
+  </md:EntityDescriptor>
+</md:EntitiesDescriptor>
+"""
+
+
+def _make_app(**settings):
+    app = Flask('test')
+    app.config['SECRET_KEY'] = 'secret'
+    app.config['MULTIPASS_AUTH_PROVIDERS'] = {
+        'saml': dict({'type': 'saml', 'saml_config': {'sp': {'entityId': 'https://sp.example.com/saml'}}},
+                     **settings),
+    }
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {'saml': {'type': 'saml'}}
+    app.config['MULTIPASS_PROVIDER_MAP'] = {'saml': 'saml'}
+    return app
+
+
+@pytest.fixture
+def app():
+    return _make_app()
+
+
+@pytest.fixture
+def provider(app):
+    multipass = Multipass(app)
+    with app.app_context():
+        return multipass.auth_providers['saml']
+
+
+@pytest.mark.parametrize(('settings', 'uris'), (
+    ({}, ('/multipass/saml/saml/acs', '/multipass/saml/saml/sls', '/multipass/saml/saml/metadata')),
+    ({'saml_acs_uri': '/saml/acs', 'saml_metadata_uri': '/saml/metadata'},
+     ('/saml/acs', '/multipass/saml/saml/sls', '/saml/metadata')),
+))
+def test_url_rules(settings, uris):
+    app = _make_app(**settings)
+    multipass = Multipass(app)
+    with app.app_context():
+        provider = multipass.auth_providers['saml']
+    rules = SAMLAuthProvider.get_url_rules('saml', settings)
+    assert tuple(rule for rule, *__ in rules) == uris
+    assert (provider.saml_acs_uri, provider.saml_sls_uri, provider.saml_metadata_uri) == uris
+    assert (provider.settings['saml_acs_uri'], provider.settings['saml_sls_uri'],
+            provider.settings['saml_metadata_uri']) == uris
+    assert [endpoint for __, endpoint, *__ in rules] == [provider.saml_acs_endpoint, provider.saml_sls_endpoint,
+                                                          provider.saml_metadata_endpoint]
+    assert {rule.rule for rule in app.url_map.iter_rules()} >= set(uris)
+
+
+def test_saml_settings_cache(mocker, app, provider):
+    settings_cls = mocker.patch('flask_multipass.providers.saml.OneLogin_Saml2_Settings',
+                                wraps=OneLogin_Saml2_Settings)
+    with app.test_request_context(base_url='https://sp.example.com'):
+        settings = provider._get_saml_settings()
+        assert settings.get_sp_data()['assertionConsumerService']['url'] == \
+            'https://sp.example.com/multipass/saml/saml/acs'
+        assert provider._get_saml_settings() is settings
+    with app.test_request_context(base_url='https://sp.example.com'):
+        # reused in later requests using the same host and scheme
+        assert provider._get_saml_settings() is settings
+    assert settings_cls.call_count == 1
+    with app.test_request_context(base_url='http://sp.example.com'):
+        http_settings = provider._get_saml_settings()
+        assert http_settings.get_sp_data()['assertionConsumerService']['url'] == \
+            'http://sp.example.com/multipass/saml/saml/acs'
+    with app.test_request_context(base_url='https://other.example.com'):
+        other_settings = provider._get_saml_settings()
+        assert other_settings.get_sp_data()['assertionConsumerService']['url'] == \
+            'https://other.example.com/multipass/saml/saml/acs'
+    assert settings_cls.call_count == 3
+    assert len({id(settings), id(http_settings), id(other_settings)}) == 3
+    with app.test_request_context(base_url='http://sp.example.com'):
+        assert provider._get_saml_settings() is http_settings
+    assert settings_cls.call_count == 3
+
+
+def test_sp_metadata(mocker, app, provider):
+    get_sp_metadata = mocker.spy(OneLogin_Saml2_Settings, 'get_sp_metadata')
+    client = app.test_client()
+    resp = client.get('/multipass/saml/saml/metadata', base_url='https://sp.example.com')
+    assert resp.status_code == 200
+    assert resp.content_type == 'text/xml'
+    assert b'entityID="https://sp.example.com/saml"' in resp.data
+    etag = resp.headers['ETag'].strip('"')
+    assert etag == hashlib.sha256(resp.data).hexdigest()
+    assert resp.cache_control.public
+    assert 86000 < resp.cache_control.max_age <= 86400
+    # the metadata is only generated once
+    resp = client.get('/multipass/saml/saml/metadata', base_url='https://sp.example.com')
+    assert resp.status_code == 200
+    assert resp.headers['ETag'].strip('"') == etag
+    assert get_sp_metadata.call_count == 1
+
+
+def test_sp_metadata_conditional(app, provider):
+    client = app.test_client()
+    resp = client.get('/multipass/saml/saml/metadata', base_url='https://sp.example.com')
+    etag = resp.headers['ETag']
+    resp = client.get('/multipass/saml/saml/metadata', base_url='https://sp.example.com',
+                      headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert not resp.data
+    assert resp.headers['ETag'] == etag
+    resp = client.get('/multipass/saml/saml/metadata', base_url='https://sp.example.com',
+                      headers={'If-None-Match': '"outdated"'})
+    assert resp.status_code == 200
+    assert resp.data
+    # the metadata (and its etag) depends on the host
+    resp = client.get('/multipass/saml/saml/metadata', base_url='https://other.example.com',
+                      headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+
+def test_sp_metadata_expiry(mocker, app):
+    app.config['MULTIPASS_AUTH_PROVIDERS']['saml']['saml_metadata_max_age'] = 600
+    Multipass(app)
+    monotonic = mocker.patch('time.monotonic', return_value=1000)
+    get_sp_metadata = mocker.spy(OneLogin_Saml2_Settings, 'get_sp_metadata')
+    client = app.test_client()
+    resp = client.get('/multipass/saml/saml/metadata', base_url='https://sp.example.com')
+    assert resp.cache_control.max_age == 600
+    monotonic.return_value = 1500
+    resp = client.get('/multipass/saml/saml/metadata', base_url='https://sp.example.com')
+    assert resp.cache_control.max_age == 100
+    assert get_sp_metadata.call_count == 1
+    monotonic.return_value = 1601
+    resp = client.get('/multipass/saml/saml/metadata', base_url='https://sp.example.com')
+    assert resp.status_code == 200
+    assert resp.cache_control.max_age == 600
+    assert get_sp_metadata.call_count == 2
+
+
+def test_sp_metadata_invalid(mocker, app, provider):
+    mocker.patch.object(OneLogin_Saml2_Settings, 'validate_metadata', return_value=['invalid_xml'])
+    resp = app.test_client().get('/multipass/saml/saml/metadata', base_url='https://sp.example.com')
+    assert resp.status_code == 500
+    assert resp.data == b'invalid_xml'
+
+
+@pytest.fixture
+def federation_settings(tmp_path):
+    metadata_file = tmp_path / 'federation.xml'
+    metadata_file.write_text(FEDERATION_METADATA)
+    return {'metadata_file': str(metadata_file), 'index_file': str(tmp_path / 'index.sqlite')}
+
+
+def test_federation_store(federation_settings):
+    store = _FederationMetadataStore('saml', federation_settings)
+    assert store.age is None
+    assert store.search() == [('https://idp1.example.com', 'First IdP'), ('https://idp2.example.com', 'Second_IdP')]
+    assert 0 <= store.age < 5
+    assert store.search('second') == [('https://idp2.example.com', 'Second_IdP')]
+    assert store.search('idp1.example') == [('https://idp1.example.com', 'First IdP')]
+    # LIKE wildcards are escaped
+    assert store.search('d_I') == [('https://idp2.example.com', 'Second_IdP')]
+    assert store.search('%') == []
+    assert store.search(limit=1) == [('https://idp1.example.com', 'First IdP')]
+    # only IdPs are stored
+    assert store.get_metadata('https://sp.example.com') is None
+    assert store.get_metadata('https://unknown.example.com') is None
+    entity = etree.fromstring(store.get_metadata('https://idp2.example.com'))
+    assert entity.get('entityID') == 'https://idp2.example.com'
+
+
+def test_federation_store_iterparse(mocker, federation_settings):
+    iterparse = mocker.spy(etree, 'iterparse')
+    store = _FederationMetadataStore('saml', federation_settings)
+    rows = list(store._iter_idps(federation_settings['metadata_file']))
+    assert [(entity_id, name) for entity_id, name, __ in rows] == [
+        ('https://idp1.example.com', 'First IdP'),
+        ('https://idp2.example.com', 'Second_IdP'),
+    ]
+    # the aggregate is parsed incrementally instead of being loaded at once
+    assert iterparse.call_count == 1
+    assert iterparse.call_args[1]['tag'] == '{urn:oasis:names:tc:SAML:2.0:metadata}EntityDescriptor'
+    # the stored metadata is complete even though processed entities are cleared
+    entity = etree.fromstring(rows[0][2])
+    assert entity.find('.//{urn:oasis:names:tc:SAML:metadata:ui}DisplayName') is not None
+
+
+def test_federation_store_refresh(mocker, federation_settings):
+    store = _FederationMetadataStore('saml', federation_settings)
+    store.refresh()
+    Path(federation_settings['metadata_file']).write_text(
+        FEDERATION_METADATA.replace('https://idp1.example.com', 'https://idp3.example.com'))
+    replace = mocker.spy(os, 'replace')
+    store.refresh()
+    # the new index is built in a separate file and atomically swapped in
+    replace.assert_called_once_with(mocker.ANY, federation_settings['index_file'])
+    assert not os.path.exists(replace.call_args[0][0])
+    assert store.get_metadata('https://idp1.example.com') is None
+    assert store.get_metadata('https://idp3.example.com') is not None
+    assert sorted(os.listdir(os.path.dirname(federation_settings['index_file']))) == [
+        'federation.xml', 'index.sqlite',
+    ]
+
+
+def test_federation_store_refresh_failure(federation_settings):
+    store = _FederationMetadataStore('saml', federation_settings)
+    store.refresh()
+    Path(federation_settings['metadata_file']).write_text(FEDERATION_METADATA[:-50])
+    with pytest.raises(etree.XMLSyntaxError):
+        store.refresh()
+    # the old index is still used
+    assert [entity_id for entity_id, __ in store.search()] == ['https://idp1.example.com', 'https://idp2.example.com']
+
+
+def test_federation_store_stale(mocker, federation_settings):
+    federation_settings['refresh_interval'] = 60
+    store = _FederationMetadataStore('saml', federation_settings)
+    store.refresh()
+    os.utime(federation_settings['index_file'], (0, 0))
+    threads = []
+    mocker.patch('threading.Thread.start', autospec=True, side_effect=threads.append)
+    refresh = mocker.spy(store, 'refresh')
+    # the stale index is used while refreshing in the background
+    assert len(store.search()) == 2
+    assert len(store.search()) == 2
+    assert len(threads) == 1
+    assert not refresh.called
+    threads[0].run()
+    assert refresh.call_count == 1
+    assert store.age < 5
+
+
+def test_federation_store_shared_refresh(mocker, federation_settings):
+    federation_settings['refresh_interval'] = 60
+    store = _FederationMetadataStore('saml', federation_settings)
+    other = _FederationMetadataStore('saml', federation_settings)
+    store.refresh()
+    os.utime(federation_settings['index_file'], (0, 0))
+    threads = []
+    mocker.patch('threading.Thread.start', autospec=True, side_effect=threads.append)
+    refresh = mocker.spy(store, 'refresh')
+    other_refresh = mocker.spy(other, 'refresh')
+    # while the index is being refreshed by another store (e.g. in a different
+    # process), the store keeps using the stale index instead of refreshing too
+    with other._refresh_lock:
+        assert len(store.search()) == 2
+        threads.pop().run()
+    assert not refresh.called
+    # once the index has been refreshed by one store, the other does not refresh it again
+    assert len(other.search()) == 2
+    threads.pop().run()
+    assert other_refresh.call_count == 1
+    assert len(store.search()) == 2
+    assert not threads
+    # a refresh started while the index was stale is skipped if another store refreshed it in the meantime
+    os.utime(federation_settings['index_file'], (0, 0))
+    assert len(store.search()) == 2
+    other.refresh()
+    threads.pop().run()
+    assert not refresh.called
+
+
+def test_federation_store_initial_build(mocker, federation_settings):
+    store = _FederationMetadataStore('saml', federation_settings)
+    other = _FederationMetadataStore('saml', federation_settings)
+    refresh = mocker.spy(store, 'refresh')
+    results = []
+    thread = threading.Thread(target=lambda: results.append(store.search()))
+    with other._refresh_lock:
+        thread.start()
+        # without an index the store waits until the other one built it
+        thread.join(0.2)
+        assert thread.is_alive()
+        other.refresh()
+        # the index is used as soon as it exists
+        thread.join(5)
+        assert len(results[0]) == 2
+    assert not refresh.called
+
+
+def test_federation_store_initial_build_timeout(federation_settings):
+    federation_settings['build_timeout'] = 0.2
+    store = _FederationMetadataStore('saml', federation_settings)
+    other = _FederationMetadataStore('saml', federation_settings)
+    with other._refresh_lock, pytest.raises(ProviderUnavailable):
+        store.search()
+    # without anyone else building it, the store builds the index itself
+    assert len(store.search()) == 2
+
+
+@pytest.fixture
+def federation_app(federation_settings):
+    app = _make_app(saml_federation=federation_settings)
+    app.add_url_rule('/', 'index', lambda: 'index')
+    return app
+
+
+def _get_flashes(client):
+    with client.session_transaction(base_url='https://sp.example.com') as sess:
+        return [message for __, message in sess.get('_flashes', [])]
+
+
+def test_federation_login(mocker, federation_app):
+    multipass = Multipass(federation_app)
+    get_metadata = mocker.spy(_FederationMetadataStore, 'get_metadata')
+    client = federation_app.test_client()
+    resp = client.get('/login/saml', query_string={'idp': 'https://idp2.example.com'},
+                      base_url='https://sp.example.com')
+    assert resp.status_code == 302
+    assert resp.location.startswith('https://idp2.example.com/sso?SAMLRequest=')
+    with client.session_transaction(base_url='https://sp.example.com') as sess:
+        assert sess['_flaskmultipass_saml_saml_idp'] == 'https://idp2.example.com'
+    resp = client.get('/login/saml', query_string={'idp': 'https://idp1.example.com'},
+                      base_url='https://sp.example.com')
+    assert resp.location.startswith('https://idp1.example.com/sso?SAMLRequest=')
+    # the settings are only built for the IdPs which are used, and then cached
+    client.get('/login/saml', query_string={'idp': 'https://idp2.example.com'}, base_url='https://sp.example.com')
+    assert [call.args[1] for call in get_metadata.call_args_list] == [
+        'https://idp2.example.com', 'https://idp1.example.com',
+    ]
+    with federation_app.app_context():
+        assert len(multipass.auth_providers['saml']._saml_settings_cache) == 2
+
+
+def test_federation_login_discovery(federation_app):
+    discovery_url = 'https://ds.example.com/discovery'
+    federation_app.config['MULTIPASS_AUTH_PROVIDERS']['saml']['saml_federation']['discovery_url'] = discovery_url
+    Multipass(federation_app)
+    resp = federation_app.test_client().get('/login/saml', base_url='https://sp.example.com')
+    assert resp.status_code == 302
+    url = urlsplit(resp.location)
+    assert f'{url.scheme}://{url.netloc}{url.path}' == discovery_url
+    # the discovery service sends the user back to the login URL with the selected IdP
+    assert parse_qs(url.query) == {'entityID': ['https://sp.example.com/saml'],
+                                   'return': ['https://sp.example.com/login/saml'],
+                                   'returnIDParam': ['idp']}
+
+
+@pytest.mark.parametrize(('idp', 'message'), (
+    (None, 'No identity provider selected'),
+    ('https://unknown.example.com', 'Unknown identity provider'),
+    ('https://sp.example.com', 'Unknown identity provider'),
+))
+def test_federation_login_invalid_idp(federation_app, idp, message):
+    Multipass(federation_app)
+    client = federation_app.test_client()
+    resp = client.get('/login/saml', query_string={'idp': idp} if idp else {}, base_url='https://sp.example.com')
+    # the user is sent back to the login page to pick another IdP
+    assert resp.status_code == 302
+    assert resp.location == '/login/'
+    assert _get_flashes(client) == [f'Authentication failed: {message}']
+    with client.session_transaction(base_url='https://sp.example.com') as sess:
+        assert '_flaskmultipass_saml_saml_idp' not in sess
+
+
+def test_federation_acs(mocker, federation_app):
+    multipass = Multipass(federation_app)
+    identities = []
+    multipass.identity_handler(identities.append)
+    process_response = mocker.patch.object(OneLogin_Saml2_Auth, 'process_response', autospec=True)
+    mocker.patch.object(OneLogin_Saml2_Auth, 'get_attributes', return_value={'email': ['foo@example.com']})
+    mocker.patch.object(OneLogin_Saml2_Auth, 'get_nameid', return_value='foo')
+    client = federation_app.test_client()
+    client.get('/login/saml', query_string={'idp': 'https://idp2.example.com'}, base_url='https://sp.example.com')
+    resp = client.post('/multipass/saml/saml/acs', data={'SAMLResponse': 'response'},
+                       base_url='https://sp.example.com')
+    assert resp.status_code == 302
+    assert resp.location == '/'
+    # the response is processed using the settings of the IdP the user logged in with
+    auth = process_response.call_args[0][0]
+    assert auth.get_settings().get_idp_data()['entityId'] == 'https://idp2.example.com'
+    assert [(x.identifier, x.data['email']) for x in identities] == [('foo', 'foo@example.com')]
+
+
+def test_search_idps(federation_app, provider):
+    multipass = Multipass(federation_app)
+    with federation_app.app_context():
+        federation_provider = multipass.auth_providers['saml']
+    assert federation_provider.search_idps() == [('https://idp1.example.com', 'First IdP'),
+                                                 ('https://idp2.example.com', 'Second_IdP')]
+    assert federation_provider.search_idps('second') == [('https://idp2.example.com', 'Second_IdP')]
+    assert federation_provider.search_idps(limit=1) == [('https://idp1.example.com', 'First IdP')]
+    with pytest.raises(RuntimeError):
+        provider.search_idps()
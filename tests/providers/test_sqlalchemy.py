@@ -0,0 +1,175 @@
+# This file is part of Flask-Multipass.
+# Copyright (C) 2015 - 2021 CERN
+#
+# Flask-Multipass is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import pytest
+from flask import Flask
+from sqlalchemy import Column, ForeignKey, Integer, String, create_engine, event
+from sqlalchemy.orm import declarative_base, relationship, scoped_session, sessionmaker
+
+from flask_multipass import Multipass
+from flask_multipass.providers.sqlalchemy import SQLAlchemyIdentityProviderBase
+from flask_multipass.util import exact_match_first
+
+Base = declarative_base()
+db_session = scoped_session(sessionmaker())
+Base.query = db_session.query_property()
+
+
+class User(Base):
+    __tablename__ = 'users'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    email = Column(String)
+
+
+class Identity(Base):
+    __tablename__ = 'identities'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    provider = Column(String)
+    identifier = Column(String)
+    user = relationship(User, backref='identities')
+
+
+class BasicIdentityProvider(SQLAlchemyIdentityProviderBase):
+    user_model = User
+    identity_user_relationship = Identity.user
+
+
+class FullIdentityProvider(SQLAlchemyIdentityProviderBase):
+    user_model = User
+    identity_user_relationship = 'user'
+    identity_model = Identity
+    provider_column = Identity.provider
+    identifier_column = Identity.identifier
+    search_columns = {'name': User.name, 'email': User.email}
+
+
+@pytest.fixture
+def statements():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    db_session.configure(bind=engine)
+    for i, name in enumerate(('Guinea Pig', 'Pig 50%', 'Cat', 'Pig Other')):
+        user = User(name=name, email=f'user{i}@example.com')
+        user.identities.append(Identity(provider='sql', identifier=f'user{i}'))
+        user.identities.append(Identity(provider='other', identifier=f'other{i}'))
+        db_session.add(user)
+    db_session.commit()
+    executed = []
+    event.listen(engine, 'before_cursor_execute', lambda _conn, _cursor, stmt, *args: executed.append(stmt))
+    yield executed
+    db_session.remove()
+    engine.dispose()
+
+
+@pytest.fixture
+def provider(statements):
+    app = Flask('test')
+    Multipass(app)
+    with app.app_context():
+        yield FullIdentityProvider(None, 'sql', {})
+
+
+def test_support_flags():
+    app = Flask('test')
+    Multipass(app)
+    with app.app_context():
+        basic = BasicIdentityProvider(None, 'sql', {})
+        full = FullIdentityProvider(None, 'sql', {})
+    assert not basic.supports_get
+    assert not basic.supports_refresh
+    assert not basic.supports_search
+    assert not basic.supports_search_ex
+    assert full.supports_get
+    assert full.supports_refresh
+    assert full.supports_search
+    assert full.supports_search_ex
+    assert basic.search_order is None
+
+
+def test_get_identity(provider):
+    identity = provider.get_identity('user1')
+    assert identity.identifier == 'user1'
+    assert identity.data['name'] == 'Pig 50%'
+    assert provider.get_identity('other1') is None
+    assert provider.get_identity('nobody') is None
+
+
+def test_refresh_identity(provider):
+    identity = provider.refresh_identity('user0', {'_provider': 'sql'})
+    assert identity.identifier == 'user0'
+    assert identity.multipass_data == {'_provider': 'sql'}
+
+
+@pytest.mark.parametrize(('criteria', 'exact', 'expected'), (
+    ({'name': {'pig'}},                        False, ['user0', 'user1', 'user3']),
+    ({'name': {'Pig'}},                        True,  []),
+    ({'name': {'Cat', 'Pig Other'}},           True,  ['user2', 'user3']),
+    ({'name': {'50%'}},                        False, ['user1']),
+    ({'name': {'g_'}},                         False, []),
+    ({'name': {'pig'}, 'email': {'user3'}},    False, ['user3']),
+    ({'name': {'pig'}, 'unknown': {'foo'}},    False, []),
+))
+def test_search_identities(provider, criteria, exact, expected):
+    assert [x.identifier for x in provider.search_identities(criteria, exact=exact)] == expected
+
+
+@pytest.mark.parametrize(('criteria', 'expected'), (
+    ({'name': {'pig'}},             ['user1', 'user3']),
+    ({'name': {'Guinea', 'cat'}},   ['user0', 'user2']),
+    ({'name': {'Pig 5'}},           ['user1']),
+    ({'name': {'Pig_'}},            []),
+))
+def test_search_identities_prefix(provider, criteria, expected):
+    assert [x.identifier for x in provider.search_identities(criteria, match='prefix')] == expected
+    identities, total = provider.search_identities_ex(criteria, match='prefix')
+    assert [x.identifier for x in identities] == expected
+    assert total == len(expected)
+
+
+def test_search_identities_ex(provider, statements):
+    del statements[:]
+    identities, total = provider.search_identities_ex({'name': {'pig'}}, limit=2)
+    assert [x.identifier for x in identities] == ['user0', 'user1']
+    assert total == 3
+    assert 'count(*)' in statements[0].lower()
+    assert 'LIMIT' in statements[1]
+    assert 'users' in statements[1]
+
+
+@pytest.mark.parametrize(('key', 'expected'), (
+    (None, ['user0', 'user1']),
+    # only the first identities from the database are sorted using the key
+    (exact_match_first({'name': 'pig 50%'}), ['user1', 'user0']),
+))
+def test_search_identities_top(statements, key, expected):
+    app = Flask('test')
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {'sql': {'type': FullIdentityProvider}}
+    multipass = Multipass(app)
+    with app.app_context():
+        assert multipass.identity_providers['sql'].search_order == 'identifier'
+        del statements[:]
+        identities = multipass.search_identities_top(2, key=key, criteria={'name': 'pig'})
+        assert [x.identifier for x in identities] == expected
+    # the database sorts like python and applies the limit
+    assert any('LIMIT' in stmt for stmt in statements)
+    assert any('ORDER BY identities.identifier COLLATE binary' in stmt for stmt in statements)
+
+
+def test_search_identities_collation(provider, statements):
+    class CollatedIdentityProvider(FullIdentityProvider):
+        identifier_collation = 'nocase'
+
+    db_session.add(User(name='Pig Upper', identities=[Identity(provider='sql', identifier='USER9')]))
+    db_session.commit()
+    assert [x.identifier for x in provider.search_identities({'name': {'pig'}})] == ['USER9', 'user0', 'user1',
+                                                                                   'user3']
+    collated = CollatedIdentityProvider(None, 'sql', {})
+    assert [x.identifier for x in collated.search_identities({'name': {'pig'}})] == ['user0', 'user1', 'user3',
+                                                                                   'USER9']
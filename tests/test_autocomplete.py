@@ -0,0 +1,115 @@
+# This file is part of Flask-Multipass.
+# Copyright (C) 2015 - 2021 CERN
+#
+# Flask-Multipass is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import pytest
+from flask import Flask
+
+from flask_multipass import Multipass
+from flask_multipass.autocomplete import normalize_query
+from flask_multipass.util import get_state
+
+
+@pytest.fixture
+def app():
+    app = Flask('test')
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {
+        'a': {'type': 'static', 'identities': {
+            'foobar': {'name': 'Foobar', 'email': 'foobar@example.com'},
+            'foo': {'name': 'Foo', 'email': 'foo@example.com'},
+            'barfoo': {'name': 'Bar Foo', 'email': 'foo.bar@example.com'},
+            'fob': {'name': 'Fob', 'email': 'fob@example.com'},
+        }},
+        'b': {'type': 'static', 'identities': {
+            'foo': {'name': 'Foo  Bar', 'email': 'x@example.com'},
+        }},
+    }
+    return app
+
+
+@pytest.mark.parametrize(('query', 'expected'), (
+    ('  Foo ', 'foo'),
+    ('Foo \t  BAR', 'foo bar'),
+    ('Straße', 'strasse'),
+))
+def test_normalize_query(query, expected):
+    assert normalize_query(query) == expected
+
+
+def test_autocomplete(mocker, app):
+    multipass = Multipass(app)
+    with app.app_context():
+        search = mocker.spy(multipass, '_iter_search_results')
+        result = multipass.autocomplete('Fo')
+        assert [(x.provider.name, x.identifier) for x in result] == [
+            ('a', 'fob'), ('a', 'foo'), ('a', 'foobar'), ('b', 'foo'),
+        ]
+        assert search.call_count == 2
+        # the longer query is answered from the cached results
+        assert [x.identifier for x in multipass.autocomplete('foo', limit=2)] == ['foo', 'foobar']
+        assert [x.identifier for x in multipass.autocomplete('FOO bar ')] == ['foo']
+        assert search.call_count == 2
+        assert multipass.autocomplete('   ') == []
+        # identities matching several fields are only returned once
+        result = multipass.autocomplete('foo', fields=('name', 'email'), providers={'a'})
+        assert [x.identifier for x in result] == ['foo', 'foobar', 'barfoo']
+
+
+def test_autocomplete_incomplete(mocker, app):
+    app.config['MULTIPASS_AUTOCOMPLETE_FETCH_LIMIT'] = 1
+    multipass = Multipass(app)
+    with app.app_context():
+        search = mocker.spy(multipass, '_iter_search_results')
+        assert [x.identifier for x in multipass.autocomplete('Fo', providers={'a'})] == ['fob']
+        # the cached results were truncated so they cannot be narrowed down
+        assert [x.identifier for x in multipass.autocomplete('Foob', providers={'a'})] == ['foobar']
+        assert search.call_count == 2
+
+
+def test_autocomplete_fetch_limit(mocker, app):
+    app.config['MULTIPASS_AUTOCOMPLETE_FETCH_LIMIT'] = 1
+    multipass = Multipass(app)
+    with app.app_context():
+        provider = multipass.identity_providers['a']
+        original = provider.search_identities
+        consumed = []
+
+        def _search_identities(*args, **kwargs):
+            for identity in original(*args, **kwargs):
+                consumed.append(identity.identifier)
+                yield identity
+
+        search = mocker.patch.object(provider, 'search_identities', side_effect=_search_identities)
+        assert len(multipass.autocomplete('Fo', providers={'a'})) == 1
+        # only one result more than the limit is retrieved
+        assert consumed == ['fob', 'foo']
+        assert search.call_count == 1
+        # identities matching any of the fields are found, using one search per field
+        consumed.clear()
+        assert [x.identifier for x in multipass.autocomplete('foo.', fields=('name', 'email'), providers={'a'})] == [
+            'barfoo',
+        ]
+        assert search.call_count == 3
+        assert search.call_args_list[1][0][0] == {'name': {'foo.'}}
+        assert search.call_args_list[2][0][0] == {'email': {'foo.'}}
+
+
+def test_autocomplete_superseded(mocker, app):
+    multipass = Multipass(app)
+    with app.app_context():
+        autocompleter = get_state().autocompleter
+        original = multipass._iter_search_results
+
+        def _iter_search_results(*args, **kwargs):
+            # a newer query from the same client arrives while searching
+            autocompleter._start('client')
+            return original(*args, **kwargs)
+
+        search = mocker.patch.object(multipass, '_iter_search_results', side_effect=_iter_search_results)
+        assert multipass.autocomplete('Fo', client='client') is None
+        assert search.call_count == 1
+        search.side_effect = original
+        assert len(multipass.autocomplete('Fo', client='client')) == 4
+        assert not autocompleter._generations
@@ -4,12 +4,23 @@
 # Flask-Multipass is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
+import threading
+import time
 from unittest.mock import Mock
 
 import pytest
-from flask import Flask, request, session
+from flask import Flask, current_app, g, request, session
 
-from flask_multipass import AuthenticationFailed, AuthProvider, Multipass
+from flask_multipass import (
+    AuthenticationFailed,
+    AuthInfo,
+    AuthProvider,
+    IdentityInfo,
+    IdentityProvider,
+    Multipass,
+    ProviderUnavailable,
+)
+from flask_multipass.util import exact_match_first
 
 
 def test_init_app_twice():
@@ -80,6 +91,47 @@ def test_initialize_providers_unique():
         multipass.init_app(app)
 
 
+class CallbackProvider(AuthProvider):
+    instances = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        CallbackProvider.instances += 1
+
+    @classmethod
+    def get_url_rules(cls, name, settings):
+        return [(f'/callback/{name}', f'callback_{name}', 'callback', ('GET',))]
+
+    def callback(self):
+        return self.name
+
+
+@pytest.mark.parametrize('lazy', (False, True))
+def test_initialize_providers_lazy(lazy):
+    CallbackProvider.instances = 0
+    app = Flask('test')
+    app.config['MULTIPASS_LAZY_PROVIDERS'] = lazy
+    app.config['MULTIPASS_AUTH_PROVIDERS'] = {
+        'test': {'type': 'callback'},
+        'test2': {'type': 'callback'},
+    }
+    app.config['MULTIPASS_PROVIDER_MAP'] = {'test': [], 'test2': []}
+    multipass = Multipass()
+    multipass.register_provider(CallbackProvider, 'callback')
+    multipass.init_app(app)
+    assert CallbackProvider.instances == (0 if lazy else 2)
+    with app.test_client() as c:
+        assert c.get('/callback/test2').data == b'test2'
+    assert CallbackProvider.instances == (1 if lazy else 2)
+    with app.app_context():
+        assert set(multipass.auth_providers) == {'test', 'test2'}
+        assert multipass.auth_providers['test'] is multipass.auth_providers['test']
+        assert multipass.auth_providers['test2'].name == 'test2'
+        with pytest.raises(KeyError):
+            multipass.auth_providers['test3']
+    assert CallbackProvider.instances == 2
+
+
 def test_create_login_rule(mocker):
     process_login = mocker.patch.object(Multipass, 'process_login')
     app = Flask('test')
@@ -236,3 +288,373 @@ def test_load_providers_from_entrypoints():
     app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {'test': {'type': 'static'}}
     app.config['MULTIPASS_PROVIDER_MAP'] = {'test': 'test'}
     Multipass(app)
+
+
+class BearerProvider(AuthProvider):
+    supports_bearer_token = True
+
+    def verify_bearer_token(self, token):
+        if token != 'valid':
+            raise AuthenticationFailed('Invalid bearer token', provider=self)
+        return AuthInfo(self, username='foo')
+
+
+@pytest.mark.parametrize(('headers', 'token', 'result'), (
+    ({},                                  None,    None),
+    ({'Authorization': 'Basic valid'},    None,    None),
+    ({'Authorization': 'Bearer valid'},   None,    'foo'),
+    ({'Authorization': 'bearer  valid '}, None,    'foo'),
+    ({'Authorization': 'Bearer invalid'}, None,    AuthenticationFailed),
+    ({},                                  'valid', 'foo'),
+))
+def test_authenticate_bearer_token(mocker, headers, token, result):
+    app = Flask('test')
+    app.config['SECRET_KEY'] = 'testing'
+    app.config['MULTIPASS_AUTH_PROVIDERS'] = {'test': {'type': 'bearer'}, 'other': {'type': 'static'}}
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {'test': {'type': 'static', 'identities': {'foo': {}}}}
+    app.config['MULTIPASS_PROVIDER_MAP'] = {'test': 'test', 'other': 'test'}
+    multipass = Multipass()
+    multipass.register_provider(BearerProvider, 'bearer')
+    multipass.init_app(app)
+    login_finished = mocker.patch.object(multipass, 'login_finished')
+    with app.test_request_context(headers=headers):
+        if isinstance(result, type):
+            with pytest.raises(result):
+                multipass.authenticate_bearer_token(token)
+        elif result is None:
+            assert multipass.authenticate_bearer_token(token) is None
+        else:
+            assert multipass.authenticate_bearer_token(token).identifier == result
+            assert multipass.authenticate_bearer_token(token, provider='test').identifier == result
+        assert '_multipass_login_provider' not in session
+    assert not login_finished.called
+
+
+class SlowIdentityProvider(IdentityProvider):
+    barrier = None
+
+    def get_identity_from_auth(self, auth_info):
+        # only passes if all lookups run at the same time
+        self.barrier.wait(timeout=5)
+        assert current_app.name == 'test'
+        if self.settings.get('match'):
+            return IdentityInfo(self, auth_info.data['username'])
+
+
+@pytest.mark.parametrize(('all_matching', 'expected'), (
+    (False, ['b']),
+    (True,  ['b', 'c']),
+))
+def test_parallel_identity_lookups(all_matching, expected):
+    app = Flask('test')
+    app.config['SECRET_KEY'] = 'testing'
+    app.config['MULTIPASS_PARALLEL_IDENTITY_LOOKUPS'] = True
+    app.config['MULTIPASS_ALL_MATCHING_IDENTITIES'] = all_matching
+    app.config['MULTIPASS_AUTH_PROVIDERS'] = {'test': {'type': 'static'}}
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {'a': {'type': 'slow'},
+                                                  'b': {'type': 'slow', 'match': True},
+                                                  'c': {'type': 'slow', 'match': True}}
+    app.config['MULTIPASS_PROVIDER_MAP'] = {'test': ['a', 'b', 'c']}
+    multipass = Multipass()
+    multipass.register_provider(SlowIdentityProvider, 'slow')
+    multipass.init_app(app)
+    SlowIdentityProvider.barrier = threading.Barrier(3)
+    with app.test_request_context():
+        auth_info = AuthInfo(multipass.auth_providers['test'], username='foo')
+        identities = multipass._get_identities_from_auth(auth_info)
+    assert [x.provider.name for x in identities] == expected
+    assert all(x.identifier == 'foo' for x in identities)
+
+
+class FlakyIdentityProvider(IdentityProvider):
+    supports_get = True
+    supports_search = True
+    calls = 0
+
+    def get_identity(self, identifier):
+        FlakyIdentityProvider.calls += 1
+        raise OSError('Connection refused')
+
+    def search_identities(self, criteria, exact=False):
+        FlakyIdentityProvider.calls += 1
+        raise OSError('Connection refused')
+
+
+def test_circuit_breaker(mocker):
+    monotonic = mocker.patch('flask_multipass.util.time.monotonic', return_value=100)
+    app = Flask('test')
+    app.config['MULTIPASS_CIRCUIT_BREAKER'] = {'failure_threshold': 2, 'reset_timeout': 60}
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {
+        'flaky': {'type': 'flaky'},
+        'static': {'type': 'static', 'identities': {'foo': {'name': 'foo'}}, 'circuit_breaker': False},
+    }
+    multipass = Multipass()
+    multipass.register_provider(FlakyIdentityProvider, 'flaky')
+    multipass.init_app(app)
+    FlakyIdentityProvider.calls = 0
+    with app.app_context():
+        for __ in range(2):
+            with pytest.raises(OSError):
+                multipass.get_identity('flaky', 'foo')
+        assert multipass.provider_health['identity']['flaky']['state'] == 'open'
+
+        assert multipass.provider_health['identity']['static']['state'] == 'closed'
+        with pytest.raises(ProviderUnavailable):
+            multipass.get_identity('flaky', 'foo')
+        # searches skip the unavailable provider
+        assert [x.identifier for x in multipass.search_identities(name='foo')] == ['foo']
+        assert FlakyIdentityProvider.calls == 2
+        monotonic.return_value = 160
+        assert multipass.provider_health['identity']['flaky']['state'] == 'half-open'
+        with pytest.raises(OSError):
+            list(multipass.search_identities(name='foo'))
+        assert FlakyIdentityProvider.calls == 3
+        assert multipass.provider_health['identity']['flaky']['state'] == 'open'
+
+
+class UnavailableIdentityProvider(IdentityProvider):
+    def get_identity_from_auth(self, auth_info):
+        raise ProviderUnavailable('down')
+
+
+def test_circuit_breaker_login_form(mocker):
+    app = Flask('test')
+    app.config['SECRET_KEY'] = 'testing'
+    app.config['MULTIPASS_CIRCUIT_BREAKER'] = {'failure_threshold': 1}
+    # the auth and identity providers have the same name
+    app.config['MULTIPASS_AUTH_PROVIDERS'] = {'test': {'type': 'static', 'identities': {'foo': 'pw'}}}
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {'test': {'type': 'unavailable'}}
+    app.config['MULTIPASS_PROVIDER_MAP'] = {'test': 'test'}
+    multipass = Multipass()
+    multipass.register_provider(UnavailableIdentityProvider, 'unavailable')
+    multipass.init_app(app)
+    handle_auth_error = mocker.patch.object(multipass, 'handle_auth_error')
+    with app.test_request_context():
+        provider = multipass.auth_providers['test']
+        assert multipass.handle_login_form(provider, {'username': 'foo', 'password': 'pw'}) is None
+        exc = handle_auth_error.call_args[0][0]
+        assert isinstance(exc, ProviderUnavailable)
+        # the identity provider's failure is attributed to it and does not count for the auth provider
+        assert exc.provider is multipass.identity_providers['test']
+        assert multipass.provider_health['identity']['test']['state'] == 'open'
+        assert multipass.provider_health['auth']['test']['state'] == 'closed'
+        assert multipass.provider_health['auth']['test']['total_failures'] == 0
+        assert '_multipass_tracked_login' not in g
+    mocker.patch.object(multipass, '_get_identities_from_auth', return_value=['foo'])
+    multipass.identity_handler(Mock(side_effect=RuntimeError('broken callback')))
+    with app.test_request_context():
+        # errors from the application's callbacks do not count either
+        with pytest.raises(RuntimeError):
+            multipass.handle_login_form(provider, {'username': 'foo', 'password': 'pw'})
+        assert multipass.provider_health['auth']['test']['state'] == 'closed'
+        # but errors of the auth provider itself do
+        mocker.patch.object(provider, 'process_local_login', side_effect=OSError('Connection refused'))
+        with pytest.raises(OSError):
+            multipass.handle_login_form(provider, {'username': 'foo', 'password': 'pw'})
+        assert multipass.provider_health['auth']['test']['state'] == 'open'
+
+
+class BlockingIdentityProvider(IdentityProvider):
+    supports_get = True
+    calls = 0
+    release = None
+
+    def get_identity(self, identifier):
+        BlockingIdentityProvider.calls += 1
+        self.release.wait(timeout=5)
+        return IdentityInfo(self, identifier)
+
+
+def test_single_flight():
+    app = Flask('test')
+    app.config['MULTIPASS_SINGLE_FLIGHT'] = True
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {'test': {'type': 'blocking'}}
+    multipass = Multipass()
+    multipass.register_provider(BlockingIdentityProvider, 'blocking')
+    multipass.init_app(app)
+    BlockingIdentityProvider.calls = 0
+    BlockingIdentityProvider.release = threading.Event()
+    results = []
+
+    def _get_identity(identifier):
+        with app.app_context():
+            results.append(multipass.get_identity('test', identifier))
+
+    threads = [threading.Thread(target=_get_identity, args=(identifier,)) for identifier in ('foo',) * 4 + ('bar',)]
+    for thread in threads:
+        thread.start()
+    while app.extensions['multipass'].single_flight.in_flight < 2:
+        time.sleep(0.01)
+    # give the other threads some time to start waiting for the first lookup
+    time.sleep(0.1)
+    BlockingIdentityProvider.release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert BlockingIdentityProvider.calls == 2
+    assert len(results) == 5
+    assert {x.identifier for x in results} == {'foo', 'bar'}
+    assert len({id(x) for x in results}) == 2
+
+
+@pytest.mark.parametrize(('request_cache', 'calls'), (
+    (False, 3),
+    (True, 1),
+))
+def test_request_cache(mocker, request_cache, calls):
+    app = Flask('test')
+    app.config['MULTIPASS_REQUEST_CACHE'] = request_cache
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {'test': {'type': 'static', 'groups': {'group': {'foo'}}}}
+    multipass = Multipass(app)
+    with app.app_context():
+        provider = multipass.identity_providers['test']
+        get_group = mocker.spy(provider, 'get_group')
+        get_identity_groups = mocker.spy(provider, 'get_identity_groups')
+        has_member = mocker.spy(provider.group_class, 'has_member')
+        for __ in range(3):
+            assert multipass.is_identity_in_group('test', 'foo', 'group')
+            assert not multipass.is_identity_in_group('test', 'bar', 'group')
+            assert {g.name for g in multipass.get_identity_groups('test', 'foo')} == {'group'}
+        # the static provider uses get_group and has_member in get_identity_groups as well
+        assert get_group.call_count == (1 if request_cache else 2 * calls) + calls
+        assert get_identity_groups.call_count == calls
+        assert has_member.call_count == 3 * calls
+    with app.app_context():
+        # the cache is cleared at the end of the app context
+        assert multipass.is_identity_in_group('test', 'foo', 'group')
+        assert get_group.call_count == (1 if request_cache else 2 * calls) + calls + 1
+
+
+@pytest.mark.parametrize('identity_groups', (False, True))
+@pytest.mark.parametrize('request_cache', (False, True))
+def test_check_memberships(mocker, request_cache, identity_groups):
+    app = Flask('test')
+    app.config['MULTIPASS_REQUEST_CACHE'] = request_cache
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {'test': {'type': 'static', 'groups': {'a': {'foo', 'bar'},
+                                                                                         'b': {'foo'}}}}
+    multipass = Multipass(app)
+    pairs = [('foo', 'a'), ('bar', 'a'), ('baz', 'a'), ('foo', 'b'), ('bar', 'b'), ('foo', 'c')]
+    with app.app_context():
+        provider = multipass.identity_providers['test']
+        mocker.patch.object(provider, 'supports_get_identity_groups', identity_groups)
+        get_group = mocker.spy(provider, 'get_group')
+        get_identity_groups = mocker.spy(provider, 'get_identity_groups')
+        has_member = mocker.spy(provider.group_class, 'has_member')
+        has_members = mocker.spy(provider.group_class, 'has_members')
+        assert multipass.is_identity_in_group('test', 'foo', 'a')
+        assert has_member.call_count == 1
+        assert multipass.check_memberships('test', pairs) == {
+            ('foo', 'a'): True,
+            ('bar', 'a'): True,
+            ('baz', 'a'): False,
+            ('foo', 'b'): True,
+            ('bar', 'b'): False,
+            ('foo', 'c'): False,
+        }
+        has_member_calls = has_member.call_count
+        if identity_groups:
+            # foo and bar are checked against several groups, so their groups are retrieved instead
+            assert get_identity_groups.call_count == 2
+            assert has_members.call_count == 1
+            assert has_members.call_args[0][1] == {'baz'}
+        else:
+            assert not get_identity_groups.called
+            assert get_group.call_count == (3 if request_cache else 4)
+            assert has_members.call_count == 2
+            assert has_member_calls == 1
+        assert not multipass.is_identity_in_group('test', 'bar', 'b')
+        assert has_member.call_count == has_member_calls + (0 if request_cache else 1)
+
+
+@pytest.mark.parametrize(('ttl', 'calls'), (
+    (0, 2),
+    (60, 1),
+))
+def test_count_members(mocker, ttl, calls):
+    app = Flask('test')
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {'test': {'type': 'static', 'member_count_cache_ttl': ttl,
+                                                           'groups': {'a': ['foo', 'bar', 'foo'], 'b': []}}}
+    multipass = Multipass(app)
+    with app.app_context():
+        provider = multipass.identity_providers['test']
+        count_members = mocker.spy(provider.group_class, '_count_members')
+        assert provider.get_group('a').count_members() == 2
+        assert provider.get_group('a').count_members() == 2
+        assert provider.get_group('b').count_members() == 0
+        assert count_members.call_count == calls + 1
+
+
+class SubstringSearchIdentityProvider(IdentityProvider):
+    supports_search = True
+
+    def search_identities(self, criteria, exact=False):
+        yield IdentityInfo(self, 'sub', exact=exact)
+
+
+def test_search_prefix():
+    app = Flask('test')
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {
+        'static': {'type': 'static',
+                   'identities': {'foo': {'name': 'Foo Bar'}, 'bar': {'name': 'Bar Foo'}},
+                   'groups': {'foobar': [], 'barfoo': []}},
+        'sub': {'type': 'sub'},
+    }
+    multipass = Multipass()
+    multipass.register_provider(SubstringSearchIdentityProvider, 'sub')
+    multipass.init_app(app)
+    with app.app_context():
+        identities = list(multipass.search_identities(match='prefix', name='Foo'))
+        assert [x.identifier for x in identities] == ['foo', 'sub']
+        # providers without prefix matching perform a substring search
+        assert not identities[1].data['exact']
+        assert [x.identifier for x in multipass.search_identities(name='Foo')] == ['bar', 'foo', 'sub']
+        identities, total = multipass.search_identities_ex(providers={'static'}, match='prefix',
+                                                           criteria={'name': 'Bar'})
+        assert [x.identifier for x in identities] == ['bar']
+        assert total == 1
+        assert [g.name for g in multipass.search_groups('foo', match='prefix')] == ['foobar']
+        with pytest.raises(ValueError):
+            list(multipass.search_identities(match='suffix', name='Foo'))
+        with pytest.raises(ValueError):
+            list(multipass.search_groups('foo', exact=True, match='prefix'))
+
+
+class SortedIdentityProvider(IdentityProvider):
+    supports_search = True
+    search_order = 'identifier'
+    consumed = []
+    closed = False
+
+    def search_identities(self, criteria, exact=False):
+        try:
+            for identifier in ('a1', 'b1', 'c1', 'd1', 'e1'):
+                SortedIdentityProvider.consumed.append(identifier)
+                yield IdentityInfo(self, identifier, name='x')
+        except GeneratorExit:
+            SortedIdentityProvider.closed = True
+            raise
+
+
+def test_search_identities_top():
+    app = Flask('test')
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {
+        'static': {'type': 'static', 'identities': {
+            'c2': {'name': 'x'}, 'a2': {'name': 'xy'}, 'b2': {'name': 'x z'}, 'z': {'name': 'y'},
+        }},
+        'sorted': {'type': 'sorted'},
+    }
+    multipass = Multipass()
+    multipass.register_provider(SortedIdentityProvider, 'sorted')
+    multipass.init_app(app)
+    SortedIdentityProvider.consumed = []
+    with app.app_context():
+        identities = multipass.search_identities_top(4, criteria={'name': 'x'})
+        assert [(x.provider.name, x.identifier) for x in identities] == [
+            ('sorted', 'a1'), ('static', 'a2'), ('sorted', 'b1'), ('static', 'b2'),
+        ]
+        # the sorted results are abandoned once they cannot be in the result anymore
+        assert SortedIdentityProvider.consumed == ['a1', 'b1', 'c1']
+        assert SortedIdentityProvider.closed
+        identities = multipass.search_identities_top(6, key=exact_match_first({'name': 'X'}), criteria={'name': 'x'})
+        assert [x.identifier for x in identities] == ['a1', 'b1', 'c1', 'c2', 'd1', 'e1']
+        identities = multipass.search_identities_top(10, providers={'static'}, match='exact', criteria={'name': 'x'})
+        assert [x.identifier for x in identities] == ['c2']
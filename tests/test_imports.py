@@ -0,0 +1,45 @@
+# This file is part of Flask-Multipass.
+# Copyright (C) 2015 - 2021 CERN
+#
+# Flask-Multipass is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import subprocess
+import sys
+
+import pytest
+
+import flask_multipass
+
+
+def _get_imported_modules(code):
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True).stderr
+    # each line looks like `import time: self [us] | cumulative | module`
+    return {line.rsplit('|', 1)[1].strip() for line in output.splitlines() if line.startswith('import time:')}
+
+
+@pytest.mark.parametrize('code', (
+    'import flask_multipass',
+    'from flask_multipass import MultipassException, NoSuchUser',
+    'from flask_multipass.exceptions import AuthenticationFailed',
+))
+def test_lightweight_imports(code):
+    modules = _get_imported_modules(code)
+    assert 'flask_multipass' in modules
+    assert 'flask' not in modules
+    assert 'werkzeug' not in modules
+
+
+def test_core_does_not_import_sqlalchemy():
+    modules = _get_imported_modules('from flask_multipass import Multipass')
+    assert 'flask' in modules
+    assert 'sqlalchemy' not in modules
+
+
+def test_lazy_attributes():
+    for name in flask_multipass.__all__:
+        assert getattr(flask_multipass, name).__name__ == name
+        assert name in dir(flask_multipass)
+    with pytest.raises(AttributeError):
+        flask_multipass.Nothing  # noqa: B018
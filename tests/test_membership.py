@@ -0,0 +1,197 @@
+# This file is part of Flask-Multipass.
+# Copyright (C) 2015 - 2021 CERN
+#
+# Flask-Multipass is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import os
+import time
+
+import pytest
+from flask import Flask
+
+from flask_multipass import Multipass
+from flask_multipass.membership import IdentifierTable, MemberBitmap, MembershipSnapshot
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask('test')
+    app.config['MULTIPASS_IDENTITY_PROVIDERS'] = {'test': {
+        'type': 'static',
+        'identities': {'foo': {}, 'bar': {}, 'baz': {}},
+        'groups': {'a': ['foo', 'bar'], 'b': ['foo'], 'c': ['baz']},
+        'membership_snapshot': {'groups': ['a', 'b', 'missing'], 'index_file': str(tmp_path / 'members.sqlite')},
+    }}
+    return app
+
+
+def test_membership_snapshot(mocker, app):
+    multipass = Multipass(app)
+    with app.app_context():
+        provider = multipass.identity_providers['test']
+        snapshot = provider.membership_snapshot
+        refresh_in_background = mocker.patch.object(snapshot, '_refresh_in_background')
+        # without an index everything is checked using the provider
+        assert snapshot.has_members('a', ['foo']) is None
+        assert refresh_in_background.called
+        assert multipass.is_identity_in_group('test', 'foo', 'a')
+        snapshot.refresh()
+        assert snapshot.metrics['age'] < 60
+        assert snapshot.metrics['last_error'] is None
+        refresh_in_background.reset_mock()
+        has_member = mocker.spy(provider.group_class, 'has_member')
+        assert multipass.is_identity_in_group('test', 'foo', 'a')
+        assert not multipass.is_identity_in_group('test', 'baz', 'a')
+        assert multipass.check_memberships('test', [('foo', 'b'), ('bar', 'b'), ('foo', 'missing')]) == {
+            ('foo', 'b'): True,
+            ('bar', 'b'): False,
+            ('foo', 'missing'): False,
+        }
+        assert provider.get_group('a').count_members() == 2
+        get_group = mocker.spy(provider, 'get_group')
+        assert {g.name for g in multipass.get_identity_groups('test', 'foo')} == {'a', 'b'}
+        assert not get_group.called
+        assert not has_member.called
+        # groups not in the snapshot are still checked using the provider
+        assert multipass.is_identity_in_group('test', 'baz', 'c')
+        assert has_member.call_count == 1
+        assert not refresh_in_background.called
+
+
+def test_membership_snapshot_group_dn(mocker, tmp_path):
+    group = mocker.Mock(dn='cn=a,dc=example')
+    group.name = 'A'
+    group.get_members.return_value = [mocker.Mock(identifier='foo')]
+    provider = mocker.Mock()
+    provider.name = 'test'
+    provider.get_group.side_effect = lambda name: group if name == 'a' else None
+    snapshot = MembershipSnapshot(provider, {'groups': ['a', 'b'], 'index_file': str(tmp_path / 'members.sqlite')})
+    snapshot.refresh()
+    provider.get_group.reset_mock()
+    assert snapshot.get_identity_groups('foo') == {provider.group_class.return_value}
+    provider.group_class.assert_called_once_with(provider, 'A', 'cn=a,dc=example')
+    assert snapshot.get_identity_groups('bar') == set()
+    assert not provider.get_group.called
+
+
+def test_membership_snapshot_stale(mocker, app):
+    multipass = Multipass(app)
+    with app.app_context():
+        provider = multipass.identity_providers['test']
+        snapshot = provider.membership_snapshot
+        snapshot.refresh()
+        refresh_in_background = mocker.patch.object(snapshot, '_refresh_in_background')
+        mtime = time.time() - 600
+        os.utime(snapshot.index_file, (mtime, mtime))
+        # stale, but still usable while it is being refreshed
+        assert snapshot.has_members('a', ['foo', 'baz']) == {'foo'}
+        assert refresh_in_background.call_count == 1
+        mtime = time.time() - 1000
+        os.utime(snapshot.index_file, (mtime, mtime))
+        # too old to be used
+        assert snapshot.has_members('a', ['foo', 'baz']) is None
+        assert multipass.is_identity_in_group('test', 'foo', 'a')
+
+
+def test_membership_snapshot_background_refresh(app):
+    multipass = Multipass(app)
+    with app.app_context():
+        snapshot = multipass.identity_providers['test'].membership_snapshot
+    snapshot._refresh_in_background()
+    for __ in range(100):
+        if snapshot.last_sync is not None:
+            break
+        time.sleep(0.05)
+    assert snapshot.count_members('a') == 2
+    assert snapshot.metrics['last_sync_duration'] is not None
+
+
+def test_membership_snapshot_shared_refresh(mocker, app):
+    multipass = Multipass(app)
+    with app.app_context():
+        provider = multipass.identity_providers['test']
+        snapshot = provider.membership_snapshot
+        # e.g. in another worker process
+        other = MembershipSnapshot(provider, app.config['MULTIPASS_IDENTITY_PROVIDERS']['test']['membership_snapshot'])
+    snapshot.refresh()
+    mtime = time.time() - 600
+    os.utime(snapshot.index_file, (mtime, mtime))
+    threads = []
+    mocker.patch('threading.Thread.start', autospec=True, side_effect=threads.append)
+    refresh = mocker.spy(snapshot, 'refresh')
+    other_refresh = mocker.spy(other, 'refresh')
+    with app.app_context():
+        assert snapshot.has_members('a', ['foo', 'baz']) == {'foo'}
+        assert other.has_members('a', ['foo', 'baz']) == {'foo'}
+    assert len(threads) == 2
+    # while one of them refreshes the index, the other one keeps using the stale one
+    with snapshot._refresh_lock:
+        threads[1].run()
+        assert not other_refresh.called
+    threads[0].run()
+    assert refresh.call_count == 1
+    assert snapshot.age < 60
+    with app.app_context():
+        assert other.has_members('a', ['foo', 'baz']) == {'foo'}
+    assert len(threads) == 2
+    # a refresh is skipped if the index has been refreshed since it was started
+    os.utime(snapshot.index_file, (mtime, mtime))
+    with app.app_context():
+        assert other.has_members('a', ['foo', 'baz']) == {'foo'}
+    assert len(threads) == 3
+    snapshot.refresh()
+    threads[2].run()
+    assert not other_refresh.called
+
+
+def test_member_bitmap():
+    a = MemberBitmap([0, 3, 9, 70])
+    b = MemberBitmap([3, 4, 70])
+    assert list(a) == [0, 3, 9, 70]
+    assert len(a) == 4
+    assert 9 in a
+    assert 4 not in a
+    assert -1 not in a
+    assert list(a & b) == [3, 70]
+    assert list(a | b) == [0, 3, 4, 9, 70]
+    assert list(a - b) == [0, 9]
+    assert list(a ^ b) == [0, 4, 9]
+    assert MemberBitmap.from_bytes(a.to_bytes()) == a
+    assert not MemberBitmap()
+    assert MemberBitmap().to_bytes() == b''
+
+
+@pytest.mark.parametrize('persistent', (False, True))
+def test_identifier_table(tmp_path, persistent):
+    path = str(tmp_path / 'ids.sqlite') if persistent else None
+    table = IdentifierTable(path)
+    assert table.get_ids(['foo', 'bar', 'foo']) == [0, 1, 0]
+    assert table.get_id('baz') == 2
+    assert table.get_identifiers([2, 0]) == ['baz', 'foo']
+    if persistent:
+        other = IdentifierTable(path)
+        assert other.get_identifiers([1]) == ['bar']
+        assert other.get_ids(['qux', 'foo']) == [3, 0]
+        assert table.get_id('qux') == 3
+    else:
+        with pytest.raises(KeyError):
+            table.get_identifiers([3])
+
+
+def test_get_member_bitmap(mocker, app):
+    multipass = Multipass(app)
+    with app.app_context():
+        provider = multipass.identity_providers['test']
+        a = provider.get_group('a').get_member_bitmap()
+        b = provider.get_group('b').get_member_bitmap()
+        c = provider.get_group('c').get_member_bitmap()
+        assert len(a) == 2
+        assert a & b == b
+        assert not a & c
+        assert sorted(provider.identifier_table.get_identifiers(a | c)) == ['bar', 'baz', 'foo']
+        # groups in the snapshot are read from it
+        provider.membership_snapshot.refresh()
+        get_members = mocker.spy(provider.group_class, 'get_members')
+        assert provider.get_group('a').get_member_bitmap() == a
+        assert not get_members.called
@@ -0,0 +1,112 @@
+# This file is part of Flask-Multipass.
+# Copyright (C) 2015 - 2021 CERN
+#
+# Flask-Multipass is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import pytest
+from flask import Flask, session
+
+from flask_multipass import Multipass
+from flask_multipass.session import SESSION_HANDLE_KEY, MemorySessionStore, SQLiteSessionStore, multipass_session
+
+
+@pytest.fixture(params=('memory', 'sqlite'))
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemorySessionStore()
+    return SQLiteSessionStore(str(tmp_path / 'sessions.sqlite'))
+
+
+def test_store(store):
+    assert store.load('foo') is None
+    store.save('foo', {'a': [1, 2]}, 60)
+    assert store.load('foo') == {'a': [1, 2]}
+    store.save('foo', {'b': 'c'}, 60)
+    assert store.load('foo') == {'b': 'c'}
+    store.delete('foo')
+    assert store.load('foo') is None
+    store.save('bar', {'a': 1}, -1)
+    assert store.load('bar') is None
+
+
+def test_multipass_session_default():
+    app = Flask('test')
+    app.secret_key = 'testing'
+    Multipass(app)
+    with app.test_request_context():
+        multipass_session['_multipass_test'] = 'foo'
+        assert session['_multipass_test'] == 'foo'
+
+
+def _make_app(store):
+    app = Flask('test')
+    app.secret_key = 'testing'
+    app.config['MULTIPASS_SESSION_STORE'] = store
+    Multipass(app)
+    return app
+
+
+def test_multipass_session_store(store):
+    app = _make_app(store)
+    with app.test_request_context():
+        assert SESSION_HANDLE_KEY not in session
+        assert multipass_session.get('_multipass_test') is None
+        assert SESSION_HANDLE_KEY not in session
+        multipass_session['_multipass_test'] = 'x' * 10000
+        assert set(session) == {SESSION_HANDLE_KEY}
+        handle = session[SESSION_HANDLE_KEY]
+        # nothing is written until the end of the request
+        assert store.load(handle) is None
+        app.process_response(app.response_class())
+        assert store.load(handle) == {'_multipass_test': 'x' * 10000}
+        saved = dict(session)
+    with app.test_request_context():
+        session.update(saved)
+        assert multipass_session.pop('_multipass_test') == 'x' * 10000
+        app.process_response(app.response_class())
+        assert store.load(handle) is None
+    with app.test_request_context():
+        session.update(saved)
+        assert '_multipass_test' not in multipass_session
+
+
+def test_multipass_session_store_saved_once(mocker, store):
+    app = _make_app(store)
+    save = mocker.spy(store, 'save')
+
+    @app.route('/test')
+    def test():
+        for i in range(5):
+            multipass_session[f'_multipass_test{i}'] = i
+        del multipass_session['_multipass_test0']
+        return ''
+
+    @app.route('/check')
+    def check():
+        return dict(multipass_session)
+
+    with app.test_client() as client:
+        client.get('/test')
+        assert save.call_count == 1
+        assert client.get('/check').json == {f'_multipass_test{i}': i for i in range(1, 5)}
+        # unchanged data is not written again
+        assert save.call_count == 1
+
+
+def test_multipass_session_cleared(store):
+    app = _make_app(store)
+    with app.test_request_context():
+        multipass_session['_multipass_test'] = 'foo'
+        handle = session[SESSION_HANDLE_KEY]
+        app.process_response(app.response_class())
+        session.clear()
+        assert '_multipass_test' not in multipass_session
+        multipass_session['_multipass_test'] = 'bar'
+        assert session[SESSION_HANDLE_KEY] != handle
+        app.process_response(app.response_class())
+        assert store.load(handle) == {'_multipass_test': 'foo'}
+        assert store.load(session[SESSION_HANDLE_KEY]) == {'_multipass_test': 'bar'}
+        multipass_session.clear()
+        app.process_response(app.response_class())
+        assert store.load(session[SESSION_HANDLE_KEY]) is None
@@ -5,18 +5,27 @@
 # and/or modify it under the terms of the Revised BSD License.
 
 import sys
+import threading
+import time
 from importlib.metadata import EntryPoint
+from unittest.mock import Mock
 
 import pytest
 from flask import Flask
 
+import flask_multipass.util
 from flask_multipass import Multipass
 from flask_multipass.auth import AuthProvider
 from flask_multipass.core import _MultipassState
-from flask_multipass.exceptions import AuthenticationFailed
+from flask_multipass.exceptions import AuthenticationFailed, ProviderUnavailable
 from flask_multipass.identity import IdentityProvider
 from flask_multipass.util import (
+    CircuitBreaker,
+    FileLock,
+    SingleFlight,
     SupportsMeta,
+    TTLCache,
+    _entry_point_index,
     classproperty,
     convert_app_data,
     convert_provider_data,
@@ -221,10 +230,13 @@ def mock_entry_points(monkeypatch):
         def _mock_entry_points():
             return mock_eps
     else:
-        def _mock_entry_points(*, group, name):
-            return [ep for ep in mock_eps[group] if ep.name == name]
+        def _mock_entry_points(*, group, name=None):
+            return [ep for ep in mock_eps[group] if name is None or ep.name == name]
 
     monkeypatch.setattr('flask_multipass.util.importlib_entry_points', _mock_entry_points)
+    _entry_point_index.clear()
+    yield
+    _entry_point_index.clear()
 
 
 def test_resolve_provider_type_class():
@@ -251,6 +263,25 @@ def test_resolve_provider_type():
     assert resolve_provider_type(DummyBase, 'dummy') is Dummy
 
 
+def test_resolve_provider_type_cached(monkeypatch, mock_entry_points):
+    calls = []
+    importlib_entry_points = flask_multipass.util.importlib_entry_points
+
+    def _count_entry_points(**kwargs):
+        calls.append(kwargs)
+        return importlib_entry_points(**kwargs)
+
+    monkeypatch.setattr('flask_multipass.util.importlib_entry_points', _count_entry_points)
+    assert resolve_provider_type(DummyBase, 'dummy') is Dummy
+    assert resolve_provider_type(DummyBase, 'dummy') is Dummy
+    with pytest.raises(ValueError):
+        resolve_provider_type(DummyBase, 'unknown')
+    assert len(calls) == 1
+    monkeypatch.setattr('sys.path', [*sys.path, '/nonexistent'])
+    assert resolve_provider_type(DummyBase, 'dummy') is Dummy
+    assert len(calls) == 2
+
+
 @pytest.mark.parametrize(('valid', 'auth_providers', 'identity_providers', 'provider_map'), (
     (False, ['a'], [],    {}),
     (False, ['a'], ['a'], {}),
@@ -270,6 +301,183 @@ def test_validate_provider_map(valid, auth_providers, identity_providers, provid
         pytest.raises(ValueError, validate_provider_map, state)
 
 
+def test_ttl_cache(mocker):
+    monotonic = mocker.patch('flask_multipass.util.time.monotonic', return_value=100)
+    cache = TTLCache(10, max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=5)
+    cache.set('c', 3, ttl=0)
+    assert cache.get('a') == 1
+    assert cache.get('b') == 2
+    assert cache.get('c') is None
+    monotonic.return_value = 105
+    assert cache.get('a') == 1
+    assert cache.get('b', 'default') == 'default'
+    cache.set('b', 2)
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert cache.get('a') is None
+    cache.clear()
+    assert cache.get('b') is None
+
+
+def test_file_lock(tmp_path):
+    path = str(tmp_path / 'test.lock')
+    lock = FileLock(path)
+    other = FileLock(path)
+    assert lock.acquire(blocking=False)
+    # the lock file is locked as well, so other processes using the same file cannot acquire it either
+    assert not other.acquire(blocking=False)
+    lock.release()
+    with other:
+        assert not lock.acquire(blocking=False)
+    assert lock.acquire(blocking=False)
+    lock.release()
+
+
+def test_file_lock_blocking(tmp_path):
+    path = str(tmp_path / 'test.lock')
+    lock = FileLock(path)
+    acquired = []
+
+    def _acquire():
+        with FileLock(path):
+            acquired.append(True)
+
+    with lock:
+        thread = threading.Thread(target=_acquire)
+        thread.start()
+        thread.join(0.1)
+        assert not acquired
+    thread.join(5)
+    assert acquired
+
+
+def _track_call(breaker, exc=None):
+    with breaker.track():
+        if exc is not None:
+            raise exc
+
+
+def test_circuit_breaker(mocker):
+    monotonic = mocker.patch('flask_multipass.util.time.monotonic', return_value=100)
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    # errors caused by the user do not count
+    with pytest.raises(AuthenticationFailed):
+        _track_call(breaker, AuthenticationFailed())
+    with pytest.raises(RuntimeError):
+        _track_call(breaker, RuntimeError('broken'))
+    assert breaker.state == CircuitBreaker.CLOSED
+    with pytest.raises(ProviderUnavailable):
+        _track_call(breaker, ProviderUnavailable('down'))
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert breaker.health == {'state': 'open', 'consecutive_failures': 2, 'total_failures': 2,
+                              'last_error': 'down', 'retry_in': 30}
+    monotonic.return_value = 130
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # only one probe at a time
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    with pytest.raises(RuntimeError):
+        _track_call(breaker, RuntimeError('still broken'))
+    assert breaker.state == CircuitBreaker.OPEN
+    monotonic.return_value = 160
+    assert breaker.allow_request()
+    _track_call(breaker)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.health['consecutive_failures'] == 0
+    assert breaker.health['total_failures'] == 3
+
+
+def test_circuit_breaker_no_threshold():
+    breaker = CircuitBreaker('test')
+    for __ in range(10):
+        with pytest.raises(RuntimeError):
+            _track_call(breaker, RuntimeError())
+    assert breaker.allow_request()
+    assert breaker.health['consecutive_failures'] == 10
+
+
+def test_circuit_breaker_attribution():
+    auth_provider = Mock(spec=AuthProvider)
+    auth_provider.name = 'test'
+    identity_provider = Mock(spec=IdentityProvider)
+    identity_provider.name = 'test'
+    auth_breaker = CircuitBreaker('test')
+    identity_breaker = CircuitBreaker('test')
+    # the outage of a provider with the same name but a different type does not count
+    with pytest.raises(ProviderUnavailable):
+        with auth_breaker.track(auth_provider):
+            raise ProviderUnavailable('down', provider=identity_provider)
+    assert auth_breaker.health['total_failures'] == 0
+    # an outage without a provider counts only for the innermost tracked provider
+    with pytest.raises(ProviderUnavailable) as exc_info:
+        with auth_breaker.track(auth_provider), identity_breaker.track(identity_provider):
+            raise ProviderUnavailable('down')
+    assert exc_info.value.provider is identity_provider
+    assert identity_breaker.health['total_failures'] == 1
+    assert auth_breaker.health['total_failures'] == 0
+    with pytest.raises(ProviderUnavailable):
+        with auth_breaker.track(auth_provider):
+            raise ProviderUnavailable('down')
+    assert auth_breaker.health['total_failures'] == 1
+
+
+def _run_concurrently(single_flight, leader_func, follower_func, count=5):
+    entered = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def _leader():
+        entered.set()
+        release.wait(timeout=5)
+        return leader_func()
+
+    def _call(func):
+        try:
+            results.append(single_flight.call('key', func))
+        except Exception as exc:
+            results.append(exc)
+
+    threads = [threading.Thread(target=_call, args=(_leader,))]
+    threads[0].start()
+    entered.wait(timeout=5)
+    threads += [threading.Thread(target=_call, args=(follower_func,)) for __ in range(count - 1)]
+    for thread in threads[1:]:
+        thread.start()
+    # give the followers some time to start waiting for the leader
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    return results
+
+
+def test_single_flight():
+    single_flight = SingleFlight()
+    result = object()
+    results = _run_concurrently(single_flight, lambda: result, lambda: pytest.fail('call not coalesced'))
+    assert len(results) == 5
+    assert all(x is result for x in results)
+    assert single_flight.in_flight == 0
+    # nothing is cached once the call finished
+    assert single_flight.call('key', lambda: 'new') == 'new'
+
+
+def test_single_flight_exception():
+    single_flight = SingleFlight()
+    exc = RuntimeError('broken')
+
+    def _fail():
+        raise exc
+
+    results = _run_concurrently(single_flight, _fail, lambda: pytest.fail('call not coalesced'))
+    assert len(results) == 5
+    assert all(x is exc for x in results)
+    assert single_flight.in_flight == 0
+
+
 def test_classproperty():
     class Foo:
         @classproperty